@@ -49,6 +49,8 @@ NEGATIVE_EXCHANGE_DIFFERENCE = int(os.environ.get('NEGATIVE_EXCHANGE_DIFFERENCE'
 DEFAULT_INC_CATEGORY = int(os.environ.get('DEFAULT_INC_CATEGORY'))
 DEFAULT_EXP_CATEGORY = int(os.environ.get('DEFAULT_EXP_CATEGORY'))
 
+TRANSACTION_PARTITIONING = os.environ.get('TRANSACTION_PARTITIONING', 'False') == 'True'
+
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
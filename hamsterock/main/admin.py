@@ -1,4 +1,5 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.db import transaction
 from django.utils.safestring import mark_safe
 from mptt.admin import MPTTModelAdmin
 
@@ -8,6 +9,27 @@ admin.site.site_title = 'Админ-панель сайта "Хомячок - у
 admin.site.site_header = 'Админ-панель сайта "Хомячок - управление личным бюджетом!"'
 
 
+class ReferencesDeleteGuardMixin:
+    """
+    Запрет удаления объекта из админки, если на него есть ссылки (см. get_references) - одним запросом, без сбора
+    всех связанных объектов на странице подтверждения удаления. При групповом удалении такие объекты пропускаются.
+    """
+    def has_delete_permission(self, request, obj=None):
+        if obj is not None and get_references(obj):
+            return False
+        return super().has_delete_permission(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        """
+        Групповое удаление (действие "Удалить выбранные") - объекты со ссылками пропускаются
+        """
+        referenced_objects = [obj for obj in queryset if get_references(obj)]
+        if referenced_objects:
+            self.message_user(request, 'Не удалены, так как на них есть ссылки: ' +
+                              ', '.join(str(obj) for obj in referenced_objects), messages.WARNING)
+        super().delete_queryset(request, queryset.exclude(pk__in=[obj.pk for obj in referenced_objects]))
+
+
 class ProfileAdmin(admin.ModelAdmin):
     list_display = ['user', 'get_html_avatar', 'date_of_birth', 'budget']
     list_display_links = ('user',)
@@ -26,7 +48,7 @@ class ProfileAdmin(admin.ModelAdmin):
 admin.site.register(Profile, ProfileAdmin)
 
 
-class CurrencyAdmin(admin.ModelAdmin):
+class CurrencyAdmin(ReferencesDeleteGuardMixin, admin.ModelAdmin):
     list_display = ['name', 'iso_code', 'numeric_code', 'entity', 'is_frequently_used']
     list_display_links = ('name',)
     search_fields = ('name', 'iso_code', 'numeric_code', 'entity')
@@ -62,11 +84,37 @@ class CurrencyRateAdmin(admin.ModelAdmin):
     save_on_top = True
     list_filter = ('currency_1',)
 
+    def save_model(self, request, obj, form, change):
+        """
+        После исправления курса пересчитываются суммы операций в базовых валютах, посчитанные по курсу на эту дату
+        (и на прежнюю, если сменились дата или валюты) - см. Transaction.reprice_by_rate.
+        Курсы хранятся к USD, поэтому пересчет идет по другой валюте пары.
+        Все пересчеты выполняются в одной транзакции: если пересчет не удался, то он откатывается целиком, а остатки
+        затронутых счетов помечаются невалидными (см. Transaction.invalidate_by_rate) - их пересчитает процедура
+        пересчета остатков.
+        """
+        super().save_model(request, obj, form, change)
+        corrections = {(obj.currency_2_id if obj.currency_1_id == DEFAULT_BASE_CURRENCY_2 else obj.currency_1_id,
+                        obj.date_rate)}
+        if change and {'currency_1', 'currency_2', 'date_rate'} & set(form.changed_data):
+            currency_1_id, currency_2_id = form.initial['currency_1'], form.initial['currency_2']
+            corrections.add((currency_2_id if currency_1_id == DEFAULT_BASE_CURRENCY_2 else currency_1_id,
+                             form.initial['date_rate']))
+        try:
+            with transaction.atomic():
+                for currency_id, date_rate in corrections:
+                    Transaction.reprice_by_rate(currency_id, date_rate)
+        except Exception as e:
+            for currency_id, date_rate in corrections:
+                Transaction.invalidate_by_rate(currency_id, date_rate)
+            self.message_user(request, 'Суммы операций по курсу не пересчитаны (' + (str(e) or e.__class__.__name__) +
+                              '), остатки затронутых счетов нужно пересчитать', messages.WARNING)
+
 
 admin.site.register(CurrencyRate, CurrencyRateAdmin)
 
 
-class CategoryAdmin(MPTTModelAdmin):
+class CategoryAdmin(ReferencesDeleteGuardMixin, MPTTModelAdmin):
     mptt_level_indent = 50
     list_display = ['item', 'name', 'type', 'user', 'budget', 'budget_object', 'time_create', 'time_update']
     list_display_links = ('item', 'name', )
@@ -36,12 +36,11 @@ def filter_budget_period(queryset, name, value):
 
 
 def filter_description(queryset, name, value):
-    return queryset.filter(Q(place__icontains=value) | Q(description__icontains=value))
+    return queryset.filter(description_search__contains=Transaction.get_search_text(value))
 
 
 def filter_banks_description(queryset, name, value):
-    return queryset.filter(Q(mcc_code__icontains=value) | Q(banks_category__icontains=value) |
-                           Q(banks_description__icontains=value))
+    return queryset.filter(banks_description_search__contains=Transaction.get_search_text(value))
 
 
 def filter_category(queryset, name, value):
@@ -50,7 +49,7 @@ def filter_category(queryset, name, value):
     elif value.lower() == 'перемещение без связи':
         return queryset.filter(type__icontains='MO', sender__isnull=True, receiver__isnull=True)
     else:
-        return queryset.distinct().filter(transaction_categories__category__name__icontains=value)
+        return queryset.filter(categories_search__contains=Transaction.get_search_text(value))
 
 
 def filter_project(queryset, name, value):
@@ -632,7 +632,7 @@ class TransactionCategoryEditForm(forms.ModelForm):
             'amount_acc_cur': forms.NumberInput(attrs={'class': 'form-input', 'step': '0.01'}),
         }
 
-    def __init__(self, parent, *args, **kwargs):
+    def __init__(self, parent, *args, shared_choices=None, **kwargs):
         super(TransactionCategoryEditForm, self).__init__(*args, **kwargs)
         self.parent_transaction = parent
         typ = 'INC' if self.parent_transaction.type == 'CRE' else \
@@ -645,17 +645,34 @@ class TransactionCategoryEditForm(forms.ModelForm):
         self.fields['category'].required = False
         self.fields['category_form'].queryset = Category.objects.filter(type=typ, budget_id__isnull=True).exclude(
             pk=exclude_category)
-        if hasattr(self.instance, 'category'):
-            if self.instance.category:
-                self.fields['category_form'].initial = self.instance.category.get_common_category_id()
-        budget_objects = [(budget_object.id, str(budget_object))
-                          for budget_object in BudgetObject.objects.filter(budget_id=parent.budget.pk)]
-        budget_objects.insert(0, (None, '<не задано>'))
-        self.fields['budget_object'].choices = budget_objects
-        if hasattr(self.instance, 'category'):
-            if self.instance.category:
-                if self.instance.category.budget_object:
-                    self.fields['budget_object'].initial = self.instance.category.budget_object.pk
+
+        # Списки выбора категорий и бюджетных объектов одинаковы для всех форм набора, поэтому строятся один раз
+        # (первой формой) и используются всеми формами (см. BaseTransactionCategoryFormset.get_form_kwargs)
+        if shared_choices is None:
+            shared_choices = {}
+        for field_name in ('category', 'category_form'):
+            if field_name not in shared_choices:
+                shared_choices[field_name] = list(self.fields[field_name].choices)
+            self.fields[field_name].choices = shared_choices[field_name]
+        if 'budget_object' not in shared_choices:
+            budget_objects = [(budget_object.id, str(budget_object))
+                              for budget_object in BudgetObject.objects.filter(budget_id=parent.budget_id)]
+            budget_objects.insert(0, (None, '<не задано>'))
+            shared_choices['budget_object'] = budget_objects
+        self.fields['budget_object'].choices = shared_choices['budget_object']
+
+        if self.instance.category_id:
+            # Базовая категория (как в Category.get_common_category_id) - по справочнику базовых категорий
+            if 'common_categories' not in shared_choices:
+                shared_choices['common_categories'] = \
+                    {(category_type, item): category_id
+                     for category_type, item, category_id in
+                     Category.objects.filter(budget_id__isnull=True).values_list('type', 'item', 'id')}
+            self.fields['category_form'].initial = \
+                shared_choices['common_categories'].get((self.instance.category.type, self.instance.category.item[:6]),
+                                                        self.instance.category_id)
+            if self.instance.category.budget_object_id:
+                self.fields['budget_object'].initial = self.instance.category.budget_object_id
 
     def get_initial_for_field(self, field, field_name):
         if self.parent_transaction.type in ['DEB', 'MO-'] and field_name == 'amount_acc_cur' and \
@@ -693,6 +710,19 @@ class TransactionCategoryEditForm(forms.ModelForm):
 class BaseTransactionCategoryFormset(BaseInlineFormSet):
     deletion_widget = HiddenInput
 
+    def __init__(self, *args, **kwargs):
+        # Общие для всех форм набора списки выбора (заполняет первая форма)
+        self.shared_choices = {}
+        # Категории операции читаем сразу с категориями - по ним формы заполняют начальные значения
+        if kwargs.get('queryset') is None:
+            kwargs['queryset'] = TransactionCategory.objects.select_related('category')
+        super(BaseTransactionCategoryFormset, self).__init__(*args, **kwargs)
+
+    def get_form_kwargs(self, index):
+        kwargs = super(BaseTransactionCategoryFormset, self).get_form_kwargs(index)
+        kwargs['shared_choices'] = self.shared_choices
+        return kwargs
+
     def clean(self):
         result = super(BaseTransactionCategoryFormset, self).clean()
 
@@ -793,6 +823,13 @@ class LoadTransactionForm(forms.Form):
                                          choices=[(None, 'Нет'), ('"', '"'), ("'", "'")],
                                          initial=None,
                                          required=False)
+    duplicates_mode = forms.ChoiceField(label='Уже загруженные операции',
+                                        widget=forms.Select(attrs={'class': 'form-input'}),
+                                        choices=[('1', 'Пропускать'), ('0', 'Загружать повторно')],
+                                        initial='1',
+                                        required=False,
+                                        help_text='Повторно загруженная операция определяется по счету, дате-времени, '
+                                                  'сумме и описанию операции от банка')
     are_field_headers = forms.ChoiceField(label='Заголовки полей',
                                           widget=forms.Select(
                                               attrs={'class': 'form-input',
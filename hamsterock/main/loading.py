@@ -0,0 +1,697 @@
+import csv
+import gzip
+import os
+import re
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+
+import django
+from django.db import connections, transaction
+from django.db.models import Q, Max
+from django.db.models.functions import TruncDate
+
+from .models import *
+
+
+def get_loading_references(account):
+    """
+    Предзагрузка справочников для загрузки операций из файла по счету.
+    Все имена, на которые могут ссылаться строки файла (валюты, категории, проекты, бюджетные объекты), получаются
+    одним запросом на справочник, чтобы при проверке строк не обращаться к базе данных.
+    :param account: счет, по которому загружаются операции;
+    :return: кортеж (словарь имен для проверки строк - передается в процессы проверки,
+                     словарь объектов для записи операций - остается в основном процессе)
+    """
+    currencies = {c.pk: c for c in Currency.objects.all()}
+
+    # Категории: сначала общие, затем категории бюджета (при совпадении имени категория бюджета приоритетнее)
+    categories = {}
+    category_names = {}
+    for c in (Category.objects
+              .filter(Q(budget__isnull=True) | Q(budget_id=account.budget_id))
+              .order_by('budget_id')):
+        categories[c.pk] = c
+        category_names[c.name] = (c.pk, c.type, c.parent_id is not None)
+
+    validation_references = {
+        'account_currency_id': account.currency_id,
+        'currencies': {c.iso_code: c.pk for c in currencies.values()},
+        'categories': category_names,
+    }
+    saving_references = {
+        'currencies': currencies,
+        'categories': categories,
+        'projects': {p.name: p for p in Project.objects.filter(budget_id=account.budget_id)},
+        'budget_objects': {o.name: o for o in BudgetObject.objects.filter(budget_id=account.budget_id)},
+        'categories_with_object': {},
+        'rates': {},
+        'import_hash_occurrences': {},
+        'last_transaction_times': {},
+    }
+    return validation_references, saving_references
+
+
+def validate_loading_rows(rows, first_row_idx, references, loading_options):
+    """
+    Проверка и нормализация порции строк файла загрузки операций.
+    Функция не обращается к базе данных (все имена берутся из предзагруженных справочников), поэтому может
+    выполняться в отдельном процессе.
+    :param rows: список строк файла (словари поле - значение);
+    :param first_row_idx: номер первой строки порции в файле;
+    :param references: словарь имен для проверки строк (см. get_loading_references);
+    :param loading_options: параметры загрузки (часовой пояс, форматы даты-времени и подсказка к ним);
+    :return: список кортежей (строка лога загрузки, словарь нормализованных значений или None при ошибках)
+    """
+    time_zone = loading_options['time_zone']
+    datetime_formats = loading_options['datetime_formats']
+    valid_datetime_formats = loading_options['valid_datetime_formats']
+
+    results = []
+    for row_idx, row in enumerate(rows, first_row_idx):
+        # Строчка лога, соответствующая строке файла
+        log = [None, row_idx, {}, {}]
+
+        # Вытаскиваем значения из строки файла, нормализуем их
+        # В случае ошибок взводим флаги ошибок для каждого поля, записываем в лог ошибку и подсказку
+
+        # 1. ОБЯЗАТЕЛЬНОЕ ПОЛЕ! Дата-время операции  - time_transaction
+        is_time_transaction_error = True
+        time_transaction_str = row.get('time_transaction', '')
+        time_transaction = None
+        log[3]['time_transaction'] = {'value': time_transaction_str}
+        # Попробуем распарсить дату-время из файла допустимыми форматами в данной локации
+        for datetime_format in datetime_formats:
+            try:
+                time_transaction = datetime.strptime(time_transaction_str, datetime_format)
+                # Приводим дату-время к UTC
+                if time_transaction.hour != 0 or time_transaction.minute != 0 or \
+                        time_transaction.second != 0 or time_transaction.microsecond != 0:
+                    time_transaction = time_transaction - timedelta(hours=float(time_zone))
+                time_transaction = datetime(time_transaction.year,
+                                            time_transaction.month,
+                                            time_transaction.day,
+                                            time_transaction.hour,
+                                            time_transaction.minute,
+                                            time_transaction.second,
+                                            time_transaction.microsecond,
+                                            timezone.utc)
+                is_time_transaction_error = False
+                break
+            except Exception as e:
+                pass
+        if is_time_transaction_error:
+            log[3]['time_transaction']['error'] = 'ошибка формата даты-времени'
+            log[3]['time_transaction']['tip'] = valid_datetime_formats
+        elif time_transaction < MIN_TRANSACTION_DATETIME or time_transaction > MAX_TRANSACTION_DATETIME:
+            is_time_transaction_error = True
+            time_transaction = None
+            log[3]['time_transaction']['error'] = 'ошибка даты-времени'
+            log[3]['time_transaction']['tip'] = \
+                f"Допускаются даты в интервале<br>от {MIN_TRANSACTION_DATETIME}<br>" \
+                f"до {MAX_TRANSACTION_DATETIME}"
+
+        # 2. ОБЯЗАТЕЛЬНОЕ ПОЛЕ! Сумма операции в валюте счета - amount_acc_cur
+        is_amount_acc_cur_error = False
+        amount_acc_cur_str = row.get('amount_acc_cur', '') or ''
+        amount_acc_cur_str = amount_acc_cur_str.replace(' ', '')
+        amount_acc_cur_str = amount_acc_cur_str.replace(',', '.')
+        amount_acc_cur = None
+        log[3]['amount_acc_cur'] = {'value': amount_acc_cur_str}
+        try:
+            amount_acc_cur = ftod(amount_acc_cur_str, 2)
+        except Exception as e:
+            is_amount_acc_cur_error = True
+            log[3]['amount_acc_cur']['error'] = 'ошибка значения суммы'
+            log[3]['amount_acc_cur']['tip'] = 'Допускаются цифры, минус,<br>точка или запятая'
+
+        # 3. ОБЯЗАТЕЛЬНОЕ ПОЛЕ! Признак операции-перемещения - movement_flag
+        is_movement_flag_error = False
+        movement_flag_str = row.get('movement_flag', '') or ''
+        movement_flag = None
+        log[3]['movement_flag'] = {'value': movement_flag_str}
+        if movement_flag_str.lower() in ['0', 'false', 'f', 'нет', 'н']:
+            movement_flag = False
+        elif movement_flag_str.lower() in ['1', 'true', 't', 'да', 'д']:
+            movement_flag = True
+        else:
+            is_movement_flag_error = True
+            log[3]['movement_flag']['error'] = 'ошибка логического значения'
+            log[3]['movement_flag']['tip'] = 'Допустимые значения:<br>0, Нет, False, 1, Да, True'
+
+        # 4. ОБЯЗАТЕЛЬНОЕ ПОЛЕ! Категория операции - category
+        is_category_error = False
+        category_str = row.get('category', '') or ''
+        category = None
+        log[3]['category'] = {'value': category_str}
+        if not movement_flag:
+            category = references['categories'].get(category_str)
+            if not category or not category[2]:
+                category = None
+                is_category_error = True
+                log[3]['category']['error'] = 'категория не найдена'
+                log[3]['category']['tip'] = \
+                    'Допустимые значения<br>смотри&nbsp;<a href="/static/main/upload/hamsterock-loading.xlsx"' \
+                    ' download="hamsterock-loading">здесь</a>'
+
+        # 5. Объект бюджета - budget_object (сам объект найдется или создастся при записи операций)
+        budget_object_str = row.get('budget_object', '') or ''
+        if budget_object_str:
+            log[3]['budget_object'] = {'value': budget_object_str}
+
+        # На основе значений признака операции-перемещения и типа категории вычисляем тип операции
+        if amount_acc_cur is None or movement_flag is None:
+            transaction_type = None
+        elif movement_flag:
+            transaction_type = 'MO+' if amount_acc_cur >= 0 else 'MO-'
+        elif category is None:
+            transaction_type = None
+        else:
+            transaction_type = 'CRE' if category[1] == 'INC' else 'DEB'
+        log[2] = {'value': transaction_type}
+
+        # 6. Валюта операции - currency
+        is_currency_error = False
+        currency_str = row.get('currency', '') or ''
+        currency_id = None
+        if currency_str:
+            log[3]['currency'] = {'value': currency_str}
+            currency_id = references['currencies'].get(currency_str)
+            if not currency_id:
+                is_currency_error = True
+                log[3]['currency']['error'] = 'валюта не найдена'
+                log[3]['currency']['tip'] = \
+                    'Допустимые значения<br>смотри&nbsp;<a href="/static/main/upload/hamsterock-loading.xlsx"' \
+                    ' download="hamsterock-loading">здесь</a>'
+        else:
+            currency_id = references['account_currency_id']
+
+        # 7. Сумма операции в валюте операции - amount
+        #    (для операции в валюте, отличной от валюты счета, сумма пересчитается по курсу при записи операций)
+        is_amount_error = False
+        amount_str = row.get('amount', '') or ''
+        amount = None
+        if amount_str:
+            amount_str = amount_str.replace(' ', '')
+            amount_str = amount_str.replace(',', '.')
+            log[3]['amount'] = {'value': amount_str}
+            try:
+                amount = ftod(amount_str, 2)
+            except Exception as e:
+                is_amount_error = True
+                log[3]['amount']['error'] = 'ошибка значения суммы'
+                log[3]['amount']['tip'] = 'Допускаются цифры, минус,<br>точка или запятая'
+        else:
+            if amount_acc_cur:
+                if currency_id == references['account_currency_id'] or currency_id is None or \
+                        time_transaction is None:
+                    amount = ftod(amount_acc_cur, 2)
+
+        # 8. Проект - project (сам проект найдется или создастся при записи операций)
+        project_str = row.get('project', '') or ''
+        if project_str:
+            log[3]['project'] = {'value': project_str}
+
+        # 9. Год периода бюджета - budget_year
+        is_budget_year_error = False
+        budget_year_str = row.get('budget_year', '') or ''
+        budget_year = None
+        if budget_year_str:
+            log[3]['budget_year'] = {'value': budget_year_str}
+            try:
+                budget_year = int(budget_year_str)
+                if not (MIN_BUDGET_YEAR <= budget_year <= MAX_BUDGET_YEAR):
+                    budget_year = None
+                    raise
+            except Exception as e:
+                is_budget_year_error = True
+                log[3]['budget_year']['error'] = 'ошибка значения года'
+                log[3]['budget_year']['tip'] = \
+                    f"Допускаются целые числа<br>в интервале от {MIN_BUDGET_YEAR} до {MAX_BUDGET_YEAR}"
+        else:
+            try:
+                budget_year = time_transaction.year
+            except Exception as e:
+                budget_year = None
+
+        # 10. Месяц периода бюджета - budget_month
+        is_budget_month_error = False
+        budget_month_str = row.get('budget_month', '') or ''
+        budget_month = None
+        if budget_month_str:
+            log[3]['budget_month'] = {'value': budget_month_str}
+            try:
+                budget_month = int(budget_month_str)
+                if not (1 <= budget_month <= 12):
+                    budget_month = None
+                    raise
+            except Exception as e:
+                is_budget_month_error = True
+                log[3]['budget_month']['error'] = 'ошибка значения месяца'
+                log[3]['budget_month']['tip'] = 'Допускаются целые числа<br>в интервале от 1 до 12'
+        else:
+            try:
+                budget_month = time_transaction.month
+            except Exception as e:
+                budget_month = None
+
+        # 11. Описание операции от банка - bank_description
+        bank_description = row.get('bank_description', None)
+        if bank_description:
+            log[3]['bank_description'] = {'value': bank_description}
+
+        # 12. Категория операции от банка - bank_category
+        bank_category = row.get('bank_category', None)
+        if bank_category:
+            log[3]['bank_category'] = {'value': bank_category}
+
+        # 13. MCC код от банка - mcc_code
+        mcc_code = row.get('mcc_code', None)
+        if mcc_code:
+            log[3]['mcc_code'] = {'value': mcc_code}
+
+        # 14. Место совершения операции - place
+        place = row.get('place', None)
+        if place:
+            log[3]['place'] = {'value': place}
+
+        # 15. Описание операции - description
+        description = row.get('description', None)
+        if description:
+            log[3]['description'] = {'value': description}
+
+        # Развилка по наличию ошибок или их отсутствию
+        if is_time_transaction_error or is_amount_acc_cur_error or is_movement_flag_error or \
+                is_category_error or is_currency_error or is_amount_error or \
+                is_budget_year_error or is_budget_month_error:
+            log[0] = 0
+            results.append((log, None))
+        else:
+            results.append((log, {'type': transaction_type,
+                                  'time_transaction': time_transaction,
+                                  'time_zone': time_zone,
+                                  'amount_acc_cur': amount_acc_cur,
+                                  'currency_id': currency_id,
+                                  'amount': amount,
+                                  'category_id': category[0] if category else None,
+                                  'category_name': category_str if category else None,
+                                  'budget_object_name': budget_object_str,
+                                  'project_name': project_str,
+                                  'budget_year': budget_year,
+                                  'budget_month': budget_month,
+                                  'place': place,
+                                  'description': description,
+                                  'mcc_code': mcc_code,
+                                  'bank_category': bank_category,
+                                  'bank_description': bank_description}))
+    return results
+
+
+def iterate_loading_chunks(rows, first_row_idx):
+    """
+    Разбиение строк файла загрузки операций на порции по TRANSACTION_LOADING_CHUNK_SIZE строк.
+    Строки читаются из итератора по мере надобности, весь файл в памяти не держится.
+    :param rows: итератор строк файла;
+    :param first_row_idx: номер первой строки в файле;
+    :return: генератор кортежей (порция строк, номер первой строки порции в файле)
+    """
+    rows = iter(rows)
+    chunk_row_idx = first_row_idx
+    while True:
+        chunk = list(islice(rows, TRANSACTION_LOADING_CHUNK_SIZE))
+        if not chunk:
+            return
+        yield chunk, chunk_row_idx
+        chunk_row_idx += len(chunk)
+
+
+def iterate_validated_chunks(rows, first_row_idx, references, loading_options):
+    """
+    Проверка строк файла загрузки операций порциями по TRANSACTION_LOADING_CHUNK_SIZE строк.
+    Если порций несколько, то они проверяются параллельно в пуле процессов (проверка не обращается к базе данных),
+    результаты возвращаются строго в порядке строк файла. В работе одновременно не больше двух порций на процесс,
+    поэтому память не зависит от размера файла. Если пул процессов недоступен, проверка идет в текущем процессе.
+    :param rows: итератор строк файла;
+    :param first_row_idx: номер первой строки в файле;
+    :param references: словарь имен для проверки строк (см. get_loading_references);
+    :param loading_options: параметры загрузки;
+    :return: генератор порций результатов проверки (см. validate_loading_rows)
+    """
+    chunks = iterate_loading_chunks(rows, first_row_idx)
+
+    # Пул процессов нужен, только если порций больше одной
+    first_chunks = list(islice(chunks, 2))
+    chunks = chain(first_chunks, chunks)
+    max_workers = os.cpu_count() or 1
+    if len(first_chunks) > 1 and max_workers > 1:
+        pending_chunks = deque()
+        try:
+            # Соединения с базой данных не должны наследоваться процессами пула
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=django.setup) as executor:
+                for chunk, chunk_row_idx in chunks:
+                    pending_chunks.append((chunk, chunk_row_idx,
+                                           executor.submit(validate_loading_rows, chunk, chunk_row_idx,
+                                                           references, loading_options)))
+                    if len(pending_chunks) >= max_workers * 2:
+                        validated_chunk = pending_chunks[0][2].result()
+                        pending_chunks.popleft()
+                        yield validated_chunk
+                while pending_chunks:
+                    validated_chunk = pending_chunks[0][2].result()
+                    pending_chunks.popleft()
+                    yield validated_chunk
+            return
+        except Exception as e:
+            print('Что-то пошло не так с параллельной проверкой строк файла загрузки - ' + str(e))
+        # Непроверенные в пуле порции проверим в текущем процессе
+        chunks = chain([(chunk, chunk_row_idx) for chunk, chunk_row_idx, future in pending_chunks], chunks)
+
+    for chunk, chunk_row_idx in chunks:
+        yield validate_loading_rows(chunk, chunk_row_idx, references, loading_options)
+
+
+def resolve_loading_rows(validated_chunk, account, user, references):
+    """
+    Дополнение проверенных строк порции объектами из базы данных (выполняется в основном процессе).
+    Находятся или создаются бюджетные объекты, категории с бюджетными объектами и проекты (каждое имя - один раз
+    за загрузку), пересчитывается по курсу сумма операции в валюте, отличной от валюты счета, вычисляется отпечаток
+    операции.
+    :param validated_chunk: порция результатов проверки (см. validate_loading_rows);
+    :param account: счет, по которому загружаются операции;
+    :param user: текущий пользователь;
+    :param references: словарь объектов для записи операций (см. get_loading_references);
+    :return: список проверенных строк порции, готовых к записи (словари нормализованных значений со строкой лога)
+    """
+    resolved_rows = []
+    for log, r in validated_chunk:
+        if r is None:
+            continue
+
+        # Бюджетный объект и категория с бюджетным объектом
+        budget_object = None
+        if r['budget_object_name']:
+            budget_object = references['budget_objects'].get(r['budget_object_name'])
+            if not budget_object:
+                try:
+                    budget_object, budget_object_created = BudgetObject.objects.get_or_create(
+                        budget_id=account.budget_id, name=r['budget_object_name'])
+                    references['budget_objects'][r['budget_object_name']] = budget_object
+                except Exception as e:
+                    log[3]['budget_object']['error'] = 'объект бюджета не был найден<br>и не смог создаться'
+                    log[3]['budget_object']['tip'] = 'Обратитесь к администратору'
+        if r['category_id'] and budget_object:
+            category_key = (r['category_id'], budget_object.pk)
+            if category_key not in references['categories_with_object']:
+                try:
+                    c_id = Category.get_category_with_object(account.budget, r['category_id'],
+                                                             budget_object.pk, user)
+                    if c_id not in references['categories']:
+                        references['categories'][c_id] = Category.objects.get(pk=c_id)
+                    references['categories_with_object'][category_key] = c_id
+                except Exception as e:
+                    references['categories_with_object'][category_key] = r['category_id']
+            r['category_id'] = references['categories_with_object'][category_key]
+        r['category'] = references['categories'].get(r['category_id'])
+
+        # Проект
+        r['project'] = None
+        if r['project_name']:
+            r['project'] = references['projects'].get(r['project_name'])
+            if not r['project']:
+                try:
+                    r['project'], project_created = Project.objects.get_or_create(budget_id=account.budget_id,
+                                                                                  name=r['project_name'])
+                    references['projects'][r['project_name']] = r['project']
+                except Exception as e:
+                    log[3]['project']['error'] = 'проект не был найден<br>и не смог создаться'
+                    log[3]['project']['tip'] = 'Обратитесь к администратору'
+                    log[0] = 0
+                    continue
+
+        # Валюта и сумма в валюте операции
+        r['currency'] = references['currencies'][r['currency_id']]
+        if r['amount'] is None and r['amount_acc_cur']:
+            rate_key = (r['currency_id'], r['time_transaction'].date())
+            if rate_key not in references['rates']:
+                references['rates'][rate_key] = CurrencyRate.get_rate(r['currency_id'], account.currency_id,
+                                                                      r['time_transaction'])
+            r['amount'] = ftod(r['amount_acc_cur'] * references['rates'][rate_key], 2)
+
+        # Отпечаток операции
+        set_loading_import_hash(r, account, references['import_hash_occurrences'])
+
+        r['log'] = log
+        resolved_rows.append(r)
+    return resolved_rows
+
+
+def set_loading_import_hash(r, account, import_hash_occurrences):
+    """
+    Вычисление отпечатка проверенной строки файла загрузки операций.
+    :param r: словарь нормализованных значений строки (см. validate_loading_rows);
+    :param account: счет, по которому загружаются операции;
+    :param import_hash_occurrences: счетчик совпадающих по реквизитам отпечатка строк файла
+    """
+    import_hash_key = (r['time_transaction'], r['amount_acc_cur'], (r['bank_description'] or '').strip())
+    import_hash_occurrences[import_hash_key] = import_hash_occurrences.get(import_hash_key, 0) + 1
+    r['import_hash'] = Transaction.get_import_hash(account.pk, r['time_transaction'], r['amount_acc_cur'],
+                                                   r['bank_description'], import_hash_occurrences[import_hash_key])
+
+
+def get_existing_loading_rows(chunk, account):
+    """
+    Поиск уже существующих операций для порции проверенных строк одним запросом на всю порцию: по отпечатку
+    операции, а для операций, загруженных до появления отпечатков, по времени + типу + сумме.
+    :param chunk: список проверенных строк порции с вычисленными отпечатками;
+    :param account: счет, по которому загружаются операции;
+    :return: список строк порции, операции по которым уже существуют
+    """
+    if not chunk:
+        return []
+    existing_hashes = set()
+    existing_keys = set()
+    existing_transactions = \
+        (Transaction.objects
+         .filter(account_id=account.pk)
+         .filter(Q(import_hash__in=[r['import_hash'] for r in chunk]) |
+                 Q(import_hash__isnull=True,
+                   time_transaction__in=[r['time_transaction'] for r in chunk]))
+         .values_list('import_hash', 'time_transaction', 'type', 'amount_acc_cur'))
+    for e_hash, e_time, e_type, e_amount in existing_transactions:
+        if e_hash:
+            existing_hashes.add(e_hash)
+        else:
+            existing_keys.add((e_time, e_type, ftod(e_amount, 2)))
+    return [r for r in chunk
+            if r['import_hash'] in existing_hashes or
+            (r['time_transaction'], r['type'], r['amount_acc_cur']) in existing_keys]
+
+
+def update_loading_last_times(chunk, account, last_transaction_times):
+    """
+    Дополнение словаря дат-времени последних операций по счету в днях операций порции.
+    Для дней, которых еще нет в словаре, время последней операции (кроме курсовых разниц) получается одним
+    сгруппированным по дням запросом на всю порцию.
+    :param chunk: список проверенных строк порции;
+    :param account: счет, по которому загружаются операции;
+    :param last_transaction_times: словарь дата - дата-время последней операции в этот день (или None)
+    """
+    days = {r['time_transaction'].date() for r in chunk} - set(last_transaction_times.keys())
+    if not days:
+        return
+    for day in days:
+        last_transaction_times[day] = None
+    last_times_by_days = \
+        (Transaction.objects
+         .filter(budget_id=account.budget_id,
+                 account_id=account.pk,
+                 time_transaction__gte=datetime(min(days).year, min(days).month, min(days).day,
+                                                0, 0, 0, 0, timezone.utc),
+                 time_transaction__lt=datetime(max(days).year, max(days).month, max(days).day,
+                                               0, 0, 0, 0, timezone.utc) + timedelta(days=1))
+         .exclude(type__in=['ED+', 'ED-'])
+         .annotate(day=TruncDate('time_transaction', tzinfo=timezone.utc))
+         .filter(day__in=days)
+         .values('day')
+         .annotate(last_time_transaction=Max('time_transaction'))
+         .values_list('day', 'last_time_transaction'))
+    for day, last_time_transaction in last_times_by_days:
+        last_transaction_times[day] = last_time_transaction
+
+
+def save_loading_chunk(chunk, account, user, is_skip_duplicates=True, last_transaction_times=None):
+    """
+    Запись порции проверенных операций.
+    Уже существующие операции пропускаются (см. get_existing_loading_rows).
+    :param chunk: список проверенных строк порции (см. resolve_loading_rows);
+    :param account: счет, по которому загружаются операции;
+    :param user: текущий пользователь;
+    :param is_skip_duplicates: пропускать уже загруженные операции;
+    :param last_transaction_times: словарь дат-времени последних операций по дням (общий на всю загрузку)
+    """
+    existing_rows = get_existing_loading_rows(chunk, account) if is_skip_duplicates else []
+    existing_row_ids = {id(r) for r in existing_rows}
+
+    # Времена последних операций в днях порции - одним запросом, чтобы операциям без времени назначить время
+    # в памяти, а не запросом в Transaction.get_last_transaction_in_day на каждую операцию
+    if last_transaction_times is None:
+        last_transaction_times = {}
+    update_loading_last_times(chunk, account, last_transaction_times)
+
+    # Количество операций в сводке бюджета изменяется один раз на порцию, а не на каждую операцию.
+    # Дельта откаченной операции в сводке остается, поэтому при ошибках сводка пересчитывается полностью
+    is_error = False
+    with BudgetSummary.deferred_counts():
+        for r in chunk:
+            if id(r) in existing_row_ids:
+                r['log'][2]['error'] = 'такая операция<br>уже существует'
+                r['log'][0] = 0
+                continue
+
+            # Дата операции задана без времени - устанавливаем время последней операции в этом дне
+            # плюс несколько минут
+            day = r['time_transaction'].date()
+            time_transaction = r['time_transaction']
+            if datetime(day.year, day.month, day.day, 0, 0, 0, 0, timezone.utc) == time_transaction:
+                time_transaction = Transaction.get_time_after_last_transaction(day, last_transaction_times[day])
+
+            # Такой операции нет - создаем ее и категорию к ней
+            try:
+                with transaction.atomic():
+                    new_transaction = Transaction()
+                    new_transaction.budget = account.budget
+                    new_transaction.account = account
+                    new_transaction.type = r['type']
+                    new_transaction.time_transaction = time_transaction
+                    new_transaction.time_zone = r['time_zone']
+                    new_transaction.amount_acc_cur = r['amount_acc_cur']
+                    new_transaction.currency = r['currency']
+                    new_transaction.amount = r['amount']
+                    new_transaction.budget_year = r['budget_year']
+                    new_transaction.budget_month = r['budget_month']
+                    new_transaction.place = r['place']
+                    new_transaction.description = r['description']
+                    new_transaction.mcc_code = r['mcc_code']
+                    new_transaction.banks_category = r['bank_category']
+                    new_transaction.banks_description = r['bank_description']
+                    new_transaction.project = r['project']
+                    new_transaction.import_hash = r['import_hash']
+                    new_transaction.user_create = user
+                    new_transaction.user_update = user
+                    new_transaction.save()
+                    if r['type'] in ['CRE', 'DEB']:
+                        new_transaction_category = TransactionCategory()
+                        new_transaction_category.transaction = new_transaction
+                        new_transaction_category.category = r['category']
+                        new_transaction_category.amount_acc_cur = r['amount_acc_cur']
+                        new_transaction_category.budget_year = r['budget_year']
+                        new_transaction_category.budget_month = r['budget_month']
+                        new_transaction_category.project = r['project']
+                        new_transaction_category.save()
+                    r['log'][0] = 1
+                if not last_transaction_times[day] or \
+                        last_transaction_times[day] < new_transaction.time_transaction:
+                    last_transaction_times[day] = new_transaction.time_transaction
+            except Exception as e:
+                r['log'][2]['error'] = 'операция не смогла<br>быть загружена'
+                r['log'][0] = 0
+                is_error = True
+
+    if is_error:
+        BudgetSummary.recalculate(account.budget_id)
+
+
+def get_loading_log_file_name(account, log_id):
+    """
+    Получение полного имени файла с полным протоколом проверки файла загрузки операций.
+    :param account: счет, по которому загружаются операции;
+    :param log_id: идентификатор протокола (hex);
+    :return: полное имя файла или None при некорректном идентификаторе
+    """
+    if not re.fullmatch(r'[0-9a-f]{32}', log_id or ''):
+        return None
+    log_dir = os.path.join(tempfile.gettempdir(), 'hamsterock_loading_logs')
+    os.makedirs(log_dir, exist_ok=True)
+    return os.path.join(log_dir, f"{account.budget_id}_{account.pk}_{log_id}.csv.gz")
+
+
+def preview_loading_file(rows, first_row_idx, headers, account, references, loading_options, log_file_name):
+    """
+    Предварительная проверка файла загрузки операций без записи в базу данных.
+    Файл проверяется потоково порциями: в памяти остаются только счетчики, первые ошибки и образец строк,
+    полный протокол по каждой строке пишется в сжатый файл (csv.gz) для скачивания.
+    :param rows: итератор строк файла;
+    :param first_row_idx: номер первой строки в файле;
+    :param headers: заголовки полей файла;
+    :param account: счет, по которому загружаются операции;
+    :param references: словарь имен для проверки строк (см. get_loading_references);
+    :param loading_options: параметры загрузки;
+    :param log_file_name: полное имя файла для полного протокола;
+    :return: словарь итогов проверки
+    """
+    preview = {'rows_count': 0,
+               'valid_count': 0,
+               'error_count': 0,
+               'duplicate_count': 0,
+               'field_errors': {},
+               'errors': [],
+               'sample': []}
+    import_hash_occurrences = {}
+
+    # Снесем протоколы предыдущих проверок старше суток
+    log_dir = os.path.dirname(log_file_name)
+    for old_log_file_name in os.listdir(log_dir):
+        try:
+            old_log_file_name = os.path.join(log_dir, old_log_file_name)
+            if os.path.getmtime(old_log_file_name) < datetime.now().timestamp() - 24 * 60 * 60:
+                os.remove(old_log_file_name)
+        except Exception as e:
+            pass
+
+    with gzip.open(log_file_name, 'wt', encoding='utf-8-sig', newline='') as log_file:
+        log_writer = csv.writer(log_file, delimiter=';')
+        log_writer.writerow(['Статус', '№', 'Тип'] + list(headers))
+
+        for validated_chunk in iterate_validated_chunks(rows, first_row_idx, references, loading_options):
+            # Поищем уже загруженные операции (только чтение, ничего не создается)
+            valid_rows = []
+            for log, r in validated_chunk:
+                if r is not None:
+                    set_loading_import_hash(r, account, import_hash_occurrences)
+                    r['log'] = log
+                    valid_rows.append(r)
+            for r in get_existing_loading_rows(valid_rows, account):
+                r['log'][2]['error'] = 'такая операция<br>уже существует'
+                preview['duplicate_count'] += 1
+
+            for log, r in validated_chunk:
+                preview['rows_count'] += 1
+                if r is None:
+                    log[0] = 0
+                    preview['error_count'] += 1
+                    for field, field_log in log[3].items():
+                        if field_log.get('error'):
+                            preview['field_errors'][field] = preview['field_errors'].get(field, 0) + 1
+                    if len(preview['errors']) < TRANSACTION_LOADING_PREVIEW_ERRORS:
+                        preview['errors'].append(log)
+                elif log[2].get('error'):
+                    # Операция уже загружена
+                    log[0] = 0
+                else:
+                    log[0] = 1
+                    preview['valid_count'] += 1
+                if len(preview['sample']) < TRANSACTION_LOADING_PREVIEW_SAMPLE:
+                    preview['sample'].append(log)
+
+                # Строка полного протокола: значение поля и ошибка через " ! "
+                log_row = ['OK' if log[0] else 'ОШИБКА', log[1],
+                           ' ! '.join([str(v) for v in [log[2].get('value'), log[2].get('error')] if v])]
+                for header in headers:
+                    field_log = log[3].get(header, {})
+                    log_row.append(' ! '.join([str(v) for v in [field_log.get('value'), field_log.get('error')]
+                                               if v]))
+                log_writer.writerow([str(v).replace('<br>', ' ') for v in log_row])
+
+    return preview
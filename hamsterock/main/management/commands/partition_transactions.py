@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from main.partitioning import *
+
+
+class Command(BaseCommand):
+    help = 'Секционирование таблиц операций и категорий операций по году бюджета (только PostgreSQL). ' \
+           'Несекционированные таблицы переводятся в секционированные с переносом данных, для секционированных ' \
+           'создаются недостающие секции по годам (с переносом строк из секции по умолчанию). ' \
+           'Команду можно запускать повторно, например, в начале каждого года.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--years-ahead', type=int, default=1,
+                            help='Количество будущих лет, для которых создаются секции (по умолчанию 1)')
+
+    def handle(self, *args, **options):
+        if not is_partitioning_supported(connection):
+            raise CommandError(f'Секционирование поддерживается только в PostgreSQL версии '
+                               f'{MIN_POSTGRESQL_VERSION // 10000} и выше')
+
+        years_ahead = options['years_ahead']
+        with connection.schema_editor() as schema_editor:
+            for table in PARTITIONED_TABLES:
+                with connection.cursor() as cursor:
+                    is_table_partitioned = is_partitioned(cursor, table)
+                if not is_table_partitioned:
+                    dropped_references = partition_table(schema_editor, table, years_ahead)
+                    self.stdout.write(f'Таблица {table} секционирована по году бюджета')
+                    for reference in dropped_references:
+                        self.stdout.write(f'  удален внешний ключ {reference}')
+                else:
+                    created_partitions = create_partitions(schema_editor, table, years_ahead)
+                    self.stdout.write(f'Таблица {table}: создано секций {len(created_partitions)}'
+                                      f'{": " + ", ".join(created_partitions) if created_partitions else ""}')
@@ -0,0 +1,22 @@
+# Generated by Django 4.1.7 on 2026-10-19 18:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_transaction_transactioncategory_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='import_hash',
+            field=models.CharField(blank=True, max_length=64, null=True, verbose_name='Отпечаток операции при загрузке из файла'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['account', 'import_hash'], name='t__account_import_hash_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.7 on 2026-10-19 19:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_transaction_import_hash'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(('sender__isnull', True), ('type__in', ['MO-', 'MO+'])), fields=['budget', 'currency', 'amount', 'time_transaction'], name='t__unlinked_movement_idx'),
+        ),
+    ]
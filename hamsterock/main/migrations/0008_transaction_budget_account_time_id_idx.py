@@ -0,0 +1,21 @@
+# Generated by Django 4.1.7 on 2026-10-19 19:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_transaction_unlinked_movement_idx'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='transaction',
+            name='t__budget_account_time_idx',
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['budget', 'account', '-time_transaction', '-id'], name='t__budget_account_time_id_idx'),
+        ),
+    ]
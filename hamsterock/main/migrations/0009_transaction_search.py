@@ -0,0 +1,65 @@
+# Generated by Django 4.1.7 on 2026-10-19 19:14
+
+from django.db import migrations, models
+
+
+def fill_search(apps, schema_editor):
+    """
+    Заполнение строк поиска у существующих операций: значения полей через перевод строки в нижнем регистре
+    (так же, как Transaction.get_search_text())
+    """
+    Transaction = apps.get_model('main', 'Transaction')
+    changed_transactions = []
+    for t in Transaction.objects.only('id', 'place', 'description', 'mcc_code', 'banks_category',
+                                      'banks_description').iterator(chunk_size=2000):
+        t.description_search = '\n'.join(str(value).strip() for value in (t.place, t.description) if value).lower()
+        t.banks_description_search = \
+            '\n'.join(str(value).strip() for value in (t.mcc_code, t.banks_category, t.banks_description)
+                      if value).lower()
+        changed_transactions.append(t)
+        if len(changed_transactions) >= 2000:
+            Transaction.objects.bulk_update(changed_transactions, ['description_search', 'banks_description_search'])
+            changed_transactions = []
+    Transaction.objects.bulk_update(changed_transactions, ['description_search', 'banks_description_search'])
+
+
+def create_trigram_indexes(apps, schema_editor):
+    """
+    Триграммные индексы для поиска подстроки (LIKE '%...%') - только в PostgreSQL
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute('CREATE INDEX IF NOT EXISTS t__description_search_trgm_idx '
+                          'ON main_transaction USING gin (description_search gin_trgm_ops)')
+    schema_editor.execute('CREATE INDEX IF NOT EXISTS t__banks_desc_search_trgm_idx '
+                          'ON main_transaction USING gin (banks_description_search gin_trgm_ops)')
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS t__description_search_trgm_idx')
+    schema_editor.execute('DROP INDEX IF EXISTS t__banks_desc_search_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_transaction_budget_account_time_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='banks_description_search',
+            field=models.TextField(blank=True, editable=False, null=True, verbose_name='Строка поиска по информации от банка'),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='description_search',
+            field=models.TextField(blank=True, editable=False, null=True, verbose_name='Строка поиска по локации и описанию операции'),
+        ),
+        migrations.RunPython(fill_search, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
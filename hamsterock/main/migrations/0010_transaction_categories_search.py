@@ -0,0 +1,57 @@
+# Generated by Django 4.1.7 on 2026-10-19 19:16
+
+from django.db import migrations, models
+
+
+def fill_categories_search(apps, schema_editor):
+    """
+    Заполнение строк поиска по категориям у существующих операций (так же, как Transaction.set_categories_search())
+    """
+    Transaction = apps.get_model('main', 'Transaction')
+    TransactionCategory = apps.get_model('main', 'TransactionCategory')
+    categories_names = {}
+    for transaction_id, category_name in \
+            TransactionCategory.objects.order_by('transaction_id', 'pk')\
+            .values_list('transaction_id', 'category__name').iterator(chunk_size=2000):
+        categories_names.setdefault(transaction_id, []).append(str(category_name).strip().lower())
+    changed_transactions = []
+    for transaction_id, names in categories_names.items():
+        changed_transactions.append(Transaction(pk=transaction_id, categories_search='\n'.join(names)))
+        if len(changed_transactions) >= 2000:
+            Transaction.objects.bulk_update(changed_transactions, ['categories_search'])
+            changed_transactions = []
+    Transaction.objects.bulk_update(changed_transactions, ['categories_search'])
+
+
+def create_trigram_index(apps, schema_editor):
+    """
+    Триграммный индекс для поиска подстроки (LIKE '%...%') - только в PostgreSQL
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute('CREATE INDEX IF NOT EXISTS t__categories_search_trgm_idx '
+                          'ON main_transaction USING gin (categories_search gin_trgm_ops)')
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS t__categories_search_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_transaction_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='categories_search',
+            field=models.TextField(blank=True, editable=False, null=True, verbose_name='Строка поиска по категориям операции'),
+        ),
+        migrations.RunPython(fill_categories_search, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
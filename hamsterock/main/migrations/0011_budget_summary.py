@@ -0,0 +1,53 @@
+# Generated by Django 4.1.7 on 2026-10-19 19:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_budget_summary(apps, schema_editor):
+    """
+    Расчет сводок существующих бюджетов (так же, как BudgetSummary.recalculate())
+    """
+    Budget = apps.get_model('main', 'Budget')
+    BudgetSummary = apps.get_model('main', 'BudgetSummary')
+    BudgetRegister = apps.get_model('main', 'BudgetRegister')
+    Transaction = apps.get_model('main', 'Transaction')
+    Account = apps.get_model('main', 'Account')
+    for budget_id in Budget.objects.values_list('id', flat=True):
+        registers = BudgetRegister.objects.filter(budget_id=budget_id).aggregate(
+            min_budget_period=models.Min(models.F('budget_year') * 100 + models.F('budget_month')),
+            max_budget_period=models.Max(models.F('budget_year') * 100 + models.F('budget_month')),
+            registers_count=models.Count('id'))
+        BudgetSummary.objects.create(budget_id=budget_id,
+                                     min_budget_period=registers['min_budget_period'],
+                                     max_budget_period=registers['max_budget_period'],
+                                     registers_count=registers['registers_count'],
+                                     transactions_count=Transaction.objects.filter(budget_id=budget_id).count(),
+                                     accounts_count=Account.objects.filter(budget_id=budget_id).count())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_transaction_categories_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BudgetSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('min_budget_period', models.IntegerField(blank=True, null=True, verbose_name='Первый период бюджетных регистров (ГГГГММ)')),
+                ('max_budget_period', models.IntegerField(blank=True, null=True, verbose_name='Последний период бюджетных регистров (ГГГГММ)')),
+                ('transactions_count', models.IntegerField(default=0, verbose_name='Количество операций')),
+                ('accounts_count', models.IntegerField(default=0, verbose_name='Количество счетов/кошельков')),
+                ('registers_count', models.IntegerField(default=0, verbose_name='Количество бюджетных регистров')),
+                ('budget', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='summary', to='main.budget', verbose_name='Бюджет')),
+            ],
+            options={
+                'verbose_name': 'Сводка бюджета',
+                'verbose_name_plural': 'Сводки бюджетов',
+            },
+        ),
+        migrations.RunPython(fill_budget_summary, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.7 on 2026-10-19 19:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_budget_summary'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='category',
+            index=models.Index(fields=['budget', 'budget_object'], name='category__budget_object_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.1.7 on 2026-10-19 19:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_category_budget_object_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='balances_error',
+            field=models.CharField(blank=True, max_length=255, null=True, verbose_name='Ошибка пересчета остатков'),
+        ),
+        migrations.AddField(
+            model_name='account',
+            name='balances_error_transaction',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='main.transaction', verbose_name='Операция, на которой остановился пересчет остатков'),
+        ),
+    ]
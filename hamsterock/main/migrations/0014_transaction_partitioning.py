@@ -0,0 +1,32 @@
+# Generated by Django 4.1.7 on 2026-10-19 20:05
+
+from django.conf import settings
+from django.db import migrations
+
+from main.partitioning import *
+
+
+def partition_transactions(apps, schema_editor):
+    """
+    Секционирование таблиц операций и категорий операций по году бюджета - только в PostgreSQL и только при
+    TRANSACTION_PARTITIONING = True. Иначе секционирование можно выполнить позже командой partition_transactions.
+    """
+    if not getattr(settings, 'TRANSACTION_PARTITIONING', False) or \
+            not is_partitioning_supported(schema_editor.connection):
+        return
+    for table in PARTITIONED_TABLES:
+        with schema_editor.connection.cursor() as cursor:
+            if is_partitioned(cursor, table):
+                continue
+        partition_table(schema_editor, table)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_account_balances_error'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_transactions, migrations.RunPython.noop),
+    ]
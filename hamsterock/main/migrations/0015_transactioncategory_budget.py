@@ -0,0 +1,35 @@
+# Generated by Django 4.1.7 on 2026-10-19 19:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_budget(apps, schema_editor):
+    """
+    Заполнение бюджета у существующих категорий операций из операций (одним UPDATE)
+    """
+    Transaction = apps.get_model('main', 'Transaction')
+    TransactionCategory = apps.get_model('main', 'TransactionCategory')
+    TransactionCategory.objects.update(budget_id=models.Subquery(Transaction.objects
+                                                                 .filter(pk=models.OuterRef('transaction_id'))
+                                                                 .values('budget_id')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_transaction_partitioning'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transactioncategory',
+            name='budget',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, to='main.budget', verbose_name='Бюджет'),
+        ),
+        migrations.RunPython(fill_budget, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='transactioncategory',
+            index=models.Index(fields=['category', 'budget', 'budget_year', 'budget_month', 'transaction'], name='tc__category_period_idx'),
+        ),
+    ]
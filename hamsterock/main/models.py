@@ -1,9 +1,14 @@
+import hashlib
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta, date, timezone
 from decimal import Decimal
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.db import models, transaction
-from django.db.models import Index
+from django.db.models import Index, Max, Min, F, Q, Exists, OuterRef, Subquery, Value
+from django.db.models.functions import Concat, Substr
 from django.urls import reverse
 from django.utils.formats import date_format, number_format
 from django.utils.safestring import mark_safe
@@ -54,6 +59,42 @@ def balance_round(balance, digit_rounding):
     return ftod(res, 2)
 
 
+# Ссылки, при наличии которых объект удалять нельзя: модель - ((модель со ссылкой, путь до объекта), ...).
+# По всем путям есть индексы (индексы внешних ключей), поэтому проверка не зависит от объема истории.
+DELETE_PROTECTING_REFERENCES = {
+    'Currency': (('Budget', 'base_currency_1'), ('Budget', 'base_currency_2'), ('CurrencyRate', 'currency_1'),
+                 ('CurrencyRate', 'currency_2'), ('Account', 'currency'), ('Transaction', 'currency')),
+    'Account': (('Transaction', 'account'),),
+    'Project': (('Transaction', 'project'), ('TransactionCategory', 'project')),
+    'BudgetObject': (('TransactionCategory', 'category__budget_object'),),
+    'Category': (('Category', 'parent'), ('TransactionCategory', 'category')),
+}
+
+
+def get_references(instance):
+    """
+    Функция проверки ссылок на объект перед удалением (см. DELETE_PROTECTING_REFERENCES).
+    Проверка делается одним запросом - по подзапросу EXISTS на каждую модель со ссылкой, без подсчета и перебора
+    ссылающихся записей.
+    :param instance: объект модели;
+    :return: список названий (во множественном числе) моделей, объекты которых ссылаются на объект.
+    """
+    references = DELETE_PROTECTING_REFERENCES.get(instance.__class__.__name__, ())
+    if not references or instance.pk is None:
+        return []
+    apps = instance._meta.apps
+    exists = {'reference_' + str(i): models.Exists(apps.get_model(instance._meta.app_label, model_name).objects
+                                                   .filter(**{path: models.OuterRef('pk')}))
+              for i, (model_name, path) in enumerate(references)}
+    flags = instance.__class__.objects.filter(pk=instance.pk).annotate(**exists).values(*exists).first() or {}
+    model_names = []
+    for i, (model_name, path) in enumerate(references):
+        model_name = str(apps.get_model(instance._meta.app_label, model_name)._meta.verbose_name_plural)
+        if flags.get('reference_' + str(i)) and model_name not in model_names:
+            model_names.append(model_name)
+    return model_names
+
+
 DEFAULT_BUDGET_NAME = 'Бюджет семьи <ваша фамилия>'
 
 TIME_ZONES = [
@@ -217,6 +258,31 @@ TRANSACTION_REQUIRED_FIELDS = [
     ('category', 'Категория операции'),
 ]
 
+TRANSACTION_LOADING_CHUNK_SIZE = 500
+TRANSACTION_LOADING_PREVIEW_ERRORS = 50
+TRANSACTION_LOADING_PREVIEW_SAMPLE = 20
+
+# Процедура пересчета остатков пишет операции порциями: одна транзакция базы данных на порцию не больше
+# BALANCES_RECALCULATION_CHUNK_SIZE операций и не дольше BALANCES_RECALCULATION_CHUNK_MILLISECONDS миллисекунд
+BALANCES_RECALCULATION_CHUNK_SIZE = 500
+BALANCES_RECALCULATION_CHUNK_MILLISECONDS = 2000
+
+
+class OriginalValuesMixin:
+    """
+    Исходные значения отложенных полей для моделей с original_ атрибутами.
+    Исходные значения запоминаются по сигналу post_init (см. signals.py), но поля, отложенные при загрузке
+    (.only()/.defer()), в этот момент еще не известны. Когда такое поле догружается из базы, его исходным значением
+    становится загруженное значение - иначе триггер save() увидит ложное изменение.
+    """
+
+    def refresh_from_db(self, using=None, fields=None):
+        deferred_fields = self.get_deferred_fields()
+        super().refresh_from_db(using=using, fields=fields)
+        for attname in deferred_fields - self.get_deferred_fields():
+            if hasattr(type(self), 'original_' + attname):
+                setattr(self, 'original_' + attname, self.__dict__[attname])
+
 
 class Profile(models.Model):
     """
@@ -314,6 +380,229 @@ class Budget(models.Model):
         verbose_name_plural = 'Бюджеты'
         ordering = ['name']
 
+    # Время жизни закэшированного контекста бюджета для меню (в секундах)
+    context_cache_timeout = 60 * 60
+
+    def save(self, *args, **kwargs):
+        """
+        Триггер на добавление/изменение
+        Сбрасывается закэшированный контекст бюджета для меню (базовые валюты).
+        """
+        super(Budget, self).save(*args, **kwargs)
+        Budget.reset_cached_context(self.pk)
+
+    @classmethod
+    def get_context_cache_key(cls, budget_id):
+        return 'budget_context_' + str(budget_id)
+
+    @classmethod
+    def get_cached_context(cls, budget):
+        """
+        Получение контекста бюджета для меню: список счетов/кошельков, диапазон лет бюджетных регистров (из сводки
+        бюджета) и базовые валюты. Контекст хранится в кэше и сбрасывается при изменении бюджета, счетов/кошельков
+        и при изменении диапазона периодов бюджетных регистров (см. reset_cached_context).
+        :param budget: объект бюджета;
+        :return: словарь с контекстом бюджета.
+        """
+        cache_key = cls.get_context_cache_key(budget.pk)
+        budget_context = cache.get(cache_key)
+        if budget_context is None:
+            budget_summary = BudgetSummary.get_summary(budget.pk)
+            currencies = Currency.objects.in_bulk([budget.base_currency_1_id, budget.base_currency_2_id])
+            budget_context = {
+                'accounts': list(Account.objects.filter(budget_id=budget.pk).select_related('currency')
+                                 .order_by('name')),
+                'first_budget_year': budget_summary.max_budget_year,
+                'last_budget_year': budget_summary.min_budget_year,
+                'base_currencies': [currencies[budget.base_currency_1_id], currencies[budget.base_currency_2_id]],
+            }
+            cache.set(cache_key, budget_context, cls.context_cache_timeout)
+        return budget_context
+
+    @classmethod
+    def reset_cached_context(cls, budget_id):
+        """
+        Сброс закэшированного контекста бюджета для меню
+        :param budget_id: id бюджета.
+        """
+        cache.delete(cls.get_context_cache_key(budget_id))
+
+
+class BudgetSummary(models.Model):
+    """
+    Сводка бюджета
+    Полностью расчетная модель: диапазон периодов бюджетных регистров и количество операций, счетов/кошельков
+    и регистров бюджета. Нужна для навигации и сводных страниц, чтобы не сканировать большие таблицы.
+    Изменяется инкрементально триггерами операций, счетов/кошельков и бюджетных регистров (удаления - по сигналам
+    post_delete, чтобы учитывались и удаления наборов записей). Если записи сводки по бюджету нет, то она полностью
+    рассчитывается при первом обращении (см. get_summary).
+    Период хранится числом в формате ГГГГММ.
+    """
+    budget = models.OneToOneField('Budget', on_delete=models.CASCADE, related_name='summary', verbose_name='Бюджет')
+    min_budget_period = models.IntegerField(null=True, blank=True,
+                                            verbose_name='Первый период бюджетных регистров (ГГГГММ)')
+    max_budget_period = models.IntegerField(null=True, blank=True,
+                                            verbose_name='Последний период бюджетных регистров (ГГГГММ)')
+    transactions_count = models.IntegerField(default=0, null=False, blank=False, verbose_name='Количество операций')
+    accounts_count = models.IntegerField(default=0, null=False, blank=False,
+                                         verbose_name='Количество счетов/кошельков')
+    registers_count = models.IntegerField(default=0, null=False, blank=False,
+                                          verbose_name='Количество бюджетных регистров')
+
+    class Meta:
+        verbose_name = 'Сводка бюджета'
+        verbose_name_plural = 'Сводки бюджетов'
+
+    def __str__(self):
+        return 'Сводка бюджета: ' + str(self.budget)
+
+    @property
+    def min_budget_year(self):
+        return self.min_budget_period // 100 if self.min_budget_period else None
+
+    @property
+    def max_budget_year(self):
+        return self.max_budget_period // 100 if self.max_budget_period else None
+
+    @classmethod
+    def get_period(cls, budget_year, budget_month):
+        return budget_year * 100 + budget_month
+
+    @classmethod
+    def get_summary(cls, budget_id):
+        """
+        Получение сводки бюджета (при отсутствии - с полным расчетом)
+        :param budget_id: id бюджета;
+        :return: объект сводки бюджета.
+        """
+        try:
+            return BudgetSummary.objects.get(budget_id=budget_id)
+        except BudgetSummary.DoesNotExist:
+            return cls.recalculate(budget_id)
+
+    # Накапливаемые внутри блока deferred_counts дельты количеств: id бюджета -> [операции, счета, регистры]
+    # (своя копия у каждого потока)
+    deferred_counts_state = threading.local()
+
+    @classmethod
+    @contextmanager
+    def deferred_counts(cls):
+        """
+        Блок массовых изменений (порция загрузки операций, удаление набора записей): дельты количеств внутри блока
+        не пишутся в сводку на каждую запись, а накапливаются и при выходе из блока записываются одним запросом
+        на бюджет - так нет лишнего UPDATE на запись и строка сводки не блокируется на все время блока.
+        Вложенный блок работает в рамках внешнего.
+        Блок обычно выполняется внутри транзакции базы данных, поэтому при выходе из блока по исключению
+        накопленные дельты отбрасываются (изменения откатываются вместе с транзакцией).
+        ВАЖНО!!! Дельты записей, изменения которых были откачены внутри блока (например, вложенной транзакцией
+        с перехваченным исключением), не отменяются - после такого отката сводку нужно пересчитать (см. recalculate).
+        """
+        state = cls.deferred_counts_state
+        if getattr(state, 'deltas', None) is not None:
+            yield
+            return
+        state.deltas = {}
+        try:
+            yield
+            deltas = state.deltas
+        finally:
+            state.deltas = None
+        for budget_id, (transactions, accounts, registers) in deltas.items():
+            if transactions or accounts or registers:
+                cls.change_counts(budget_id, transactions=transactions, accounts=accounts, registers=registers)
+
+    @classmethod
+    def recalculate(cls, budget_id):
+        """
+        Полный расчет сводки бюджета по операциям, счетам/кошелькам и бюджетным регистрам.
+        Накопленные блоком deferred_counts дельты по бюджету отбрасываются - они уже учтены в расчете.
+        :param budget_id: id бюджета;
+        :return: объект сводки бюджета.
+        """
+        deltas = getattr(cls.deferred_counts_state, 'deltas', None)
+        if deltas is not None:
+            deltas.pop(budget_id, None)
+        registers = BudgetRegister.objects.filter(budget_id=budget_id).aggregate(
+            min_budget_period=Min(F('budget_year') * 100 + F('budget_month')),
+            max_budget_period=Max(F('budget_year') * 100 + F('budget_month')),
+            registers_count=models.Count('id'))
+        budget_summary, created = BudgetSummary.objects.update_or_create(
+            budget_id=budget_id,
+            defaults={'min_budget_period': registers['min_budget_period'],
+                      'max_budget_period': registers['max_budget_period'],
+                      'registers_count': registers['registers_count'],
+                      'transactions_count': Transaction.objects.filter(budget_id=budget_id).count(),
+                      'accounts_count': Account.objects.filter(budget_id=budget_id).count()})
+        Budget.reset_cached_context(budget_id)
+        return budget_summary
+
+    @classmethod
+    def change_counts(cls, budget_id, transactions=0, accounts=0, registers=0):
+        """
+        Изменение количеств в сводке бюджета на дельту (одним запросом, без чтения сводки).
+        Внутри блока deferred_counts дельта только накапливается. Если сводки еще нет, то ничего не делается - она
+        будет полностью рассчитана при первом обращении (см. get_summary). Заново сводка здесь не создается: при
+        удалении бюджета сводка может удаляться раньше его операций, счетов и регистров.
+        :param budget_id: id бюджета;
+        :param transactions: дельта количества операций;
+        :param accounts: дельта количества счетов/кошельков;
+        :param registers: дельта количества бюджетных регистров.
+        """
+        deltas = getattr(cls.deferred_counts_state, 'deltas', None)
+        if deltas is not None:
+            budget_deltas = deltas.setdefault(budget_id, [0, 0, 0])
+            budget_deltas[0] += transactions
+            budget_deltas[1] += accounts
+            budget_deltas[2] += registers
+            return
+        BudgetSummary.objects.filter(budget_id=budget_id).update(
+            transactions_count=F('transactions_count') + transactions,
+            accounts_count=F('accounts_count') + accounts,
+            registers_count=F('registers_count') + registers)
+
+    @classmethod
+    def extend_periods(cls, budget_id, min_budget_period, max_budget_period):
+        """
+        Расширение диапазона периодов бюджетных регистров в сводке бюджета (при добавлении регистров).
+        Если диапазон изменился, то сбрасывается закэшированный контекст бюджета для меню.
+        :param budget_id: id бюджета;
+        :param min_budget_period: минимальный период добавленных регистров (ГГГГММ);
+        :param max_budget_period: максимальный период добавленных регистров (ГГГГММ).
+        """
+        is_min_change = BudgetSummary.objects.filter(
+            Q(min_budget_period__isnull=True) | Q(min_budget_period__gt=min_budget_period),
+            budget_id=budget_id).update(min_budget_period=min_budget_period)
+        is_max_change = BudgetSummary.objects.filter(
+            Q(max_budget_period__isnull=True) | Q(max_budget_period__lt=max_budget_period),
+            budget_id=budget_id).update(max_budget_period=max_budget_period)
+        if is_min_change or is_max_change:
+            Budget.reset_cached_context(budget_id)
+
+    @classmethod
+    def add_registers(cls, budget_id, budget_periods):
+        """
+        Учет в сводке бюджета добавленных бюджетных регистров
+        :param budget_id: id бюджета;
+        :param budget_periods: периоды добавленных регистров (ГГГГММ), по одному на регистр.
+        """
+        if not budget_periods:
+            return
+        cls.change_counts(budget_id, registers=len(budget_periods))
+        cls.extend_periods(budget_id, min(budget_periods), max(budget_periods))
+
+    @classmethod
+    def remove_register(cls, budget_id, budget_period):
+        """
+        Учет в сводке бюджета удаленного бюджетного регистра.
+        Если удален регистр на границе диапазона периодов, то диапазон пересчитывается полностью.
+        :param budget_id: id бюджета;
+        :param budget_period: период удаленного регистра (ГГГГММ).
+        """
+        cls.change_counts(budget_id, registers=-1)
+        if BudgetSummary.objects.filter(Q(min_budget_period=budget_period) | Q(max_budget_period=budget_period),
+                                        budget_id=budget_id).exists():
+            cls.recalculate(budget_id)
+
 
 class CurrencyRate(models.Model):
     """
@@ -415,6 +704,27 @@ class CurrencyRate(models.Model):
 
         return True
 
+    @classmethod
+    def get_search_date(cls, date_rate=None):
+        """
+        Получение даты курса, по которому считаются суммы на дату: для текущего месяца - курс на конец предыдущего
+        дня, для предыдущих месяцев - курс на конец месяца (будущие даты приравниваются к текущей)
+        :param date_rate: дата (дата-время) для расчета
+        :return: дата курса
+        """
+        today = datetime.utcnow()
+        if not date_rate:
+            date_rate = datetime.utcnow().date()
+        elif type(date_rate) == datetime:
+            date_rate = date_rate.date()
+        if date_rate > today.date():
+            date_rate = datetime.utcnow().date()
+
+        if date_rate.year == today.year and date_rate.month == today.month:
+            return date_rate - timedelta(days=1)
+        else:
+            return last_day_of_month(date(date_rate.year, date_rate.month, 1))
+
     @classmethod
     def get_rate(cls, currency_1_id, currency_2_id, date_rate=None):
         """
@@ -528,19 +838,8 @@ class CurrencyRate(models.Model):
         if currency_1_id == currency_2_id:
             return ftod(1.00, 9)
 
-        today = datetime.utcnow()
-        if not date_rate:
-            date_rate = datetime.utcnow().date()
-        elif type(date_rate) == datetime:
-            date_rate = date_rate.date()
-        if date_rate > today.date():
-            date_rate = datetime.utcnow().date()
-
         # Определяем дату для поиска курса
-        if date_rate.year == today.year and date_rate.month == today.month:
-            search_date = date_rate - timedelta(days=1)
-        else:
-            search_date = last_day_of_month(date(date_rate.year, date_rate.month, 1))
+        search_date = cls.get_search_date(date_rate)
 
         # Сначала попытаемся найти курс напрямую у заданной пары, либо валюта1 к валюте2, либо валюта2 к валюте1
         currency_rate = get_native_rate(currency_1_id, currency_2_id, search_date)
@@ -587,7 +886,7 @@ class CurrencyRate(models.Model):
             return ftod(1.00, 9)
 
 
-class Account(models.Model):
+class Account(OriginalValuesMixin, models.Model):
     """
     Счета/кошельки
     Расходы, доходы, остатки отчетных периодов бюджета берутся из операций, которые проводятся по счетам и кошелькам.
@@ -626,6 +925,11 @@ class Account(models.Model):
     is_turnovers_valid = models.BooleanField(default=True, verbose_name='Бюджетные обороты действительны?')
     turnovers_valid_until = models.DateTimeField(default=MIN_TRANSACTION_DATETIME, null=False, blank=False,
                                                  verbose_name='Бюджетные обороты действительны до')
+    balances_error = models.CharField(max_length=255, null=True, blank=True,
+                                      verbose_name='Ошибка пересчета остатков')
+    balances_error_transaction = models.ForeignKey('Transaction', on_delete=models.SET_NULL, null=True, blank=True,
+                                                   related_name='+',
+                                                   verbose_name='Операция, на которой остановился пересчет остатков')
 
     # Для отслеживания изменений отдельных атрибутов заводим для них original_ атрибут,
     # который заполняем начальным значением по сигналу ".post_init" (см. файл signals.py)
@@ -682,7 +986,7 @@ class Account(models.Model):
             self.balance_base_cur_1 = \
                 ftod(self.balance_base_cur_1, 2) + \
                 ftod(self.initial_balance * rate_base_cur_1, 2) - \
-                ftod(self.original_initial_balance * rate_base_cur_1, 2)
+                ftod(ftod(self.original_initial_balance, 2) * rate_base_cur_1, 2)
 
             rate_base_cur_2 = CurrencyRate.get_rate(self.budget.base_currency_2_id,
                                                     self.currency_id,
@@ -690,7 +994,7 @@ class Account(models.Model):
             self.balance_base_cur_2 = \
                 ftod(self.balance_base_cur_2, 2) + \
                 ftod(self.initial_balance * rate_base_cur_2, 2) - \
-                ftod(self.original_initial_balance * rate_base_cur_2, 2)
+                ftod(ftod(self.original_initial_balance, 2) * rate_base_cur_2, 2)
 
             self.is_balances_valid = False
             self.balances_valid_until = MIN_TRANSACTION_DATETIME
@@ -710,8 +1014,40 @@ class Account(models.Model):
             elif self.type in BUSN_ACCOUNT:
                 self.group = '6.BUSN'
 
+        is_new = self._state.adding
         super(Account, self).save(*args, **kwargs)
 
+        # Счета/кошельки (с флагом валидности остатков) выводятся в меню бюджета - сбросим его кэш
+        Budget.reset_cached_context(self.budget_id)
+        if is_new:
+            BudgetSummary.change_counts(self.budget_id, accounts=1)
+
+    def delete(self, *args, **kwargs):
+        """
+        Триггер на удаление объекта класса
+        """
+        result = super(Account, self).delete(*args, **kwargs)
+        Budget.reset_cached_context(self.budget_id)
+        return result
+
+    @classmethod
+    def invalidate_balances(cls, invalid_times):
+        """
+        Сброс валидности остатков счетов (массовыми запросами, без триггеров): флаг валидности снимается,
+        дата валидности остатков переносится на время, с которого остатки невалидны, если она позже.
+        Остатки таких счетов пересчитает процедура пересчета остатков.
+        :param invalid_times: словарь id счета -> время, с которого остатки счета невалидны.
+        """
+        if not invalid_times:
+            return
+        for account_id, time_transaction in invalid_times.items():
+            Account.objects.filter(pk=account_id).update(is_balances_valid=False)
+            Account.objects.filter(pk=account_id,
+                                   balances_valid_until__gt=time_transaction
+                                   ).update(balances_valid_until=time_transaction)
+        for budget_id in set(Account.objects.filter(pk__in=list(invalid_times)).values_list('budget_id', flat=True)):
+            Budget.reset_cached_context(budget_id)
+
     def get_balance_on_date(self, on_date=None):
         """
         Получение остатка по счету/кошельку на дату.
@@ -868,7 +1204,7 @@ class Project(models.Model):
         return self.name
 
 
-class BudgetObject(models.Model):
+class BudgetObject(OriginalValuesMixin, models.Model):
     """
     Бюджетные объекты
     Бюджетный объект - это возможность разделить базовую категорию дохода или расхода на несколько по объектам
@@ -902,21 +1238,28 @@ class BudgetObject(models.Model):
         """
         Триггер на добавление/изменение
         Если изменилось название бюджетного объекта, то нужно заменить названия категорий, связанных с ним.
+        Новое название категории - название базовой категории (того же типа, со статьей из первых шести символов
+        статьи категории) и название объекта в скобках. Замена делается одним запросом UPDATE с подзапросом
+        базовой категории (только общие категории без бюджета, при неоднозначности - с наименьшим id). Дерево
+        категорий упорядочено по статье (order_insertion_by), а статьи не меняются, поэтому перестраивать его
+        не нужно.
         """
-        if self.original_name != self.name:
-            categories_with_object = Category.objects.filter(budget_id=self.budget_id, budget_object_id=self.id)
-            for category_with_object in categories_with_object:
-                try:
-                    category_with_object.name = \
-                        Category.objects.get(type=category_with_object.type,
-                                             item=category_with_object.item[:6]).name + ' (' + self.name + ')'
-                    category_with_object.save()
-                except Exception as e:
-                    pass
+        if self.pk and self.original_name != self.name:
+            common_categories = Category.objects.filter(budget__isnull=True, type=OuterRef('type'),
+                                                        item=Substr(OuterRef('item'), 1, 6)).order_by('pk')
+            if Category.objects.filter(Exists(common_categories),
+                                       budget_id=self.budget_id, budget_object_id=self.pk).update(
+                    name=Concat(Subquery(common_categories.values('name')[:1]), Value(' (' + self.name + ')'),
+                                output_field=models.CharField())):
+                # Обновим строки поиска по категориям у операций с этими категориями (см. Category.save)
+                Transaction.set_categories_search(
+                    TransactionCategory.objects.filter(category__budget_id=self.budget_id,
+                                                       category__budget_object_id=self.pk)
+                    .values_list('transaction_id', flat=True))
         super(BudgetObject, self).save(*args, **kwargs)
 
 
-class Category(MPTTModel):
+class Category(OriginalValuesMixin, MPTTModel):
     """
     Категории доходов и расходов
     Иерархическая структура с двумя уровнями. Статьи бюджета строятся по категориям их этого справочника.
@@ -946,6 +1289,8 @@ class Category(MPTTModel):
     time_create = models.DateTimeField(auto_now_add=True, verbose_name='Время создания')
     time_update = models.DateTimeField(auto_now=True, verbose_name='Время изменения')
 
+    original_name = None
+
     def __str__(self):
         return self.name
         # return self.item + ' ' + self.name
@@ -958,6 +1303,7 @@ class Category(MPTTModel):
         verbose_name_plural = 'Категории доходов/расходов'
         indexes = (Index(fields=['type', 'item', 'budget'], name='category__type_item_budget_idx'),
                    Index(fields=['budget', 'name'], name='category__budget_name_idx'),
+                   Index(fields=['budget', 'budget_object'], name='category__budget_object_idx'),
                    )
         constraints = [
             models.UniqueConstraint(fields=['budget', 'name'], name='category__budget_name_unique'),
@@ -969,11 +1315,75 @@ class Category(MPTTModel):
         verbose_name_plural = 'Категории доходов/расходов'
         order_insertion_by = ['item']
 
+    def save(self, *args, **kwargs):
+        """
+        Триггер на добавление/изменение
+        Если изменилось название категории, то нужно обновить строки поиска по категориям у ее операций.
+        Для категории бюджета сбрасывается закэшированная карта категорий с бюджетными объектами.
+        """
+        result = super(Category, self).save(*args, **kwargs)
+        if self.budget_id is not None:
+            Category.reset_objects_map(self.budget_id)
+        if self.original_name is not None and self.original_name != self.name:
+            Transaction.set_categories_search(
+                TransactionCategory.objects.filter(category_id=self.pk).values_list('transaction_id', flat=True))
+        self.original_name = self.name
+        return result
+
+    # Время жизни закэшированной карты категорий с бюджетными объектами (в секундах)
+    objects_map_cache_timeout = 60 * 60
+
+    @classmethod
+    def get_objects_map_cache_key(cls, budget_id):
+        return 'category_objects_map_' + str(budget_id)
+
+    @classmethod
+    def get_objects_map(cls, budget_id):
+        """
+        Получение карты категорий с бюджетными объектами бюджета:
+        - 'categories': (id базовой категории, id бюджетного объекта) -> id категории с бюджетным объектом;
+        - 'suffixes': id базовой категории -> последний буквенный индекс в статьях ее категорий с бюджетными объектами.
+        Карта строится одним запросом по индексу (бюджет, бюджетный объект), базовая категория определяется по типу
+        и статье (как в get_common_category_id). Карта хранится в кэше и сбрасывается при изменении и удалении
+        категорий бюджета (см. reset_objects_map).
+        :param budget_id: id бюджета;
+        :return: словарь с картой категорий.
+        """
+        cache_key = cls.get_objects_map_cache_key(budget_id)
+        objects_map = cache.get(cache_key)
+        if objects_map is None:
+            objects_map = {'categories': {}, 'suffixes': {}}
+            common_categories = Category.objects.filter(budget__isnull=True, type=OuterRef('type'),
+                                                        item=Substr(OuterRef('item'), 1, 6)).order_by('pk')
+            categories = Category.objects.filter(budget_id=budget_id, budget_object__isnull=False)\
+                .annotate(common_category_id=Subquery(common_categories.values('pk')[:1]))\
+                .values_list('pk', 'item', 'budget_object_id', 'common_category_id')
+            for category_id, item, object_id, common_category_id in categories:
+                if common_category_id is None:
+                    continue
+                objects_map['categories'][(common_category_id, object_id)] = category_id
+                suffix = item[item.rfind('.') + 1:]
+                if suffix > objects_map['suffixes'].get(common_category_id, ''):
+                    objects_map['suffixes'][common_category_id] = suffix
+            cache.set(cache_key, objects_map, cls.objects_map_cache_timeout)
+        return objects_map
+
+    @classmethod
+    def reset_objects_map(cls, budget_id):
+        """
+        Сброс закэшированной карты категорий с бюджетными объектами бюджета
+        :param budget_id: id бюджета.
+        """
+        cache.delete(cls.get_objects_map_cache_key(budget_id))
+
     @classmethod
     def get_category_with_object(cls, budget, category_id, object_id, user):
         """
         Получение категории с бюджетным объектом, по базовой категории и бюджетному объекту.
         Возвращает найденную существующую категорию, либо вновь созданную.
+        Существующая категория ищется по закэшированной карте категорий бюджета (см. get_objects_map), там же
+        берется буквенный индекс статьи для новой категории - так при загрузке выписки построчный вызов не ходит
+        в базу, пока не понадобится создать категорию.
         :param budget: объект текущего бюджета;
         :param category_id: id базовой категории;
         :param object_id: id бюджетного объекта;
@@ -984,7 +1394,17 @@ class Category(MPTTModel):
         if not object_id or not budget:
             return category_id
 
-        # Получаем по объекты базовой категории и бюджетного объекта
+        # 1. Попытаемся найти существующую категорию с бюджетным объектом по карте категорий бюджета
+        try:
+            category_key = (int(category_id), int(object_id))
+        except Exception as e:
+            return category_id
+        objects_map = Category.get_objects_map(budget.pk)
+        if category_key in objects_map['categories']:
+            # Нашли нужную категорию!!!
+            return objects_map['categories'][category_key]
+
+        # 2. Получаем по объекты базовой категории и бюджетного объекта
         try:
             category = Category.objects.get(pk=category_id)
             category_name = category.name
@@ -995,39 +1415,38 @@ class Category(MPTTModel):
             return category_id
 
         # Если категория первого уровня, то ее и возвращаем (нельзя иметь категорию с бюджетным объектом 1 уровня)
-        if not category.parent:
+        if not category.parent_id:
             return category_id
 
-        # Попытаемся найти существующую категорию с бюджетным объектом
-        try:
-            category_with_object = Category.objects.get(budget_id=budget.pk,
-                                                        name=category_name + ' (' + object_name + ')')
-            # Нашли нужную категорию!!!
+        # Категории нет в карте (например, у нее не задан бюджетный объект или ее статья не соответствует базовой
+        # категории), но в бюджете уже может быть категория с таким наименованием - ее и возвращаем
+        category_with_object = Category.objects.filter(budget_id=budget.pk,
+                                                       name=category_name + ' (' + object_name + ')').first()
+        if category_with_object:
+            objects_map['categories'][category_key] = category_with_object.pk
+            cache.set(Category.get_objects_map_cache_key(budget.pk), objects_map, Category.objects_map_cache_timeout)
             return category_with_object.pk
-        except Exception as e:
-            pass
 
-        # Будем создавать новую категорию по заданным базовой категории и бюджетному объекту
+        # 3. Будем создавать новую категорию по заданным базовой категории и бюджетному объекту
         cat = Category()
         cat.name = category_name + ' (' + object_name + ')'
-        cat.parent = category.parent
+        cat.parent_id = category.parent_id
         cat.type = category.type
         cat.user = user
         cat.budget = budget
         cat.budget_object = budget_object
 
         # Вычислим буквенный индекс (либо "a" для первого, либо следующий, если для данной базовой категории
-        # уже существуют категории с другими бюджетными объектами заданного бюджета
-        categories = Category.objects.filter(budget_id=budget.pk,
-                                             name__startswith=category_name).order_by('budget', '-item')
-        if categories:
-            last_item = categories[0].item
-            cat.item = category.item + chr(ord(last_item[last_item.rfind('.') + 1:]) + 1)
-        else:
-            cat.item = category.item + 'a'
+        # уже существуют категории с другими бюджетными объектами заданного бюджета)
+        last_suffix = objects_map['suffixes'].get(category.pk)
+        suffix = chr(ord(last_suffix) + 1) if last_suffix else 'a'
+        cat.item = category.item + suffix
 
-        # Сохраним новую категорию с бюджетным объектом
+        # 4. Сохраним новую категорию с бюджетным объектом и добавим ее в карту категорий бюджета
         cat.save()
+        objects_map['categories'][(category.pk, budget_object.pk)] = cat.pk
+        objects_map['suffixes'][category.pk] = suffix
+        cache.set(Category.get_objects_map_cache_key(budget.pk), objects_map, Category.objects_map_cache_timeout)
         return cat.pk
 
     def get_common_category_id(self):
@@ -1086,8 +1505,222 @@ class BudgetRegister(models.Model):
         return 'Регистр бюджета: ' + str(self.budget) + ' - ' + str(self.budget_year) + ' | ' + \
                str(self.budget_month) + ' | ' + str(self.category) + ' | ' + project_name
 
+    def save(self, *args, **kwargs):
+        """
+        Триггер на добавление/изменение
+        Новый регистр учитывается в сводке бюджета (количество и диапазон периодов).
+        """
+        is_new = self._state.adding
+        super(BudgetRegister, self).save(*args, **kwargs)
+        if is_new:
+            BudgetSummary.add_registers(self.budget_id,
+                                        [BudgetSummary.get_period(self.budget_year, self.budget_month)])
+
+    @classmethod
+    def set_planned_cells(cls, budget, cells):
+        """
+        Изменение плановых значений ячеек годового бюджета (категория - месяц).
+        Курс дополнительной валюты берется один раз на каждый год, текущие плановые значения всех ячеек отбираются
+        одним запросом, новые значения рассчитываются в памяти (правки одной ячейки применяются последовательно)
+        и записываются массово.
+        :param budget: бюджет;
+        :param cells: список правок - словарей с ключами cat_year, cat_month, cat_id, cat_dir ('inc'/'exp'),
+                      cat_type ('all'/'non-project'/'project') и cat_planned_value (со знаком направления);
+        :return: список словарей новых значений и изменений (all, non_project, project) по каждой правке.
+        """
+        if not cells:
+            return []
+
+        # 1. Курсы дополнительной валюты на начало каждого года
+        rates = {}
+        for cat_year in {cell['cat_year'] for cell in cells}:
+            rates[cat_year] = CurrencyRate.get_rate(budget.base_currency_2_id,
+                                                    budget.base_currency_1_id,
+                                                    date(cat_year, 1, 1) - timedelta(days=1))
+
+        # 2. Текущие плановые значения: текущие регистры (без проекта) и план проектов (проект = 0)
+        planned_values = {}
+        for budget_year, budget_month, category_id, project_id, planned_amount_base_cur_1 in \
+                (BudgetRegister.objects
+                 .filter(models.Q(project_id__isnull=True) | models.Q(project_id=0),
+                         budget_id=budget.pk,
+                         budget_year__in={cell['cat_year'] for cell in cells},
+                         budget_month__in={cell['cat_month'] for cell in cells},
+                         category_id__in={cell['cat_id'] for cell in cells})
+                 .order_by('id')
+                 .values_list('budget_year', 'budget_month', 'category_id', 'project_id',
+                              'planned_amount_base_cur_1')):
+            planned_values.setdefault((budget_year, budget_month, category_id, project_id),
+                                      ftod(planned_amount_base_cur_1, 2))
+
+        # 3. Рассчитываем новые значения
+        changed_keys = set()
+        results = []
+        for cell in cells:
+            non_project_key = (cell['cat_year'], cell['cat_month'], cell['cat_id'], None)
+            project_key = (cell['cat_year'], cell['cat_month'], cell['cat_id'], 0)
+            old_non_project = planned_values.get(non_project_key, ftod(0.00, 2))
+            old_project = planned_values.get(project_key, ftod(0.00, 2))
+            old_all = ftod(old_non_project + old_project, 2)
+            new_non_project = old_non_project
+            new_project = old_project
+
+            if cell['cat_type'] == 'all':
+                # Изменение общей суммы сначала ложится на текущий план, а то, что не поместилось
+                # (уменьшение ниже нуля), - на план проектов
+                delta = cell['cat_planned_value'] - old_all
+                delta_x = max(-old_non_project, delta) if cell['cat_dir'] == 'inc' \
+                    else -max(old_non_project, -delta)
+                delta_y = delta - delta_x
+                new_non_project = ftod(old_non_project + ftod(delta_x, 2), 2)
+                if ftod(delta_y, 2) != ftod(0.00, 2):
+                    new_project = ftod(old_project + ftod(delta_y, 2), 2)
+            elif cell['cat_type'] == 'non-project':
+                new_non_project = ftod(cell['cat_planned_value'], 2)
+            elif cell['cat_type'] == 'project':
+                new_project = ftod(cell['cat_planned_value'], 2)
+
+            if new_non_project != old_non_project:
+                changed_keys.add(non_project_key)
+            if new_project != old_project:
+                changed_keys.add(project_key)
+            planned_values[non_project_key] = new_non_project
+            planned_values[project_key] = new_project
+
+            new_all = ftod(new_non_project + new_project, 2)
+            sign = -1 if cell['cat_dir'] == 'exp' else 1
+            results.append({'new_all': sign * new_all,
+                            'new_non_project': sign * new_non_project,
+                            'new_project': sign * new_project,
+                            'delta_all': sign * ftod(new_all - old_all, 2),
+                            'delta_non_project': sign * ftod(new_non_project - old_non_project, 2),
+                            'delta_project': sign * ftod(new_project - old_project, 2),
+                            })
+
+        # 4. Записываем измененные значения по годам
+        for cat_year, rate in rates.items():
+            BudgetRegister.set_planned_values(budget.pk, cat_year,
+                                              {(budget_month, category_id, project_id):
+                                               (planned_values[(budget_year, budget_month, category_id, project_id)],
+                                                ftod(planned_values[(budget_year, budget_month, category_id,
+                                                                     project_id)] * rate, 2))
+                                               for budget_year, budget_month, category_id, project_id in changed_keys
+                                               if budget_year == cat_year})
+
+        return results
 
-class Transaction(models.Model):
+    @classmethod
+    def set_planned_values(cls, budget_id, budget_year, planned_values):
+        """
+        Массовая запись плановых значений бюджетных регистров года.
+        Существующие регистры отбираются одним запросом и обновляются одним массовым обновлением, недостающие
+        создаются одним массовым добавлением. Upsert через bulk_create(update_conflicts=True) здесь не подходит:
+        у регистров текущих доходов и расходов проект не указан, а NULL в уникальном ключе не дает конфликта.
+        :param budget_id: id бюджета;
+        :param budget_year: год бюджета;
+        :param planned_values: словарь (месяц, id категории, id проекта или None) -
+                               (план в основной базовой валюте, план в дополнительной базовой валюте).
+        """
+        if not planned_values:
+            return
+        planned_values = dict(planned_values)
+
+        project_ids = {project_id for budget_month, category_id, project_id in planned_values}
+        projects_filter = models.Q(project_id__in=[project_id for project_id in project_ids if project_id is not None])
+        if None in project_ids:
+            projects_filter |= models.Q(project_id__isnull=True)
+
+        changed_registers = []
+        for br in (BudgetRegister.objects
+                   .filter(projects_filter,
+                           budget_id=budget_id,
+                           budget_year=budget_year,
+                           budget_month__in={budget_month for budget_month, category_id, project_id in planned_values},
+                           category_id__in={category_id for budget_month, category_id, project_id in planned_values})
+                   .order_by('id')):
+            key = (br.budget_month, br.category_id, br.project_id)
+            if key in planned_values:
+                br.planned_amount_base_cur_1, br.planned_amount_base_cur_2 = planned_values.pop(key)
+                changed_registers.append(br)
+
+        new_registers = [BudgetRegister(budget_id=budget_id,
+                                        budget_year=budget_year,
+                                        budget_month=budget_month,
+                                        category_id=category_id,
+                                        project_id=project_id,
+                                        planned_amount_base_cur_1=planned_amount_base_cur_1,
+                                        planned_amount_base_cur_2=planned_amount_base_cur_2)
+                         for (budget_month, category_id, project_id), (planned_amount_base_cur_1,
+                                                                       planned_amount_base_cur_2)
+                         in planned_values.items()]
+
+        BudgetRegister.objects.bulk_update(changed_registers,
+                                           ['planned_amount_base_cur_1', 'planned_amount_base_cur_2'],
+                                           batch_size=500)
+        BudgetRegister.objects.bulk_create(new_registers, batch_size=500)
+        BudgetSummary.add_registers(budget_id, [BudgetSummary.get_period(budget_register.budget_year,
+                                                                         budget_register.budget_month)
+                                                for budget_register in new_registers])
+
+    @classmethod
+    def add_actual_values(cls, budget_id, actual_deltas):
+        """
+        Массовое изменение фактических значений бюджетных регистров на дельты.
+        Существующие регистры отбираются одним запросом и обновляются одним массовым обновлением, недостающие
+        создаются одним массовым добавлением (см. set_planned_values). Нулевые дельты пропускаются.
+        :param budget_id: id бюджета;
+        :param actual_deltas: словарь (год, месяц, id категории, id проекта или None) -
+                              (дельта факта в основной базовой валюте, дельта факта в дополнительной базовой валюте).
+        """
+        actual_deltas = {key: (ftod(delta_1, 2), ftod(delta_2, 2))
+                         for key, (delta_1, delta_2) in actual_deltas.items()
+                         if ftod(delta_1, 2) != ftod(0.00, 2) or ftod(delta_2, 2) != ftod(0.00, 2)}
+        if not actual_deltas:
+            return
+
+        project_ids = {project_id for budget_year, budget_month, category_id, project_id in actual_deltas}
+        projects_filter = models.Q(project_id__in=[project_id for project_id in project_ids if project_id is not None])
+        if None in project_ids:
+            projects_filter |= models.Q(project_id__isnull=True)
+
+        changed_registers = []
+        for br in (BudgetRegister.objects
+                   .filter(projects_filter,
+                           budget_id=budget_id,
+                           budget_year__in={budget_year for budget_year, budget_month, category_id, project_id
+                                            in actual_deltas},
+                           budget_month__in={budget_month for budget_year, budget_month, category_id, project_id
+                                             in actual_deltas},
+                           category_id__in={category_id for budget_year, budget_month, category_id, project_id
+                                            in actual_deltas})
+                   .order_by('id')):
+            key = (br.budget_year, br.budget_month, br.category_id, br.project_id)
+            if key in actual_deltas:
+                delta_1, delta_2 = actual_deltas.pop(key)
+                br.actual_amount_base_cur_1 = ftod(br.actual_amount_base_cur_1, 2) + delta_1
+                br.actual_amount_base_cur_2 = ftod(br.actual_amount_base_cur_2, 2) + delta_2
+                changed_registers.append(br)
+
+        new_registers = [BudgetRegister(budget_id=budget_id,
+                                        budget_year=budget_year,
+                                        budget_month=budget_month,
+                                        category_id=category_id,
+                                        project_id=project_id,
+                                        actual_amount_base_cur_1=delta_1,
+                                        actual_amount_base_cur_2=delta_2)
+                         for (budget_year, budget_month, category_id, project_id), (delta_1, delta_2)
+                         in actual_deltas.items()]
+
+        BudgetRegister.objects.bulk_update(changed_registers,
+                                           ['actual_amount_base_cur_1', 'actual_amount_base_cur_2'],
+                                           batch_size=500)
+        BudgetRegister.objects.bulk_create(new_registers, batch_size=500)
+        BudgetSummary.add_registers(budget_id, [BudgetSummary.get_period(budget_register.budget_year,
+                                                                         budget_register.budget_month)
+                                                for budget_register in new_registers])
+
+
+class Transaction(OriginalValuesMixin, models.Model):
     """
     Операции по счету/кошельку
     Операция соответствует фактически совершенной операции с деньгами: получение зарплаты, покупка в магазине, перевод
@@ -1127,6 +1760,14 @@ class Transaction(models.Model):
     project = models.ForeignKey('Project', on_delete=models.PROTECT, null=True, blank=True, verbose_name='Проект')
     sender = models.OneToOneField('self', related_name='receiver', on_delete=models.SET_NULL, null=True, blank=True,
                                   verbose_name='Операция-источник')
+    import_hash = models.CharField(max_length=64, null=True, blank=True,
+                                   verbose_name='Отпечаток операции при загрузке из файла')
+    description_search = models.TextField(null=True, blank=True, editable=False,
+                                          verbose_name='Строка поиска по локации и описанию операции')
+    banks_description_search = models.TextField(null=True, blank=True, editable=False,
+                                                verbose_name='Строка поиска по информации от банка')
+    categories_search = models.TextField(null=True, blank=True, editable=False,
+                                         verbose_name='Строка поиска по категориям операции')
     user_create = models.ForeignKey(User, related_name='user_create', on_delete=models.PROTECT, null=True, blank=True,
                                     verbose_name='Добавивший операцию в систему')
     user_update = models.ForeignKey(User, related_name='user_update', on_delete=models.PROTECT, null=True, blank=True,
@@ -1156,8 +1797,8 @@ class Transaction(models.Model):
     original_amount_base_cur_2 = None
     original_budget_year = None
     original_budget_month = None
-    original_sender = None
-    original_project = None
+    original_sender_id = None
+    original_project_id = None
 
     def __str__(self):
         type_name = '???'
@@ -1190,10 +1831,15 @@ class Transaction(models.Model):
     class Meta:
         verbose_name = 'Операция'
         verbose_name_plural = 'Операции'
-        indexes = (Index(fields=['budget', 'account', '-time_transaction'],
-                         name='t__budget_account_time_idx'),
+        indexes = (Index(fields=['budget', 'account', '-time_transaction', '-id'],
+                         name='t__budget_account_time_id_idx'),
                    Index(fields=['budget', 'type', '-time_transaction'],
                          name='t__budget_type_time_idx'),
+                   Index(fields=['account', 'import_hash'],
+                         name='t__account_import_hash_idx'),
+                   Index(fields=['budget', 'currency', 'amount', 'time_transaction'],
+                         name='t__unlinked_movement_idx',
+                         condition=models.Q(type__in=['MO-', 'MO+'], sender__isnull=True)),
                    )
         ordering = ['budget', 'account', '-time_transaction']
 
@@ -1215,8 +1861,8 @@ class Transaction(models.Model):
         is_original_time_transaction_change = self.original_time_transaction != self.time_transaction
         is_budget_year_change = self.original_budget_year != self.budget_year
         is_budget_month_change = self.original_budget_month != self.budget_month
-        is_sender_change = self.original_sender != self.sender
-        is_project_change = self.original_project != self.project
+        is_sender_change = self.original_sender_id != self.sender_id
+        is_project_change = self.original_project_id != self.project_id
 
         # 1. Изменяем атрибуты самой операции
         # 1.1. Приравняем сумму операции сумме в валюте счета при валюте операции равной валюте счета, ибо на
@@ -1235,6 +1881,10 @@ class Transaction(models.Model):
                     0, 0, 0, 0, timezone.utc) == self.time_transaction:
             self.time_transaction = self.get_last_transaction_in_day(self.account, self.time_transaction)
 
+        # 1.3. Обновим строки поиска по локации и описанию операции и по информации от банка
+        self.description_search = self.get_search_text(self.place, self.description)
+        self.banks_description_search = self.get_search_text(self.mcc_code, self.banks_category, self.banks_description)
+
         # 2. Для операций перемещения попробуем найти подходящую единственную связанную операцию
         suitable_transaction = None
 
@@ -1242,27 +1892,10 @@ class Transaction(models.Model):
                 self.type == 'MO-' and not hasattr(self, 'receiver') or \
                 self.type == 'MO-' and self.receiver is None:
 
-            # Искать будем противоположные операции
-            search_type = 'MO-' if self.type == 'MO+' else 'MO+'
-
-            # Устанавливаем промежуток времени для поиска
-            search_start_time = self.time_transaction - DEFAULT_TIME_DELTA if self.type == 'MO+' \
-                else self.time_transaction
-            search_end_time = self.time_transaction if self.type == 'MO+' \
-                else self.time_transaction + DEFAULT_TIME_DELTA
-
-            # Отбираем операции перемещения заданного типа и в заданном промежутке времени, с инвертированной
+            # Отбираем операции перемещения противоположного типа в допустимом промежутке времени, с инвертированной
             # суммой операции, в валюте текущего перемещения, без установленной связи, по всем счетам, кроме текущего
-            suitable_transactions = \
-                Transaction.objects.filter(budget_id=self.budget.id,
-                                           time_transaction__gte=search_start_time,
-                                           time_transaction__lte=search_end_time,
-                                           type=search_type,
-                                           amount=-self.amount,
-                                           currency_id=self.currency.id,
-                                           sender__isnull=True,
-                                           receiver__isnull=True
-                                           ).exclude(account_id=self.account.id)
+            # (второй кандидат нужен только для того, чтобы понять, что подходящая операция не единственная)
+            suitable_transactions = Transaction.get_movement_candidates(self)[:2]
 
             # Если подходящих транзакций выбралось только одна, то устанавливаем связь
             if len(suitable_transactions) == 1:
@@ -1273,8 +1906,11 @@ class Transaction(models.Model):
                 if self.type == 'MO+':
                     self.sender = suitable_transaction
 
-        # 3. Сохраним саму операцию, ибо в случае новой понадобится её ключ
+        # 3. Сохраним саму операцию, ибо в случае новой понадобится её ключ (новую учтем в сводке бюджета)
+        is_new = self._state.adding
         super(Transaction, self).save(*args, **kwargs)
+        if is_new:
+            BudgetSummary.change_counts(self.budget_id, transactions=1)
 
         # ...закончим операцию по связыванию операций из п.2 (нужен был pk новой операции, чтоб в подходящую для
         # связывания операцию приемник запихать)
@@ -1601,6 +2237,48 @@ class Transaction(models.Model):
         except Exception as e:
             print('Что-то пошло не так с удалением операции - ' + str(e))
 
+    @classmethod
+    def get_search_text(cls, *values):
+        """
+        Получение строки поиска операции - значений полей через перевод строки в нижнем регистре (как и в строке
+        поиска по категориям, чтобы подстрока не находилась на стыке двух полей).
+        В PostgreSQL по строкам поиска построены триграммные индексы (см. миграцию 0009), поэтому поиск подстроки
+        по ним идет по индексу, в остальных СУБД - тем же запросом без индекса.
+        :param values: значения полей операции;
+        :return: строка поиска.
+        """
+        return '\n'.join(str(value).strip() for value in values if value).lower()
+
+    @classmethod
+    def set_categories_search(cls, transaction_ids):
+        """
+        Обновление строки поиска по категориям у заданных операций - названия категорий операции в нижнем регистре
+        через перевод строки (чтобы подстрока не находилась на стыке двух названий).
+        Вызывается из триггеров категорий операции и при переименовании категорий. Пишется массовым обновлением
+        (bulk_update), чтобы не запускать триггер операции.
+        :param transaction_ids: id операций;
+        """
+        transaction_ids = set(transaction_ids)
+        if not transaction_ids:
+            return
+        categories_names = {transaction_id: [] for transaction_id in transaction_ids}
+        for transaction_id, category_name in \
+                TransactionCategory.objects.filter(transaction_id__in=transaction_ids).order_by('pk')\
+                .values_list('transaction_id', 'category__name'):
+            categories_names[transaction_id].append(cls.get_search_text(category_name))
+        Transaction.objects.bulk_update([Transaction(pk=transaction_id, categories_search='\n'.join(names) or None)
+                                         for transaction_id, names in categories_names.items()],
+                                        ['categories_search'], batch_size=500)
+
+    @classmethod
+    def get_categories_prefetch(cls):
+        """
+        Предзагрузка категорий операций для списков операций - одним запросом на весь список, сразу с категориями.
+        :return: объект Prefetch для prefetch_related.
+        """
+        return models.Prefetch('transaction_categories',
+                               queryset=TransactionCategory.objects.select_related('category'))
+
     @classmethod
     def get_last_transaction_in_day(cls, account=None, searching_day=None):
         """
@@ -1629,16 +2307,28 @@ class Transaction(models.Model):
                                        account_id=account.id,
                                        time_transaction__gte=searching_day_start,
                                        time_transaction__lte=searching_day_end,
-                                       ).exclude(type__in=['ED+', 'ED-']).order_by('-time_transaction')
+                                       ).exclude(type__in=['ED+', 'ED-']).order_by('-time_transaction')[:1]
         if suitable_transactions:
+            return cls.get_time_after_last_transaction(searching_day, suitable_transactions[0].time_transaction)
+        else:
+            return cls.get_time_after_last_transaction(searching_day, None)
+
+    @classmethod
+    def get_time_after_last_transaction(cls, searching_day, time_last_transaction_in_day=None):
+        """
+        Получение даты-времени новой операции по дате-времени последней операции в заданную дату.
+        :param searching_day: дата;
+        :param time_last_transaction_in_day: дата-время последней операции в заданную дату или None;
+        :return: дата-время новой операции.
+        """
+        if time_last_transaction_in_day:
             # Операции нашлись, берем дату-время последней и прибавляем дельту
-            time_last_transaction_in_day = suitable_transactions[0].time_transaction
             if time_last_transaction_in_day.hour == 23 and \
                     time_last_transaction_in_day.minute + DEFAULT_MINUTES_DELTA_FOR_NEW_TRANSACTION > 59:
-                return suitable_transactions[0].time_transaction + \
+                return time_last_transaction_in_day + \
                        timedelta(seconds=1)
             else:
-                return suitable_transactions[0].time_transaction + \
+                return time_last_transaction_in_day + \
                        timedelta(minutes=DEFAULT_MINUTES_DELTA_FOR_NEW_TRANSACTION)
         else:
             # Операции не нашлись, возвращаем полдень указанной даты
@@ -1646,17 +2336,492 @@ class Transaction(models.Model):
                             0, 0, 0, 0, timezone.utc) + \
                    timedelta(hours=12)
 
+    @classmethod
+    def get_import_hash(cls, account_id, time_transaction, amount_acc_cur, banks_description, occurrence=1):
+        """
+        Получение отпечатка операции, загружаемой из файла.
+        Отпечаток строится по счету, дате-времени операции из файла (до подстановки времени для операций без времени),
+        сумме в валюте счета и описанию операции от банка. Порядковый номер совпадающих по этим реквизитам операций
+        в файле позволяет загрузить действительно одинаковые операции (например, две одинаковые покупки подряд)
+        и при этом не задублировать их при повторной загрузке того же файла.
+        :param account_id: id счета;
+        :param time_transaction: дата-время операции в UTC;
+        :param amount_acc_cur: сумма операции в валюте счета;
+        :param banks_description: описание операции от банка;
+        :param occurrence: порядковый номер совпадающей операции в файле;
+        :return: отпечаток операции (sha256 в hex).
+        """
+        fingerprint = '|'.join([str(account_id),
+                                time_transaction.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                                str(ftod(amount_acc_cur, 2)),
+                                (banks_description or '').strip(),
+                                str(occurrence)])
+        return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get_movement_candidates(cls, movement):
+        """
+        Получение операций, подходящих для установки связи с операцией перемещения.
+        Подходящими считаются несвязанные операции перемещения противоположного типа по другим счетам бюджета
+        в валюте операции, с инвертированной суммой операции, в промежутке времени DEFAULT_TIME_DELTA до операции
+        прихода или после операции расхода. Отбор идет по частичному индексу t__unlinked_movement_idx.
+        :param movement: операция перемещения;
+        :return: набор подходящих операций, упорядоченный по удаленности по времени от операции перемещения.
+        """
+        if movement.type == 'MO+':
+            search_type = 'MO-'
+            search_start_time = movement.time_transaction - DEFAULT_TIME_DELTA
+            search_end_time = movement.time_transaction
+            ordering = '-time_transaction'
+        else:
+            search_type = 'MO+'
+            search_start_time = movement.time_transaction
+            search_end_time = movement.time_transaction + DEFAULT_TIME_DELTA
+            ordering = 'time_transaction'
+        return (Transaction.objects
+                .filter(budget_id=movement.budget_id,
+                        currency_id=movement.currency_id,
+                        amount=-movement.amount,
+                        time_transaction__gte=search_start_time,
+                        time_transaction__lte=search_end_time,
+                        type=search_type,
+                        sender__isnull=True,
+                        receiver__isnull=True)
+                .exclude(account_id=movement.account_id)
+                .order_by(ordering, 'id'))
+
+    @classmethod
+    def get_movement_matching(cls, budget_id):
+        """
+        Подбор пар для всех несвязанных операций перемещения бюджета.
+        Несвязанные операции перемещения расход и приход раскладываются по корзинам (валюта, сумма), внутри корзины
+        упорядочиваются по времени, и для каждого расхода проходом по отсортированным приходам отбираются приходы
+        в окне [время расхода; время расхода + DEFAULT_TIME_DELTA] по другим счетам (те же условия, что и при
+        автоматическом связывании в Transaction.save()). Операции, связанные через кандидатов, собираются в группы:
+        группа из одного расхода и одного прихода - однозначная пара, остальные группы - неоднозначные.
+        :param budget_id: id бюджета;
+        :return: список однозначных пар (id расхода, id прихода) и список неоднозначных групп
+                 (список id расходов, список id приходов).
+        """
+
+        # 1. Отберем все несвязанные операции перемещения бюджета и разложим их по корзинам
+        buckets = {}
+        unlinked_movements = (Transaction.objects
+                              .filter(budget_id=budget_id,
+                                      type__in=['MO-', 'MO+'],
+                                      sender__isnull=True,
+                                      receiver__isnull=True)
+                              .values_list('id', 'type', 'account_id', 'currency_id', 'amount', 'time_transaction'))
+        for t_id, t_type, account_id, currency_id, amount, time_transaction in unlinked_movements:
+            # Сумма прихода противоположна по знаку сумме расхода
+            key = (currency_id, ftod(-amount if t_type == 'MO-' else amount, 2))
+            bucket = buckets.setdefault(key, ([], []))
+            bucket[0 if t_type == 'MO-' else 1].append((time_transaction, t_id, account_id))
+
+        # 2. В каждой корзине проходим окном по упорядоченным по времени приходам: начало и конец окна только
+        #    сдвигаются вперед, т.к. расходы тоже упорядочены. Пары расход-кандидат объединяем в группы
+        parents = {}
+
+        def find(node):
+            while parents.setdefault(node, node) != node:
+                parents[node] = parents[parents[node]]
+                node = parents[node]
+            return node
+
+        for senders, receivers in buckets.values():
+            if not senders or not receivers:
+                continue
+            senders.sort()
+            receivers.sort()
+            window_start = 0
+            window_end = 0
+            for sender_time, sender_id, sender_account_id in senders:
+                while window_start < len(receivers) and receivers[window_start][0] < sender_time:
+                    window_start += 1
+                window_end = max(window_end, window_start)
+                while window_end < len(receivers) and receivers[window_end][0] <= sender_time + DEFAULT_TIME_DELTA:
+                    window_end += 1
+                for receiver_time, receiver_id, receiver_account_id in receivers[window_start:window_end]:
+                    if receiver_account_id != sender_account_id:
+                        root_sender = find(('MO-', sender_id))
+                        root_receiver = find(('MO+', receiver_id))
+                        if root_sender != root_receiver:
+                            parents[root_sender] = root_receiver
+
+        # 3. Группа из одного расхода и одного прихода - однозначная пара, остальные группы - неоднозначные
+        groups = {}
+        for node in list(parents.keys()):
+            group = groups.setdefault(find(node), ([], []))
+            group[0 if node[0] == 'MO-' else 1].append(node[1])
+        pairs = []
+        ambiguous_groups = []
+        for group_senders, group_receivers in groups.values():
+            if len(group_senders) == 1 and len(group_receivers) == 1:
+                pairs.append((group_senders[0], group_receivers[0]))
+            else:
+                ambiguous_groups.append((sorted(group_senders), sorted(group_receivers)))
+
+        return pairs, ambiguous_groups
 
-class TransactionCategory(models.Model):
+    @classmethod
+    def set_movement_links(cls, pairs, user=None):
+        """
+        Установка связей между операциями перемещения одним массовым обновлением.
+        Массовое обновление не вызывает Transaction.save(), поэтому признак невалидности остатков и дата валидности
+        остатков у счетов операций прихода устанавливаются здесь же (см. п.6.4 в Transaction.save()).
+        Пары перепроверяются под блокировкой операций: приход еще не связан, расход не связан с другим приходом,
+        каждая операция - не более чем в одной паре. При секционировании таблицы операций уникальность
+        операции-отправителя базой данных не обеспечивается (см. partitioning), поэтому эта проверка обязательна.
+        Не прошедшие проверку пары пропускаются.
+        :param pairs: список пар (id расхода, id прихода);
+        :param user: пользователь, устанавливающий связи;
+        :return: количество связанных пар.
+        """
+        if not pairs:
+            return 0
+
+        with transaction.atomic():
+            # 1. Блокируем операции пар (в порядке id - параллельные установки связей ждут друг друга)
+            #    и отбираем уже связанные
+            list(Transaction.objects.select_for_update()
+                 .filter(pk__in=[t_id for pair in pairs for t_id in pair]).order_by('pk').values_list('pk'))
+            linked_ids = set(Transaction.objects
+                             .filter(pk__in=[receiver_id for sender_id, receiver_id in pairs], sender__isnull=False)
+                             .values_list('pk', flat=True))
+            linked_ids.update(Transaction.objects
+                              .filter(sender_id__in=[sender_id for sender_id, receiver_id in pairs])
+                              .values_list('sender_id', flat=True))
+
+            # 2. Связываем оставшиеся пары
+            time_update = datetime.now(timezone.utc)
+            receivers = []
+            for sender_id, receiver_id in pairs:
+                if sender_id in linked_ids or receiver_id in linked_ids:
+                    continue
+                linked_ids.update((sender_id, receiver_id))
+                receiver = Transaction(pk=receiver_id)
+                receiver.sender_id = sender_id
+                receiver.user_update = user
+                receiver.time_update = time_update
+                receivers.append(receiver)
+            if not receivers:
+                return 0
+            Transaction.objects.bulk_update(receivers, ['sender', 'user_update', 'time_update'], batch_size=500)
+
+            # 3. Самые ранние времена связанных приходов по счетам
+            earliest_times = {}
+            for account_id, time_transaction in \
+                    (Transaction.objects
+                     .filter(pk__in=[receiver.pk for receiver in receivers])
+                     .values_list('account_id', 'time_transaction')):
+                if account_id not in earliest_times or earliest_times[account_id] > time_transaction:
+                    earliest_times[account_id] = time_transaction
+            Account.invalidate_balances(earliest_times)
+
+        return len(receivers)
+
+    @classmethod
+    def reprice_by_rate(cls, currency_id, date_rate):
+        """
+        Пересчет сумм операций в базовых валютах после исправления курса валюты на дату (без полного пересчета
+        остатков). Пересчитываются только операции, суммы которых считаются по курсу на эту дату (см.
+        CurrencyRate.get_search_date): операции счетов в этой валюте и счетов бюджетов с этой базовой валютой,
+        а также операции перемещения расход, чьи операции-приемники попали в пересчет.
+        По каждому счету операции проходятся по времени от первой затронутой, суммы и остатки в базовых валютах
+        считаются так же, как в процедуре пересчета остатков, но от сохраненных остатков - проход заканчивается на
+        первой операции после затронутого интервала, на которой сдвиг остатков нулевой (изменения поглотили операции
+        курсовой разницы, остатки дальше не меняются), но не позже конца следующего месяца: если сдвиг не поглощен
+        и к этому времени, то остатки счета с операции, на которой остановлен проход, помечаются невалидными.
+        Изменения пишутся массовыми операциями: операции, категории операций (по долям, как в Transaction.save),
+        бюджетные регистры (дельтами, см. BudgetRegister.add_actual_values), бюджетные обороты и остатки счетов.
+        Счета с невалидными остатками пересчитываются только до даты валидности остатков - дальше их пересчитает
+        процедура пересчета остатков.
+        :param currency_id: id валюты, курс которой исправлен;
+        :param date_rate: дата исправленного курса;
+        :return: количество измененных операций.
+        """
+        # 1. Интервалы времени операций, суммы которых считаются по курсу на заданную дату: месяц (для курса на
+        #    конец прошлого месяца) и следующий день (в текущем месяце, для текущего дня - и все будущие операции)
+        today = datetime.utcnow().date()
+        intervals = []
+        if date_rate == last_day_of_month(date_rate) and \
+                date(date_rate.year, date_rate.month, 1) < date(today.year, today.month, 1):
+            intervals.append((datetime(date_rate.year, date_rate.month, 1, 0, 0, 0, 0, timezone.utc),
+                              datetime(date_rate.year, date_rate.month, date_rate.day,
+                                       23, 59, 59, 999999, timezone.utc)))
+        next_day = date_rate + timedelta(days=1)
+        if next_day <= today and next_day.year == today.year and next_day.month == today.month:
+            intervals.append((datetime(next_day.year, next_day.month, next_day.day, 0, 0, 0, 0, timezone.utc),
+                              MAX_TRANSACTION_DATETIME if next_day == today else
+                              datetime(next_day.year, next_day.month, next_day.day, 23, 59, 59, 999999, timezone.utc)))
+        if not intervals:
+            return 0
+        intervals_filter = Q()
+        for begin_time, end_time in intervals:
+            intervals_filter |= Q(time_transaction__range=(begin_time, end_time))
+        intervals_end = max(end_time for begin_time, end_time in intervals)
+
+        def is_repriced(time_transaction):
+            return CurrencyRate.get_search_date(time_transaction) == date_rate
+
+        rates = {}
+
+        def get_rate(base_currency_id, account_currency_id, time_transaction):
+            key = (base_currency_id, account_currency_id, CurrencyRate.get_search_date(time_transaction))
+            if key not in rates:
+                rates[key] = CurrencyRate.get_rate(base_currency_id, account_currency_id, time_transaction)
+            return rates[key]
+
+        # 2. Счета для пересчета и время первой затронутой операции по каждому: счета в этой валюте и счета бюджетов
+        #    с этой базовой валютой - от начала интервала, счета-отправители перемещений в них - от перемещения расход
+        accounts = {account.pk: account for account in
+                    Account.objects.filter(Q(currency_id=currency_id) | Q(budget__base_currency_1_id=currency_id) |
+                                           Q(budget__base_currency_2_id=currency_id))
+                    .select_related('budget')}
+        begin_times = {account_id: intervals[0][0] for account_id in accounts}
+        end_times = {account_id: intervals_end for account_id in accounts}
+        for sender_account_id, sender_time in Transaction.objects\
+                .filter(intervals_filter, account_id__in=list(accounts), type='MO+', sender__isnull=False)\
+                .values_list('sender__account_id', 'sender__time_transaction'):
+            begin_times[sender_account_id] = min(begin_times.get(sender_account_id, sender_time), sender_time)
+            end_times[sender_account_id] = max(end_times.get(sender_account_id, sender_time), sender_time)
+        accounts.update(Account.objects.in_bulk([account_id for account_id in begin_times
+                                                 if account_id not in accounts]))
+
+        # 3. Проход по операциям счетов с пересчетом сумм и остатков в базовых валютах. Проход ограничен концом
+        #    месяца, следующего за месяцем последней пересчитываемой операции счета: сдвиг остатков (в том числе
+        #    от переоценки остатка на конец месяца по исправленному курсу) поглощает пара операций курсовой разницы
+        #    на конец следующего месяца, а если не поглотила (их нет), то остатки дальше пересчитает процедура
+        #    пересчета остатков - счет помечается невалидным
+        changed_transactions = []
+        amount_deltas = {}
+        invalid_times = {}
+        for account_id, begin_time in begin_times.items():
+            account = accounts[account_id]
+            if not account.is_balances_valid and account.balances_valid_until <= begin_time:
+                continue
+            end_time = end_times[account_id]
+            next_month = min(MAX_TRANSACTION_DATETIME, last_day_of_month(end_time) + timedelta(days=1))
+            walk_end_time = datetime(next_month.year, next_month.month, last_day_of_month(next_month).day,
+                                     23, 59, 59, 999999, timezone.utc)
+            base_currencies = (account.budget.base_currency_1_id, account.budget.base_currency_2_id)
+            transactions = Transaction.objects.filter(budget_id=account.budget_id, account_id=account.pk,
+                                                      time_transaction__gte=begin_time)\
+                .select_related('receiver__account').order_by('time_transaction', 'id')
+            if not account.is_balances_valid:
+                transactions = transactions.filter(time_transaction__lt=account.balances_valid_until)
+            is_first = not Transaction.objects.filter(budget_id=account.budget_id, account_id=account.pk,
+                                                      time_transaction__lt=begin_time).exists()
+            shifts = [ftod(0.00, 2), ftod(0.00, 2)]
+            for t in transactions:
+                # 3.0. Операции после затронутого интервала не пересчитываются - при нулевом сдвиге остатки дальше
+                #      не меняются, а за концом прохода с ненулевым сдвигом счет пересчитает процедура пересчета
+                if t.time_transaction > end_time and shifts == [ftod(0.00, 2), ftod(0.00, 2)]:
+                    break
+                if t.time_transaction > walk_end_time:
+                    invalid_times[account_id] = t.time_transaction
+                    break
+
+                old_rates = [ftod(t.rate_base_cur_1, 9), ftod(t.rate_base_cur_2, 9)]
+                old_amounts = [ftod(t.amount_base_cur_1, 2), ftod(t.amount_base_cur_2, 2)]
+                old_balances = [ftod(t.balance_base_cur_1, 2), ftod(t.balance_base_cur_2, 2)]
+
+                # 3.1. Остатки предыдущей операции (с учетом сдвига), для первой операции счета - начальный остаток
+                previous_balances = [old_balances[i] - old_amounts[i] + shifts[i] for i in range(2)]
+                if is_first:
+                    is_first = False
+                    if t.type in ['ED+', 'ED-']:
+                        initial_time = datetime(t.time_transaction.year, t.time_transaction.month,
+                                                1, 0, 0, 0, 0, timezone.utc) - timedelta(microseconds=1)
+                    else:
+                        initial_time = t.time_transaction
+                    if is_repriced(initial_time):
+                        previous_balances = [ftod(account.initial_balance *
+                                                  get_rate(base_currencies[i], account.currency_id, initial_time), 2)
+                                             for i in range(2)]
+
+                # 3.2. Курсы и суммы операции
+                new_rates, new_amounts = old_rates, old_amounts
+                receiver_transaction = getattr(t, 'receiver', None) if t.type == 'MO-' else None
+                if t.type in ['MO+', 'CRE', 'DEB'] and is_repriced(t.time_transaction):
+                    new_rates = [get_rate(base_currencies[i], account.currency_id, t.time_transaction)
+                                 for i in range(2)]
+                    new_amounts = [ftod(t.amount_acc_cur * new_rates[i], 2) for i in range(2)]
+                elif receiver_transaction and is_repriced(receiver_transaction.time_transaction):
+                    new_rates = [get_rate(base_currencies[i], receiver_transaction.account.currency_id,
+                                          receiver_transaction.time_transaction) for i in range(2)]
+                    new_amounts = [ftod(-receiver_transaction.amount_acc_cur * new_rates[i], 2) for i in range(2)]
+                elif t.type in ['ED+', 'ED-']:
+                    if is_repriced(t.time_transaction):
+                        new_rates = [get_rate(base_currencies[i], account.currency_id, t.time_transaction)
+                                     for i in range(2)]
+                    new_amounts = []
+                    for i in range(2):
+                        difference = ftod(t.balance_acc_cur * new_rates[i], 2) - previous_balances[i]
+                        if t.type == 'ED+' and difference >= 0 or t.type == 'ED-' and difference <= 0:
+                            new_amounts.append(difference)
+                        else:
+                            new_amounts.append(ftod(0.00, 2))
+                new_balances = [previous_balances[i] + new_amounts[i] for i in range(2)]
+                shifts = [new_balances[i] - old_balances[i] for i in range(2)]
+
+                # 3.3. Запомним измененную операцию
+                if new_rates != old_rates or new_amounts != old_amounts or new_balances != old_balances:
+                    t.rate_base_cur_1, t.rate_base_cur_2 = new_rates
+                    t.amount_base_cur_1, t.amount_base_cur_2 = new_amounts
+                    t.balance_base_cur_1, t.balance_base_cur_2 = new_balances
+                    changed_transactions.append(t)
+                    if new_amounts != old_amounts:
+                        amount_deltas[t.pk] = (t, new_amounts[0] - old_amounts[0], new_amounts[1] - old_amounts[1])
+
+        if not changed_transactions:
+            return 0
+
+        with transaction.atomic():
+            # 4. Запишем операции
+            Transaction.objects.bulk_update(changed_transactions,
+                                            ['rate_base_cur_1', 'rate_base_cur_2', 'amount_base_cur_1',
+                                             'amount_base_cur_2', 'balance_base_cur_1', 'balance_base_cur_2'],
+                                            batch_size=500)
+
+            # 5. Суммы категорий операций по долям сумм в валюте счета (последней категории - остаток)
+            #    и дельты бюджетных регистров
+            transaction_categories = {}
+            for transaction_category in TransactionCategory.objects\
+                    .filter(transaction_id__in=[transaction_id for transaction_id, (t, delta_1, delta_2)
+                                                in amount_deltas.items()
+                                                if t.type in ['CRE', 'DEB', 'ED+', 'ED-']])\
+                    .order_by('pk'):
+                transaction_categories.setdefault(transaction_category.transaction_id, []).append(transaction_category)
+            changed_transaction_categories = []
+            actual_deltas = {}
+            for transaction_id, categories in transaction_categories.items():
+                t = amount_deltas[transaction_id][0]
+                categories_sum = sum(ftod(category.amount_acc_cur, 2) for category in categories)
+                new_sum_amount_base_cur_1 = ftod(0.00, 2)
+                new_sum_amount_base_cur_2 = ftod(0.00, 2)
+                for i, transaction_category in enumerate(categories):
+                    old_amount_base_cur_1 = ftod(transaction_category.amount_base_cur_1, 2)
+                    old_amount_base_cur_2 = ftod(transaction_category.amount_base_cur_2, 2)
+                    if i < len(categories) - 1 and categories_sum:
+                        proportion = ftod(transaction_category.amount_acc_cur, 2) / categories_sum
+                        transaction_category.amount_base_cur_1 = ftod(t.amount_base_cur_1 * proportion, 2)
+                        transaction_category.amount_base_cur_2 = ftod(t.amount_base_cur_2 * proportion, 2)
+                    else:
+                        transaction_category.amount_base_cur_1 = ftod(t.amount_base_cur_1 -
+                                                                      new_sum_amount_base_cur_1, 2)
+                        transaction_category.amount_base_cur_2 = ftod(t.amount_base_cur_2 -
+                                                                      new_sum_amount_base_cur_2, 2)
+                    new_sum_amount_base_cur_1 = new_sum_amount_base_cur_1 + transaction_category.amount_base_cur_1
+                    new_sum_amount_base_cur_2 = new_sum_amount_base_cur_2 + transaction_category.amount_base_cur_2
+                    changed_transaction_categories.append(transaction_category)
+
+                    budget_deltas = actual_deltas.setdefault(t.budget_id, {})
+                    key = (transaction_category.budget_year, transaction_category.budget_month,
+                           transaction_category.category_id, transaction_category.project_id)
+                    delta_1, delta_2 = budget_deltas.get(key, (ftod(0.00, 2), ftod(0.00, 2)))
+                    budget_deltas[key] = (delta_1 + transaction_category.amount_base_cur_1 - old_amount_base_cur_1,
+                                          delta_2 + transaction_category.amount_base_cur_2 - old_amount_base_cur_2)
+            TransactionCategory.objects.bulk_update(changed_transaction_categories,
+                                                    ['amount_base_cur_1', 'amount_base_cur_2'], batch_size=500)
+            for budget_id, budget_deltas in actual_deltas.items():
+                BudgetRegister.add_actual_values(budget_id, budget_deltas)
+
+            # 6. Бюджетные обороты по счетам: обороты периодов меняются на дельты, остатки на начало и конец
+            #    периодов - на накопленную сумму дельт предыдущих периодов
+            turnover_deltas = {}
+            for t, delta_1, delta_2 in amount_deltas.values():
+                account_deltas = turnover_deltas.setdefault((t.budget_id, t.account_id), {})
+                budget_period = datetime(t.budget_year, t.budget_month, 15, 0, 0, 0, 0, timezone.utc)
+                deltas = account_deltas.setdefault(budget_period, [ftod(0.00, 2)] * 4)
+                if t.type in ['MO+', 'CRE', 'ED+']:
+                    deltas[0], deltas[1] = deltas[0] + delta_1, deltas[1] + delta_2
+                else:
+                    deltas[2], deltas[3] = deltas[2] + delta_1, deltas[3] + delta_2
+            budget_ids = set()
+            for (budget_id, account_id), account_deltas in turnover_deltas.items():
+                budget_ids.add(budget_id)
+                shift_1, shift_2 = ftod(0.00, 2), ftod(0.00, 2)
+                budget_periods = sorted(account_deltas)
+                for i, budget_period in enumerate(budget_periods):
+                    credit_1, credit_2, debit_1, debit_2 = account_deltas[budget_period]
+                    AccountTurnover.objects.get_or_create(budget_id=budget_id, account_id=account_id,
+                                                          budget_period=budget_period)
+                    AccountTurnover.objects.filter(budget_id=budget_id, account_id=account_id,
+                                                   budget_period=budget_period)\
+                        .update(credit_turnover_base_cur_1=F('credit_turnover_base_cur_1') + credit_1,
+                                credit_turnover_base_cur_2=F('credit_turnover_base_cur_2') + credit_2,
+                                debit_turnover_base_cur_1=F('debit_turnover_base_cur_1') + debit_1,
+                                debit_turnover_base_cur_2=F('debit_turnover_base_cur_2') + debit_2,
+                                begin_balance_base_cur_1=F('begin_balance_base_cur_1') + shift_1,
+                                begin_balance_base_cur_2=F('begin_balance_base_cur_2') + shift_2,
+                                end_balance_base_cur_1=F('end_balance_base_cur_1') + shift_1 + credit_1 + debit_1,
+                                end_balance_base_cur_2=F('end_balance_base_cur_2') + shift_2 + credit_2 + debit_2)
+                    shift_1, shift_2 = shift_1 + credit_1 + debit_1, shift_2 + credit_2 + debit_2
+                    if shift_1 or shift_2:
+                        following_turnovers = AccountTurnover.objects.filter(budget_id=budget_id,
+                                                                             account_id=account_id,
+                                                                             budget_period__gt=budget_period)
+                        if i < len(budget_periods) - 1:
+                            following_turnovers = following_turnovers.filter(
+                                budget_period__lt=budget_periods[i + 1])
+                        following_turnovers.update(begin_balance_base_cur_1=F('begin_balance_base_cur_1') + shift_1,
+                                                   begin_balance_base_cur_2=F('begin_balance_base_cur_2') + shift_2,
+                                                   end_balance_base_cur_1=F('end_balance_base_cur_1') + shift_1,
+                                                   end_balance_base_cur_2=F('end_balance_base_cur_2') + shift_2)
+
+                # 7. Остатки счета в базовых валютах
+                Account.objects.filter(pk=account_id)\
+                    .update(balance_base_cur_1=F('balance_base_cur_1') +
+                            sum(deltas[0] + deltas[2] for deltas in account_deltas.values()),
+                            balance_base_cur_2=F('balance_base_cur_2') +
+                            sum(deltas[1] + deltas[3] for deltas in account_deltas.values()))
+            for budget_id in budget_ids:
+                Budget.reset_cached_context(budget_id)
+
+            # 8. Счета, сдвиг остатков которых не поглотили операции курсовой разницы, - невалидны с операции,
+            #    на которой остановлен проход
+            Account.invalidate_balances(invalid_times)
+
+        return len(changed_transactions)
+
+    @classmethod
+    def invalidate_by_rate(cls, currency_id, date_rate):
+        """
+        Сброс валидности остатков счетов, суммы операций которых в базовых валютах могут считаться по курсу валюты
+        на дату (см. reprice_by_rate), - если пересчет по курсу не удался, эти счета пересчитает процедура пересчета
+        остатков. Остатки невалидны с начала месяца даты курса: счета в этой валюте и счета бюджетов с этой базовой
+        валютой, а также счета-отправители перемещений в них - с перемещения расход.
+        :param currency_id: id валюты, курс которой исправлен;
+        :param date_rate: дата исправленного курса.
+        """
+        begin_time = datetime(date_rate.year, date_rate.month, 1, 0, 0, 0, 0, timezone.utc)
+        invalid_times = {account_id: begin_time for account_id in
+                         Account.objects.filter(Q(currency_id=currency_id) |
+                                                Q(budget__base_currency_1_id=currency_id) |
+                                                Q(budget__base_currency_2_id=currency_id))
+                         .values_list('pk', flat=True)}
+        for sender_account_id, sender_time in Transaction.objects\
+                .filter(account_id__in=list(invalid_times), type='MO+', sender__isnull=False,
+                        time_transaction__gte=begin_time)\
+                .values_list('sender__account_id', 'sender__time_transaction'):
+            invalid_times[sender_account_id] = min(invalid_times.get(sender_account_id, sender_time), sender_time)
+        Account.invalidate_balances(invalid_times)
+
+
+class TransactionCategory(OriginalValuesMixin, models.Model):
     """
     Категории операции
     Здесь хранится разбивка суммы операции по категориям. Только для операций с типом: приход и расход.
     Также здесь есть атрибуты для расчета бюджета: суммы категории операции в базовой и дополнительной валютах,
     год и месяц бюджетного периода и проект.
+    Бюджет операции продублирован здесь для индекса расшифровки факта бюджета (категория, бюджет, год, месяц).
     """
 
     transaction = models.ForeignKey('Transaction', on_delete=models.CASCADE,
                                     related_name='transaction_categories', verbose_name='Операция')
+    budget = models.ForeignKey('Budget', on_delete=models.PROTECT, null=True, blank=True, editable=False,
+                               verbose_name='Бюджет')
     category = models.ForeignKey('Category', on_delete=models.PROTECT, verbose_name='Категория')
     amount_acc_cur = models.DecimalField(default=0.00, null=False, blank=False, max_digits=19, decimal_places=2,
                                          verbose_name='Сумма для категории в валюте счета')
@@ -1671,9 +2836,8 @@ class TransactionCategory(models.Model):
 
     original_budget_year = None
     original_budget_month = None
-    original_category = None
-    original_is_project = None
-    original_project = None
+    original_category_id = None
+    original_project_id = None
     original_amount_base_cur_1 = ftod(0.00, 2)
     original_amount_base_cur_2 = ftod(0.00, 2)
 
@@ -1691,6 +2855,9 @@ class TransactionCategory(models.Model):
     class Meta:
         verbose_name = 'Категория операции'
         verbose_name_plural = 'Категории операций'
+        indexes = (Index(fields=['category', 'budget', 'budget_year', 'budget_month', 'transaction'],
+                         name='tc__category_period_idx'),
+                   )
         ordering = ['pk']
 
     def save(self, *args, **kwargs):
@@ -1699,24 +2866,26 @@ class TransactionCategory(models.Model):
         Обновляются бюджетные регистры.
         """
 
-        # Запишем год и месяц бюджета из операции, если не указаны
+        # Запишем бюджет, год и месяц бюджета из операции, если не указаны
+        if not self.budget_id:
+            self.budget_id = self.transaction.budget_id
         if not self.budget_year:
             self.budget_year = self.transaction.budget_year
         if not self.budget_month:
             self.budget_month = self.transaction.budget_month
-        if not self.project and self.transaction.project:
-            self.project = self.transaction.project
+        if self.project_id is None and self.transaction.project_id is not None:
+            self.project_id = self.transaction.project_id
 
         # Сохраним категорию
         result = super(TransactionCategory, self).save(*args, **kwargs)
 
-        if hasattr(self, 'category') and self.category:
+        if self.category_id:
 
             # Запишем обновление в регистр бюджета
             is_budget_year_change = self.original_budget_year != self.budget_year
             is_budget_month_change = self.original_budget_month != self.budget_month
-            is_project_change = self.original_project != self.project
-            is_category_change = self.original_category != self.category
+            is_project_change = self.original_project_id != self.project_id
+            is_category_change = self.original_category_id != self.category_id
             is_key_change = is_budget_year_change or is_budget_month_change or is_project_change or is_category_change
 
             is_amount_base_cur_1_change = \
@@ -1735,15 +2904,15 @@ class TransactionCategory(models.Model):
                 if not is_key_change:
 
                     # Обновим состояние регистра (прибавим дельту), ибо ключ не поменялся
-                    if self.project:
+                    if self.project_id is not None:
                         # С проектом
                         try:
                             budget_register, created = \
                                 BudgetRegister.objects.get_or_create(budget_id=self.transaction.budget_id,
                                                                      budget_year=self.budget_year,
                                                                      budget_month=self.budget_month,
-                                                                     category_id=self.category.id,
-                                                                     project_id=self.project.id)
+                                                                     category_id=self.category_id,
+                                                                     project_id=self.project_id)
                             budget_register.actual_amount_base_cur_1 = \
                                 ftod(budget_register.actual_amount_base_cur_1, 2) - \
                                 ftod(self.original_amount_base_cur_1, 2) + \
@@ -1762,7 +2931,7 @@ class TransactionCategory(models.Model):
                                 BudgetRegister.objects.get_or_create(budget_id=self.transaction.budget_id,
                                                                      budget_year=self.budget_year,
                                                                      budget_month=self.budget_month,
-                                                                     category_id=self.category.id,
+                                                                     category_id=self.category_id,
                                                                      project_id__isnull=True)
                             budget_register.actual_amount_base_cur_1 = \
                                 ftod(budget_register.actual_amount_base_cur_1, 2) - \
@@ -1782,15 +2951,15 @@ class TransactionCategory(models.Model):
                     if self.original_budget_year and \
                             (ftod(self.original_amount_base_cur_1, 2) != ftod(0.00, 2) or
                              ftod(self.original_amount_base_cur_2, 2) != ftod(0.00, 2)):
-                        if self.original_project:
+                        if self.original_project_id is not None:
                             # С проектом
                             try:
                                 budget_register, created = \
                                     BudgetRegister.objects.get_or_create(budget_id=self.transaction.budget_id,
                                                                          budget_year=self.original_budget_year,
                                                                          budget_month=self.original_budget_month,
-                                                                         category_id=self.original_category.id,
-                                                                         project_id=self.original_project.id)
+                                                                         category_id=self.original_category_id,
+                                                                         project_id=self.original_project_id)
                                 budget_register.actual_amount_base_cur_1 = \
                                     ftod(budget_register.actual_amount_base_cur_1, 2) - \
                                     ftod(self.original_amount_base_cur_1, 2)
@@ -1807,7 +2976,7 @@ class TransactionCategory(models.Model):
                                     BudgetRegister.objects.get_or_create(budget_id=self.transaction.budget_id,
                                                                          budget_year=self.original_budget_year,
                                                                          budget_month=self.original_budget_month,
-                                                                         category_id=self.original_category.id,
+                                                                         category_id=self.original_category_id,
                                                                          project_id__isnull=True)
                                 budget_register.actual_amount_base_cur_1 = \
                                     ftod(budget_register.actual_amount_base_cur_1, 2) - \
@@ -1826,15 +2995,15 @@ class TransactionCategory(models.Model):
                     # Запишем в регистр новое состояние по новому ключу, если новые суммы не нулевые
                     if ftod(self.amount_base_cur_1, 2) != ftod(0.00, 2) or \
                             ftod(self.amount_base_cur_2, 2) != ftod(0.00, 2):
-                        if self.project:
+                        if self.project_id is not None:
                             # С проектом
                             try:
                                 budget_register, created = \
                                     BudgetRegister.objects.get_or_create(budget_id=self.transaction.budget_id,
                                                                          budget_year=self.budget_year,
                                                                          budget_month=self.budget_month,
-                                                                         category_id=self.category.id,
-                                                                         project_id=self.project.id)
+                                                                         category_id=self.category_id,
+                                                                         project_id=self.project_id)
                                 budget_register.actual_amount_base_cur_1 = \
                                     ftod(budget_register.actual_amount_base_cur_1, 2) + \
                                     ftod(self.amount_base_cur_1, 2)
@@ -1851,7 +3020,7 @@ class TransactionCategory(models.Model):
                                     BudgetRegister.objects.get_or_create(budget_id=self.transaction.budget_id,
                                                                          budget_year=self.budget_year,
                                                                          budget_month=self.budget_month,
-                                                                         category_id=self.category.id,
+                                                                         category_id=self.category_id,
                                                                          project_id__isnull=True)
                                 budget_register.actual_amount_base_cur_1 = \
                                     ftod(budget_register.actual_amount_base_cur_1, 2) + \
@@ -1869,6 +3038,9 @@ class TransactionCategory(models.Model):
                 # Не будем ничего делать с регистром бюджета, ибо или суммы нулевые, или равные суммы и ключи
                 pass
 
+        # Обновим строку поиска операции по категориям
+        Transaction.set_categories_search([self.transaction_id])
+
         return result
 
     def delete(self, *args, **kwargs):
@@ -1880,14 +3052,14 @@ class TransactionCategory(models.Model):
         # Удаляем предыдущее состояние (только если запись не новая - смотрим по notnull полю Год)
         if self.original_budget_year:
             # С проектом
-            if self.original_project:
+            if self.original_project_id is not None:
                 try:
                     budget_register = \
                         BudgetRegister.objects.get(budget_id=self.transaction.budget_id,
                                                    budget_year=self.original_budget_year,
                                                    budget_month=self.original_budget_month,
-                                                   category_id=self.original_category.id,
-                                                   project_id=self.original_project.id)
+                                                   category_id=self.original_category_id,
+                                                   project_id=self.original_project_id)
                     budget_register.actual_amount_base_cur_1 = \
                         budget_register.actual_amount_base_cur_1 - ftod(self.original_amount_base_cur_1, 2)
                     budget_register.actual_amount_base_cur_2 = \
@@ -1902,7 +3074,7 @@ class TransactionCategory(models.Model):
                         BudgetRegister.objects.get(budget_id=self.transaction.budget_id,
                                                    budget_year=self.original_budget_year,
                                                    budget_month=self.original_budget_month,
-                                                   category_id=self.original_category.id,
+                                                   category_id=self.original_category_id,
                                                    project_id__isnull=True)
                     budget_register.actual_amount_base_cur_1 = \
                         budget_register.actual_amount_base_cur_1 - ftod(self.original_amount_base_cur_1, 2)
@@ -1915,4 +3087,89 @@ class TransactionCategory(models.Model):
         # Удалим саму категорию операции
         result = super(TransactionCategory, self).delete(*args, **kwargs)
 
+        # Обновим строку поиска операции по категориям
+        Transaction.set_categories_search([self.transaction_id])
+
         return result
+
+    @classmethod
+    def set_transaction_categories(cls, parent_transaction, transaction_categories):
+        """
+        Запись нового списка категорий операции целиком (вместо сохранения категорий по одной).
+        Суммы в базовых валютах распределяются по категориям пропорционально суммам в валюте счета (последней
+        категории достается остаток, чтобы не было копеек разницы из-за округления). Бюджетные регистры меняются
+        на разницу между старым и новым списком по ключам (год, месяц, категория, проект) одним пакетом, сами
+        категории пишутся массовыми операциями - количество запросов не зависит от количества категорий.
+        ВАЖНО!!! Триггеры save()/delete() категорий операции здесь не срабатывают - их работа делается здесь.
+        :param parent_transaction: объект операции;
+        :param transaction_categories: новый список категорий операции по порядку (существующие - с pk, новые - без);
+                                       существующие категории операции, не попавшие в список, удаляются.
+        """
+        # 1. Старый список категорий операции (значения из базы)
+        old_transaction_categories = list(TransactionCategory.objects.filter(transaction_id=parent_transaction.pk)
+                                          .order_by('pk'))
+
+        # 2. Бюджет, бюджетный период и проект новых категорий берем из операции, если не указаны,
+        #    а суммы в базовых валютах распределяем по долям сумм в валюте счета
+        categories_sum = ftod(0.00, 2)
+        for transaction_category in transaction_categories:
+            transaction_category.transaction = parent_transaction
+            if not transaction_category.budget_id:
+                transaction_category.budget_id = parent_transaction.budget_id
+            if not transaction_category.budget_year:
+                transaction_category.budget_year = parent_transaction.budget_year
+            if not transaction_category.budget_month:
+                transaction_category.budget_month = parent_transaction.budget_month
+            if transaction_category.project_id is None and parent_transaction.project_id is not None:
+                transaction_category.project_id = parent_transaction.project_id
+            categories_sum = categories_sum + ftod(transaction_category.amount_acc_cur, 2)
+
+        new_sum_amount_base_cur_1 = ftod(0.00, 2)
+        new_sum_amount_base_cur_2 = ftod(0.00, 2)
+        for i, transaction_category in enumerate(transaction_categories):
+            if i < len(transaction_categories) - 1 and categories_sum:
+                # Для всех, кроме последней
+                proportion = ftod(transaction_category.amount_acc_cur, 2) / categories_sum
+                transaction_category.amount_base_cur_1 = ftod(parent_transaction.amount_base_cur_1 * proportion, 2)
+                transaction_category.amount_base_cur_2 = ftod(parent_transaction.amount_base_cur_2 * proportion, 2)
+            else:
+                # Для последней (или единственной) - остаток от суммы операции. При нулевой сумме категорий долей нет:
+                # остаток достается первой категории, остальным - ноль
+                transaction_category.amount_base_cur_1 = \
+                    ftod(parent_transaction.amount_base_cur_1 - new_sum_amount_base_cur_1, 2)
+                transaction_category.amount_base_cur_2 = \
+                    ftod(parent_transaction.amount_base_cur_2 - new_sum_amount_base_cur_2, 2)
+            new_sum_amount_base_cur_1 = new_sum_amount_base_cur_1 + transaction_category.amount_base_cur_1
+            new_sum_amount_base_cur_2 = new_sum_amount_base_cur_2 + transaction_category.amount_base_cur_2
+
+        # 3. Изменим бюджетные регистры на дельты: минус старый список, плюс новый
+        actual_deltas = {}
+        for sign, categories in ((-1, old_transaction_categories), (1, transaction_categories)):
+            for transaction_category in categories:
+                key = (transaction_category.budget_year, transaction_category.budget_month,
+                       transaction_category.category_id, transaction_category.project_id)
+                delta_1, delta_2 = actual_deltas.get(key, (ftod(0.00, 2), ftod(0.00, 2)))
+                actual_deltas[key] = (delta_1 + sign * ftod(transaction_category.amount_base_cur_1, 2),
+                                      delta_2 + sign * ftod(transaction_category.amount_base_cur_2, 2))
+        BudgetRegister.add_actual_values(parent_transaction.budget_id, actual_deltas)
+
+        # 4. Запишем категории операции: удалим не попавшие в список, изменим существующие, добавим новые
+        kept_ids = {transaction_category.pk for transaction_category in transaction_categories
+                    if transaction_category.pk}
+        deleted_ids = [transaction_category.pk for transaction_category in old_transaction_categories
+                       if transaction_category.pk not in kept_ids]
+        if deleted_ids:
+            TransactionCategory.objects.filter(pk__in=deleted_ids).delete()
+        TransactionCategory.objects.bulk_update([transaction_category
+                                                 for transaction_category in transaction_categories
+                                                 if transaction_category.pk],
+                                                ['category', 'amount_acc_cur', 'amount_base_cur_1',
+                                                 'amount_base_cur_2', 'budget_year', 'budget_month', 'project'],
+                                                batch_size=500)
+        TransactionCategory.objects.bulk_create([transaction_category
+                                                 for transaction_category in transaction_categories
+                                                 if not transaction_category.pk],
+                                                batch_size=500)
+
+        # 5. Обновим строку поиска операции по категориям
+        Transaction.set_categories_search([parent_transaction.pk])
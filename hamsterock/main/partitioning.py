@@ -0,0 +1,139 @@
+"""
+Секционирование (партиционирование) таблиц операций и категорий операций по году бюджета - только в PostgreSQL.
+
+Таблица переводится в декларативно секционированную (PARTITION BY RANGE (budget_year)): по секции на каждый год
+бюджета и секция по умолчанию для годов, секции для которых еще не созданы. Отчеты и регистры отбирают данные по году
+бюджета, поэтому запросы текущего года читают только "горячие" секции, а старые годы можно обслуживать (VACUUM) и
+архивировать (ALTER TABLE ... DETACH PARTITION) отдельно.
+
+Ограничения PostgreSQL для секционированных таблиц:
+- первичный ключ и уникальные ограничения должны включать ключ секционирования, поэтому первичный ключ становится
+  (id, budget_year), а уникальность id обеспечивается последовательностью;
+- внешние ключи, ссылающиеся на секционированную таблицу, должны включать ключ секционирования, поэтому такие ключи
+  (операция категории, операция-отправитель, операция с ошибкой пересчета на счете) удаляются,
+  ссылочная целостность для них поддерживается приложением (on_delete в Django выполняется на уровне ORM);
+- уникальные индексы (например, по операции-отправителю) заменяются обычными, уникальность связей перемещений
+  проверяется приложением под блокировкой (см. Transaction.set_movement_links).
+Для Django структура таблиц (состав и типы полей) не меняется, поэтому модели и миграции остаются прежними.
+"""
+from datetime import datetime
+
+MIN_POSTGRESQL_VERSION = 110000
+PARTITIONED_TABLES = ('main_transaction', 'main_transactioncategory')
+PARTITION_KEY = 'budget_year'
+DEFAULT_PARTITION_SUFFIX = '_default'
+
+
+def is_partitioning_supported(connection):
+    return connection.vendor == 'postgresql' and connection.pg_version >= MIN_POSTGRESQL_VERSION
+
+
+def is_partitioned(cursor, table):
+    cursor.execute('SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid '
+                   'WHERE c.oid = to_regclass(%s)', [table])
+    return cursor.fetchone() is not None
+
+
+def get_partition_name(table, year):
+    return f'{table}_y{year}'
+
+
+def get_partitions(cursor, table):
+    """
+    Имена секций таблицы
+    """
+    cursor.execute('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+                   'WHERE i.inhparent = to_regclass(%s)', [table])
+    return {row[0] for row in cursor.fetchall()}
+
+
+def get_partition_years(cursor, table, years_ahead):
+    """
+    Годы, для которых нужны секции: от минимального года в таблице (или текущего) до текущего + years_ahead
+    """
+    current_year = datetime.now().year
+    cursor.execute(f'SELECT MIN({PARTITION_KEY}), MAX({PARTITION_KEY}) FROM {table}')
+    min_year, max_year = cursor.fetchone()
+    return range(min(min_year or current_year, current_year),
+                 max(max_year or current_year, current_year) + years_ahead + 1)
+
+
+def partition_table(schema_editor, table, years_ahead=1):
+    """
+    Перевод таблицы в секционированную по году бюджета с переносом существующих данных.
+    Выполняется в одной транзакции: индексы, внешние ключи на несекционированные таблицы и последовательность
+    первичного ключа воссоздаются на новой таблице.
+    Возвращает список удаленных внешних ключей других таблиц, ссылавшихся на эту таблицу.
+    """
+    qn = schema_editor.quote_name
+    old_table = f'{table}_unpartitioned'
+    sequence = f'{table}_id_seq'
+    with schema_editor.connection.cursor() as cursor:
+
+        # 1. Запомним определения индексов и внешних ключей таблицы, а также ссылки на нее из других таблиц
+        cursor.execute('SELECT pg_get_indexdef(ix.indexrelid), ix.indisunique FROM pg_index ix '
+                       'WHERE ix.indrelid = to_regclass(%s) AND NOT ix.indisprimary', [table])
+        indexes = [index_def.replace('CREATE UNIQUE INDEX', 'CREATE INDEX', 1) if is_unique else index_def
+                   for index_def, is_unique in cursor.fetchall()]
+        cursor.execute("SELECT conname, pg_get_constraintdef(oid), confrelid::regclass::text FROM pg_constraint "
+                       "WHERE conrelid = to_regclass(%s) AND contype = 'f'", [table])
+        foreign_keys = [(name, constraint_def) for name, constraint_def, ref_table in cursor.fetchall()
+                        if ref_table not in PARTITIONED_TABLES and not is_partitioned(cursor, ref_table)]
+        cursor.execute("SELECT conrelid::regclass::text || '.' || conname FROM pg_constraint "
+                       "WHERE confrelid = to_regclass(%s) AND conrelid <> confrelid AND contype = 'f'", [table])
+        dropped_references = [row[0] for row in cursor.fetchall()]
+        years = get_partition_years(cursor, table, years_ahead)
+
+    # 2. Новая секционированная таблица с той же структурой и секции по годам
+    schema_editor.execute(f'ALTER TABLE {qn(table)} RENAME TO {qn(old_table)}')
+    schema_editor.execute(f'CREATE TABLE {qn(table)} (LIKE {qn(old_table)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+                          f'PARTITION BY RANGE ({qn(PARTITION_KEY)})')
+    schema_editor.execute(f'ALTER TABLE {qn(table)} ADD PRIMARY KEY ("id", {qn(PARTITION_KEY)})')
+    for year in years:
+        schema_editor.execute(f'CREATE TABLE {qn(get_partition_name(table, year))} PARTITION OF {qn(table)} '
+                              f'FOR VALUES FROM ({year}) TO ({year + 1})')
+    schema_editor.execute(f'CREATE TABLE {qn(table + DEFAULT_PARTITION_SUFFIX)} PARTITION OF {qn(table)} DEFAULT')
+
+    # 3. Перенос данных, старая таблица удаляется вместе со ссылками на нее и своей последовательностью
+    schema_editor.execute(f'INSERT INTO {qn(table)} SELECT * FROM {qn(old_table)}')
+    schema_editor.execute(f'DROP TABLE {qn(old_table)} CASCADE')
+
+    # 4. Последовательность первичного ключа, индексы и внешние ключи на новой таблице
+    schema_editor.execute(f'CREATE SEQUENCE {qn(sequence)} OWNED BY {qn(table)}."id"')
+    schema_editor.execute(f"SELECT setval('{sequence}', COALESCE(MAX(\"id\"), 0) + 1, false) FROM {qn(table)}")
+    schema_editor.execute(f"ALTER TABLE {qn(table)} ALTER COLUMN \"id\" SET DEFAULT nextval('{sequence}')")
+    for index_def in indexes:
+        schema_editor.execute(index_def)
+    for name, constraint_def in foreign_keys:
+        schema_editor.execute(f'ALTER TABLE {qn(table)} ADD CONSTRAINT {qn(name)} {constraint_def}')
+
+    return dropped_references
+
+
+def create_partitions(schema_editor, table, years_ahead=1):
+    """
+    Создание недостающих секций по годам для уже секционированной таблицы.
+    Строки этих годов, попавшие в секцию по умолчанию, переносятся в новые секции.
+    Возвращает список созданных секций.
+    """
+    qn = schema_editor.quote_name
+    default_partition = table + DEFAULT_PARTITION_SUFFIX
+    with schema_editor.connection.cursor() as cursor:
+        partitions = get_partitions(cursor, table)
+        years = get_partition_years(cursor, table, years_ahead)
+
+    created_partitions = []
+    for year in years:
+        partition = get_partition_name(table, year)
+        if partition in partitions:
+            continue
+        schema_editor.execute(f'CREATE TABLE {qn(partition)} '
+                              f'(LIKE {qn(table)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+        schema_editor.execute(f'INSERT INTO {qn(partition)} SELECT * FROM {qn(default_partition)} '
+                              f'WHERE {qn(PARTITION_KEY)} = {year}')
+        schema_editor.execute(f'DELETE FROM {qn(default_partition)} WHERE {qn(PARTITION_KEY)} = {year}')
+        schema_editor.execute(f'ALTER TABLE {qn(table)} ATTACH PARTITION {qn(partition)} '
+                              f'FOR VALUES FROM ({year}) TO ({year + 1})')
+        created_partitions.append(partition)
+
+    return created_partitions
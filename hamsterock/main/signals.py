@@ -4,43 +4,72 @@ from django.db.models.signals import post_init
 from .models import *
 
 
+def set_original_values(instance, attnames):
+    """
+    Запоминание исходных значений атрибутов объекта в original_ атрибутах (по сигналу post_init).
+    Значения берутся прямо из __dict__ объекта: для внешних ключей запоминается *_id, поэтому связанные объекты
+    из базы не запрашиваются. Отложенные (deferred) поля пропускаются и не догружаются - их original_ атрибут
+    заполняется при догрузке поля (см. OriginalValuesMixin). Суммы к Decimal не приводятся - это делают триггеры
+    save()/delete() при сравнении. Так загрузка объектов на чтение (списки, отчеты, пересчеты) за отслеживание
+    изменений не платит.
+    :param instance: объект модели;
+    :param attnames: имена атрибутов (для внешних ключей - с суффиксом _id).
+    """
+    deferred_fields = instance.get_deferred_fields()
+    values = instance.__dict__
+    for attname in attnames:
+        if attname not in deferred_fields:
+            setattr(instance, 'original_' + attname, values[attname])
+
+
 @receiver(signal=models.signals.post_init, sender=Account)
 def post_init_account_handler(instance, **kwargs):
-    instance.original_initial_balance = ftod(instance.initial_balance, 2)
-    instance.original_is_balances_valid = instance.is_balances_valid
-    instance.original_balances_valid_until = instance.balances_valid_until
-    instance.original_type = instance.type
+    set_original_values(instance, ('initial_balance', 'is_balances_valid', 'balances_valid_until', 'type'))
 
 
 @receiver(signal=models.signals.post_init, sender=BudgetObject)
 def post_init_budget_object_handler(instance, **kwargs):
-    instance.original_name = instance.name
+    set_original_values(instance, ('name',))
+
+
+@receiver(signal=models.signals.post_init, sender=Category)
+def post_init_category_handler(instance, **kwargs):
+    set_original_values(instance, ('name',))
 
 
 @receiver(signal=models.signals.post_init, sender=Transaction)
 def post_init_transaction_handler(instance, **kwargs):
-    instance.original_time_transaction = instance.time_transaction
-    instance.original_amount_acc_cur = ftod(instance.amount_acc_cur, 2)
-    instance.original_amount_base_cur_1 = ftod(instance.amount_base_cur_1, 2)
-    instance.original_amount_base_cur_2 = ftod(instance.amount_base_cur_2, 2)
-    instance.original_budget_year = instance.budget_year
-    instance.original_budget_month = instance.budget_month
-    instance.original_sender = instance.sender
-    instance.original_project = instance.project
+    set_original_values(instance, ('time_transaction', 'amount_acc_cur', 'amount_base_cur_1', 'amount_base_cur_2',
+                                   'budget_year', 'budget_month', 'sender_id', 'project_id'))
 
 
 @receiver(signal=models.signals.post_init, sender=TransactionCategory)
 def post_init_transaction_category_handler(instance, **kwargs):
-    instance.original_budget_year = instance.budget_year
-    instance.original_budget_month = instance.budget_month
-    if hasattr(instance, 'category'):
-        instance.original_category = instance.category
-    else:
-        instance.original_category = None
-    instance.original_is_project = 1 if instance.project is not None else 0
-    if hasattr(instance, 'project'):
-        instance.original_project = instance.project
-    else:
-        instance.original_project = None
-    instance.original_amount_base_cur_1 = ftod(instance.amount_base_cur_1, 2)
-    instance.original_amount_base_cur_2 = ftod(instance.amount_base_cur_2, 2)
+    set_original_values(instance, ('budget_year', 'budget_month', 'category_id', 'project_id',
+                                   'amount_base_cur_1', 'amount_base_cur_2'))
+
+
+@receiver(signal=models.signals.post_delete, sender=Category)
+def post_delete_category_handler(instance, **kwargs):
+    # Удаление категории бюджета (в том числе каскадное, при удалении бюджетного объекта) сбрасывает
+    # закэшированную карту категорий с бюджетными объектами
+    if instance.budget_id is not None:
+        Category.reset_objects_map(instance.budget_id)
+
+
+# Удаления учитываются в сводке бюджета по сигналам, а не в delete() моделей - так учитываются и удаления наборов
+# записей (QuerySet.delete()), для которых delete() объектов не вызывается (см. BudgetSummary.deferred_counts)
+@receiver(signal=models.signals.post_delete, sender=Account)
+def post_delete_account_handler(instance, **kwargs):
+    BudgetSummary.change_counts(instance.budget_id, accounts=-1)
+
+
+@receiver(signal=models.signals.post_delete, sender=Transaction)
+def post_delete_transaction_handler(instance, **kwargs):
+    BudgetSummary.change_counts(instance.budget_id, transactions=-1)
+
+
+@receiver(signal=models.signals.post_delete, sender=BudgetRegister)
+def post_delete_budget_register_handler(instance, **kwargs):
+    BudgetSummary.remove_register(instance.budget_id,
+                                  BudgetSummary.get_period(instance.budget_year, instance.budget_month))
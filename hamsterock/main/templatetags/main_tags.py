@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 from django import template
 
 from ..models import *
@@ -59,6 +61,17 @@ def url_replace(request, field, value):
     return d.urlencode()
 
 
+@register.simple_tag
+def url_page(request, page, key_field=None, key=None):
+    d = request.GET.copy()
+    d['page'] = page
+    d.pop('after', None)
+    d.pop('before', None)
+    if key_field and key:
+        d[key_field] = key
+    return d.urlencode()
+
+
 @register.inclusion_tag('main/menu_unauthenticated.html')
 def show_unauthenticated_left_menu(selected_menu=None):
     return {'selected_menu': selected_menu}
@@ -112,6 +125,12 @@ def addstr(value, term):
     return value + str(term)
 
 
+@lru_cache(maxsize=None)
+def get_currency_iso_code(currency_id):
+    # ISO коды валют не меняются - кэшируем на время жизни процесса
+    return Currency.objects.get(pk=currency_id).iso_code
+
+
 @register.simple_tag(name='getcats')
 def get_categories(tr=None):
     class CategoriesSummary:
@@ -122,13 +141,14 @@ def get_categories(tr=None):
             self.sum_amount = sum_amount
             self.category_list = category_list
 
-    tks = TransactionCategory.objects.filter(transaction_id=tr.pk)
+    # Категории берутся из предзагрузки списка (Transaction.get_categories_prefetch()), без нее - запросом
+    tks = tr.transaction_categories.all()
     cq = len(tks)
     sa = ftod(0.00, 2)
     cl = []
     for tk in tks:
         sa = sa + ftod(tk.amount_acc_cur, 2)
-        amount = tk.amount_acc_cur if tk.transaction.type in ('CRE', 'MO+', 'ED+') else -tk.amount_acc_cur
+        amount = tk.amount_acc_cur if tr.type in ('CRE', 'MO+', 'ED+') else -tk.amount_acc_cur
         cl.append(tk.category.name + ': ' + number_format(amount, decimal_pos=2, use_l10n=True, force_grouping=True))
     return CategoriesSummary(cq, sa, cl)
 
@@ -143,23 +163,24 @@ def get_categories_extra(tr, num_base_currency):
             self.sum_amount = sum_amount
             self.category_list = category_list
 
-    tks = TransactionCategory.objects.filter(transaction_id=tr.pk)
+    # Категории берутся из предзагрузки списка (Transaction.get_categories_prefetch()), без нее - запросом
+    tks = tr.transaction_categories.all()
     cq = len(tks)
     sa = ftod(0.00, 2)
     cl = []
     for tk in tks:
         sa = sa + ftod(tk.amount_acc_cur, 2)
-        amount = tk.amount_acc_cur if tk.transaction.type in ('CRE', 'MO+', 'ED+') else -tk.amount_acc_cur
+        amount = tk.amount_acc_cur if tr.type in ('CRE', 'MO+', 'ED+') else -tk.amount_acc_cur
         if num_base_currency == 1:
             amount_base = tk.amount_base_cur_1 \
-                if tk.transaction.type in ('CRE', 'MO+', 'ED+') \
+                if tr.type in ('CRE', 'MO+', 'ED+') \
                 else -tk.amount_base_cur_1
-            cur_iso = Currency.objects.get(pk=DEFAULT_BASE_CURRENCY_1).iso_code
+            cur_iso = get_currency_iso_code(DEFAULT_BASE_CURRENCY_1)
         else:
             amount_base = tk.amount_base_cur_2 \
-                if tk.transaction.type in ('CRE', 'MO+', 'ED+') \
+                if tr.type in ('CRE', 'MO+', 'ED+') \
                 else -tk.amount_base_cur_2
-            cur_iso = Currency.objects.get(pk=DEFAULT_BASE_CURRENCY_2).iso_code
+            cur_iso = get_currency_iso_code(DEFAULT_BASE_CURRENCY_2)
         cl.append(tk.category.name + ': ' + number_format(amount, decimal_pos=2, use_l10n=True, force_grouping=True) +
                   ' (' + number_format(amount_base, decimal_pos=2, use_l10n=True, force_grouping=True) + ' ' +
                   cur_iso + ')')
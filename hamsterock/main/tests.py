@@ -1,3 +1,588 @@
-from django.test import TestCase
+from datetime import datetime, date, timedelta, timezone
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib import admin
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.color import no_style
+from django.db import connection, transaction, DataError
+from django.db.migrations.executor import MigrationExecutor
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+
+from .models import *
+from .partitioning import *
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class BudgetTestCase(TestCase):
+    """
+    Бюджет в рублях (дополнительная валюта - доллары) с двумя рублевыми счетами и деревом категорий.
+    Кэш - в памяти, чтобы тесты не трогали файловый кэш проекта.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.rub = Currency.objects.create(id=DEFAULT_BASE_CURRENCY_1, name='Рубль', iso_code='RUB',
+                                          numeric_code='643', entity='RU')
+        cls.usd = Currency.objects.create(id=DEFAULT_BASE_CURRENCY_2, name='Доллар', iso_code='USD',
+                                          numeric_code='840', entity='US')
+        cls.user = User.objects.create_user('user', password='password')
+        cls.budget = Budget.objects.create(name='Бюджет', user=cls.user, base_currency_1=cls.rub,
+                                           base_currency_2=cls.usd, secret_key='secret')
+        Profile.objects.create(user=cls.user, budget=cls.budget)
+        cls.income = Category.objects.create(id=DEFAULT_INC_CATEGORY, name='Доходы', type='INC', item='01.')
+        cls.expense = Category.objects.create(id=DEFAULT_EXP_CATEGORY, name='Расходы', type='EXP', item='02.')
+        Category.objects.create(id=POSITIVE_EXCHANGE_DIFFERENCE, name='Курсовая разница+', type='INC',
+                                item='01.99.', parent=cls.income)
+        Category.objects.create(id=NEGATIVE_EXCHANGE_DIFFERENCE, name='Курсовая разница-', type='EXP',
+                                item='02.99.', parent=cls.expense)
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [Currency, Category]):
+                cursor.execute(sql)
+        cls.salary = Category.objects.create(name='Зарплата', type='INC', item='01.01.', parent=cls.income)
+        cls.food = Category.objects.create(name='Еда', type='EXP', item='02.01.', parent=cls.expense)
+        cls.transport = Category.objects.create(name='Транспорт', type='EXP', item='02.02.', parent=cls.expense)
+        cls.account_1 = Account.objects.create(budget=cls.budget, name='Карта', user=cls.user, currency=cls.rub,
+                                               type='DEC')
+        cls.account_2 = Account.objects.create(budget=cls.budget, name='Кошелек', user=cls.user, currency=cls.rub,
+                                               type='WAL')
+        CurrencyRate.objects.create(currency_1=cls.rub, currency_2=cls.usd, date_rate=date(2022, 1, 1),
+                                    rate=ftod(0.01, 9))
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def create_transaction(self, account, transaction_type, amount, time_transaction, category=None):
+        """
+        Создание операции в валюте счета (и ее категории - для прихода и расхода)
+        """
+        new_transaction = Transaction(budget=account.budget, account=account, type=transaction_type,
+                                      time_transaction=time_transaction, amount_acc_cur=ftod(amount, 2),
+                                      currency=account.currency, amount=ftod(amount, 2),
+                                      budget_year=time_transaction.year, budget_month=time_transaction.month)
+        new_transaction.save()
+        if category:
+            TransactionCategory(transaction=new_transaction, category=category,
+                                amount_acc_cur=ftod(amount, 2)).save()
+        return new_transaction
+
+
+class AccountTransactionsForJoinTests(BudgetTestCase):
+
+    def test_candidates_ranking_and_pagination(self):
+        # Подходящих приходов больше, чем помещается на страницу, поэтому автоматическая связь не устанавливается
+        sender_time = datetime(2023, 1, 5, 10, 0, tzinfo=timezone.utc)
+        receivers = [self.create_transaction(self.account_2, 'MO+', 100, sender_time + timedelta(minutes=i + 1))
+                     for i in range(15)]
+        self.create_transaction(self.account_2, 'MO+', 100, sender_time + DEFAULT_TIME_DELTA + timedelta(days=1))
+        self.create_transaction(self.account_2, 'MO+', 70, sender_time + timedelta(minutes=30))
+        sender = self.create_transaction(self.account_1, 'MO-', -100, sender_time)
+        self.assertFalse(Transaction.objects.filter(sender=sender).exists())
+
+        candidates = list(Transaction.get_movement_candidates(sender))
+        self.assertEqual(candidates, receivers)
+
+        url = reverse('account_transactions_for_join', args=[sender.pk, 'account_transactions'])
+        first_page = self.client.get(url)
+        second_page = self.client.get(url, {'page': 2})
+        self.assertTrue(first_page.context['is_movement_candidates'])
+        self.assertTrue(second_page.context['is_movement_candidates'])
+        self.assertEqual(list(first_page.context['transactions']) + list(second_page.context['transactions']),
+                         receivers)
+
+        filtered_page = self.client.get(url, {'amount_inc_min': 50})
+        self.assertFalse(filtered_page.context['is_movement_candidates'])
+
+
+class CategoryWithObjectTests(BudgetTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.person = BudgetObject.objects.create(budget=self.budget, object_type='Персона', name='Вася')
+
+    def test_created_category_is_found_in_cached_map(self):
+        category_id = Category.get_category_with_object(self.budget, self.food.pk, self.person.pk, self.user)
+        category = Category.objects.get(pk=category_id)
+        self.assertEqual((category.name, category.item, category.budget_object_id),
+                         ('Еда (Вася)', '02.01.a', self.person.pk))
+        with self.assertNumQueries(0):
+            self.assertEqual(Category.get_category_with_object(self.budget, self.food.pk, self.person.pk, self.user),
+                             category_id)
+
+        other_person = BudgetObject.objects.create(budget=self.budget, object_type='Персона', name='Петя')
+        other_category_id = Category.get_category_with_object(self.budget, self.food.pk, other_person.pk, self.user)
+        self.assertEqual(Category.objects.get(pk=other_category_id).item, '02.01.b')
+
+    def test_existing_category_with_the_same_name_is_returned(self):
+        # Категория с тем же наименованием, но без бюджетного объекта - в карте ее нет, но создавать новую нельзя
+        existing_category = Category.objects.create(budget=self.budget, name='Еда (Вася)', type='EXP', item='02.01.a',
+                                                    parent=self.expense)
+        self.assertEqual(Category.get_category_with_object(self.budget, self.food.pk, self.person.pk, self.user),
+                         existing_category.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(Category.get_category_with_object(self.budget, self.food.pk, self.person.pk, self.user),
+                             existing_category.pk)
+        self.assertEqual(Category.objects.filter(budget=self.budget).count(), 1)
+
+    def test_budget_object_rename_renames_its_categories(self):
+        category_id = Category.get_category_with_object(self.budget, self.food.pk, self.person.pk, self.user)
+        # Категория бюджета с той же статьей, что и у базовой, не должна подменять базовую категорию
+        Category.objects.create(budget=self.budget, name='Еда бюджета', type='EXP', item='02.01.',
+                                parent=self.expense)
+        self.person.name = 'Василий'
+        self.person.save()
+        self.assertEqual(Category.objects.get(pk=category_id).name, 'Еда (Василий)')
+
+
+class TransactionSearchTests(BudgetTestCase):
+
+    def test_search_does_not_match_across_fields(self):
+        search_transaction = self.create_transaction(self.account_1, 'DEB', -10,
+                                                     datetime(2023, 1, 5, 10, 0, tzinfo=timezone.utc), self.food)
+        search_transaction.place = 'Москва'
+        search_transaction.description = 'Кофе'
+        search_transaction.save()
+        transactions = Transaction.objects.filter(budget=self.budget)
+        self.assertTrue(transactions.filter(description_search__contains=Transaction.get_search_text('ква')).exists())
+        self.assertFalse(transactions.filter(description_search__contains=Transaction.get_search_text('ква ко'))
+                         .exists())
+
+
+class TransactionCategoriesTests(BudgetTestCase):
+
+    def test_zero_categories_sum_is_split(self):
+        zero_transaction = self.create_transaction(self.account_1, 'DEB', 0,
+                                                   datetime(2023, 1, 5, 10, 0, tzinfo=timezone.utc))
+        TransactionCategory.set_transaction_categories(
+            Transaction.objects.get(pk=zero_transaction.pk),
+            [TransactionCategory(category=category, amount_acc_cur=ftod(0, 2))
+             for category in (self.food, self.transport)])
+        self.assertEqual(list(TransactionCategory.objects.filter(transaction=zero_transaction).order_by('pk')
+                              .values_list('category_id', 'amount_base_cur_1', 'amount_base_cur_2')),
+                         [(self.food.pk, ftod(0, 2), ftod(0, 2)), (self.transport.pk, ftod(0, 2), ftod(0, 2))])
+
+
+class OriginalValuesTests(BudgetTestCase):
+
+    def test_saving_deferred_instances_does_not_change_balances(self):
+        self.create_transaction(self.account_1, 'DEB', -10, datetime(2023, 1, 5, 10, 0, tzinfo=timezone.utc),
+                                self.food)
+        self.account_1.refresh_from_db()
+        self.account_1.initial_balance = ftod(100, 2)
+        self.account_1.save()
+        account = Account.objects.get(pk=self.account_1.pk)
+        registers = list(BudgetRegister.objects.filter(budget=self.budget).order_by('pk')
+                         .values_list('actual_amount_base_cur_1', 'actual_amount_base_cur_2'))
+
+        deferred_transaction = Transaction.objects.only('id', 'description').get(account=account)
+        deferred_transaction.description = 'Кофе'
+        deferred_transaction.save()
+        deferred_account = Account.objects.only('id', 'name').get(pk=account.pk)
+        deferred_account.name = 'Карта 2'
+        deferred_account.save()
+
+        saved_account = Account.objects.get(pk=account.pk)
+        self.assertEqual((saved_account.balance, saved_account.balance_base_cur_1, saved_account.balance_base_cur_2),
+                         (account.balance, account.balance_base_cur_1, account.balance_base_cur_2))
+        self.assertEqual(list(BudgetRegister.objects.filter(budget=self.budget).order_by('pk')
+                              .values_list('actual_amount_base_cur_1', 'actual_amount_base_cur_2')), registers)
+
+
+class ReferencesDeleteGuardTests(BudgetTestCase):
+
+    def test_bulk_delete_skips_referenced_objects(self):
+        unused_currency = Currency.objects.create(name='Евро', iso_code='EUR', numeric_code='978', entity='EU')
+        request = RequestFactory().post('/admin/main/currency/')
+        request._messages = CookieStorage(request)
+        admin.site._registry[Currency].delete_queryset(request, Currency.objects.all())
+        self.assertEqual(set(Currency.objects.values_list('pk', flat=True)), {self.rub.pk, self.usd.pk})
+        self.assertFalse(Currency.objects.filter(pk=unused_currency.pk).exists())
+
+
+class BudgetSummaryTests(BudgetTestCase):
+
+    def assertSummaryIsActual(self):
+        summary = BudgetSummary.get_summary(self.budget.pk)
+        counts = (summary.transactions_count, summary.accounts_count, summary.registers_count)
+        recalculated_summary = BudgetSummary.recalculate(self.budget.pk)
+        self.assertEqual(counts, (recalculated_summary.transactions_count, recalculated_summary.accounts_count,
+                                  recalculated_summary.registers_count))
+        return summary
+
+    def test_deferred_counts_are_written_once(self):
+        summary = self.assertSummaryIsActual()
+        time_transaction = datetime(2023, 1, 5, 10, 0, tzinfo=timezone.utc)
+        with BudgetSummary.deferred_counts():
+            for i in range(3):
+                self.create_transaction(self.account_1, 'MO-', -10, time_transaction + timedelta(minutes=i))
+            self.assertEqual(BudgetSummary.get_summary(self.budget.pk).transactions_count, summary.transactions_count)
+        self.assertEqual(BudgetSummary.get_summary(self.budget.pk).transactions_count, summary.transactions_count + 3)
+        self.assertSummaryIsActual()
+
+        # При исключении дельты блока отбрасываются вместе с откатом транзакции
+        with self.assertRaises(ValueError):
+            with transaction.atomic(), BudgetSummary.deferred_counts():
+                self.create_transaction(self.account_1, 'MO-', -10, time_transaction + timedelta(hours=1))
+                raise ValueError
+        self.assertSummaryIsActual()
+
+    def test_queryset_delete_changes_counts(self):
+        time_transaction = datetime(2023, 1, 5, 10, 0, tzinfo=timezone.utc)
+        for i in range(3):
+            self.create_transaction(self.account_2, 'MO-', -10, time_transaction + timedelta(minutes=i))
+        self.assertEqual(self.assertSummaryIsActual().transactions_count, 3)
+        Transaction.objects.filter(account=self.account_2).delete()
+        Account.objects.filter(pk=self.account_2.pk).delete()
+        summary = self.assertSummaryIsActual()
+        self.assertEqual((summary.transactions_count, summary.accounts_count), (0, 1))
+
+
+    def test_budget_with_registers_is_deleted(self):
+        other_budget = Budget.objects.create(name='Другой', user=self.user, base_currency_1=self.rub,
+                                             base_currency_2=self.usd, secret_key='other')
+        for month in (1, 2, 3):
+            BudgetRegister.objects.create(budget=other_budget, budget_year=2023, budget_month=month,
+                                          category=self.food)
+        self.assertEqual(BudgetSummary.get_summary(other_budget.pk).registers_count, 3)
+        other_budget.delete()
+        with connection.cursor() as cursor:
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        self.assertFalse(BudgetSummary.objects.filter(budget_id=other_budget.pk).exists())
+        self.assertFalse(BudgetRegister.objects.filter(budget_id=other_budget.pk).exists())
+
+
+class BalancesTestCase(BudgetTestCase):
+    """
+    Долларовый счет в рублевом бюджете с операциями двух последних завершенных месяцев и курсами на конец месяцев
+    """
+
+    def setUp(self):
+        super().setUp()
+        today = datetime.utcnow().date()
+        self.month_ends = []
+        month_end = date(today.year, today.month, 1) - timedelta(days=1)
+        for i in range(3):
+            self.month_ends.insert(0, month_end)
+            CurrencyRate.objects.create(currency_1=self.rub, currency_2=self.usd, date_rate=month_end,
+                                        rate=ftod(0.0130 + month_end.month * 0.0001, 9))
+            month_end = date(month_end.year, month_end.month, 1) - timedelta(days=1)
+        self.account_3 = Account.objects.create(budget=self.budget, name='Доллары', user=self.user,
+                                                currency=self.usd, type='DEC', initial_balance=ftod(1000, 2))
+
+        # Операции двух последних завершенных месяцев: приход, расход по двум категориям и перемещение в рубли
+        def get_time(month_end, day):
+            return datetime(month_end.year, month_end.month, day, 12, 0, tzinfo=timezone.utc)
+        self.create_transaction(self.account_3, 'CRE', 500, get_time(self.month_ends[1], 10), self.salary)
+        self.create_transaction(self.account_3, 'DEB', -120, get_time(self.month_ends[2], 5))
+        TransactionCategory(transaction=Transaction.objects.get(account=self.account_3, type='DEB'),
+                            category=self.food, amount_acc_cur=ftod(-70, 2)).save()
+        TransactionCategory(transaction=Transaction.objects.get(account=self.account_3, type='DEB'),
+                            category=self.transport, amount_acc_cur=ftod(-50, 2)).save()
+        sender = self.create_transaction(self.account_3, 'MO-', -100, get_time(self.month_ends[2], 10))
+        receiver = Transaction(budget=self.budget, account=self.account_1, type='MO+',
+                               time_transaction=get_time(self.month_ends[2], 10), amount_acc_cur=ftod(7000, 2),
+                               currency=self.usd, amount=ftod(100, 2), budget_year=self.month_ends[2].year,
+                               budget_month=self.month_ends[2].month, sender=sender)
+        receiver.save()
+        self.create_transaction(self.account_1, 'DEB', -1000, get_time(self.month_ends[2], 20), self.food)
+
+    def recalculate_balances(self):
+        Account.objects.filter(budget=self.budget).update(is_balances_valid=False,
+                                                          balances_valid_until=MIN_TRANSACTION_DATETIME)
+        response = self.client.get(reverse('balances_recalculation', args=[self.budget.pk, 'home']))
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Account.objects.filter(budget=self.budget, is_balances_valid=False).exists())
+
+    def get_snapshot(self):
+        return (list(Transaction.objects.filter(budget=self.budget).order_by('account_id', 'time_transaction', 'id')
+                     .values_list('account_id', 'type', 'time_transaction', 'rate_base_cur_1', 'rate_base_cur_2',
+                                  'amount_base_cur_1', 'amount_base_cur_2', 'balance_base_cur_1',
+                                  'balance_base_cur_2')),
+                list(TransactionCategory.objects.filter(budget=self.budget).order_by('pk')
+                     .values_list('pk', 'amount_base_cur_1', 'amount_base_cur_2')),
+                sorted(register for register in BudgetRegister.objects.filter(budget=self.budget)
+                       .values_list('budget_year', 'budget_month', 'category_id', 'project_id',
+                                    'actual_amount_base_cur_1', 'actual_amount_base_cur_2')
+                       if register[4] or register[5]),
+                list(AccountTurnover.objects.filter(budget=self.budget).order_by('account_id', 'budget_period')
+                     .values_list('account_id', 'budget_period', 'begin_balance_base_cur_1',
+                                  'credit_turnover_base_cur_1', 'debit_turnover_base_cur_1', 'end_balance_base_cur_1',
+                                  'begin_balance_base_cur_2', 'end_balance_base_cur_2')),
+                list(Account.objects.filter(budget=self.budget).order_by('pk')
+                     .values_list('pk', 'balance_base_cur_1', 'balance_base_cur_2')))
+
+
+class RepriceByRateTests(BalancesTestCase):
+
+    def test_reprice_matches_balances_recalculation(self):
+        self.recalculate_balances()
+        for month_end, rate in [(self.month_ends[1], 0.0200), (self.month_ends[0], 0.0090)]:
+            CurrencyRate.objects.filter(currency_1=self.rub, currency_2=self.usd, date_rate=month_end)\
+                .update(rate=ftod(rate, 9))
+            self.assertGreater(Transaction.reprice_by_rate(self.rub.pk, month_end), 0)
+            self.assertFalse(Account.objects.filter(budget=self.budget, is_balances_valid=False).exists())
+            repriced_snapshot = self.get_snapshot()
+            self.recalculate_balances()
+            self.assertEqual(repriced_snapshot, self.get_snapshot())
+
+    def test_not_absorbed_shift_invalidates_balances(self):
+        self.recalculate_balances()
+        # Без операций курсовой разницы после затронутого месяца сдвиг остатков поглотить нечем
+        Transaction.objects.filter(account=self.account_3, type__in=['ED+', 'ED-'],
+                                   time_transaction__gt=datetime(self.month_ends[2].year, self.month_ends[2].month, 1,
+                                                                 tzinfo=timezone.utc)).delete()
+        today = datetime.utcnow().date()
+        later_transaction = self.create_transaction(self.account_3, 'DEB', -5,
+                                                    datetime(today.year, today.month, 1, 12, 0, tzinfo=timezone.utc))
+        Account.objects.filter(pk=self.account_3.pk).update(is_balances_valid=True,
+                                                             balances_valid_until=MAX_TRANSACTION_DATETIME)
+        CurrencyRate.objects.filter(currency_1=self.rub, currency_2=self.usd, date_rate=self.month_ends[1])\
+            .update(rate=ftod(0.0200, 9))
+        Transaction.reprice_by_rate(self.rub.pk, self.month_ends[1])
+        self.account_3.refresh_from_db()
+        self.assertFalse(self.account_3.is_balances_valid)
+        self.assertEqual(self.account_3.balances_valid_until, later_transaction.time_transaction)
+
+    def test_failed_reprice_invalidates_balances(self):
+        self.recalculate_balances()
+        rate = CurrencyRate.objects.get(currency_1=self.rub, currency_2=self.usd, date_rate=self.month_ends[1])
+        rate.rate = ftod(0.0200, 9)
+        request = RequestFactory().post('/admin/main/currencyrate/')
+        request._messages = CookieStorage(request)
+        with mock.patch.object(Transaction, 'reprice_by_rate', side_effect=DataError('ошибка')):
+            admin.site._registry[CurrencyRate].save_model(request, rate, None, False)
+        self.assertEqual(CurrencyRate.objects.get(pk=rate.pk).rate, ftod(0.0200, 9))
+        begin_time = datetime(self.month_ends[1].year, self.month_ends[1].month, 1, tzinfo=timezone.utc)
+        self.assertEqual(list(Account.objects.filter(budget=self.budget).order_by('pk')
+                              .values_list('is_balances_valid', 'balances_valid_until')),
+                         [(False, begin_time)] * 3)
+        self.assertIn('ошибка', str(list(request._messages)[0]))
+
+
+class BalancesRecalculationTests(BalancesTestCase):
+
+    def test_interrupted_recalculation_resumes_from_last_chunk(self):
+        self.recalculate_balances()
+        snapshot = self.get_snapshot()
+        transactions_count = Transaction.objects.filter(budget=self.budget).count()
+
+        # Пересчет с нуля порциями по 7 операций, на 20-й операции - ошибка: записаны две порции
+        Account.objects.filter(budget=self.budget).update(is_balances_valid=False,
+                                                          balances_valid_until=MIN_TRANSACTION_DATETIME)
+        Transaction.objects.filter(budget=self.budget).update(balance_base_cur_1=ftod(-12345, 2))
+        original_save = Transaction.save
+        saved_ids = []
+
+        def failing_save(transaction_self, *args, **kwargs):
+            saved_ids.append(transaction_self.pk)
+            if len(saved_ids) == 20:
+                raise DataError('ошибка')
+            return original_save(transaction_self, *args, **kwargs)
+
+        url = reverse('balances_recalculation', args=[self.budget.pk, 'home'])
+        with mock.patch('main.views.BALANCES_RECALCULATION_CHUNK_SIZE', 7), \
+                mock.patch('main.views.BALANCES_RECALCULATION_CHUNK_MILLISECONDS', 10 ** 9), \
+                mock.patch.object(Transaction, 'save', failing_save):
+            self.client.get(url)
+        self.assertEqual(Transaction.objects.filter(budget=self.budget)
+                         .exclude(balance_base_cur_1=ftod(-12345, 2)).count(), 14)
+        failed_account = Account.objects.get(budget=self.budget, balances_error__isnull=False)
+        self.assertEqual(failed_account.balances_error, 'ошибка')
+        self.assertEqual(failed_account.balances_error_transaction_id, saved_ids[-1])
+        self.assertTrue(Account.objects.filter(budget=self.budget, is_balances_valid=False).exists())
+
+        # Повторный пересчет продолжается с последней записанной порции и дает тот же результат
+        saved_ids.clear()
+
+        def counting_save(transaction_self, *args, **kwargs):
+            saved_ids.append(transaction_self.pk)
+            return original_save(transaction_self, *args, **kwargs)
+
+        with mock.patch.object(Transaction, 'save', counting_save):
+            self.client.get(url)
+        self.assertEqual(len(saved_ids), transactions_count - 14)
+        self.assertEqual(self.get_snapshot(), snapshot)
+        self.assertFalse(Account.objects.filter(budget=self.budget, balances_error__isnull=False).exists())
+
+
+class LoadTransactionsTests(BudgetTestCase):
+
+    def load(self, lines, duplicates_mode='1'):
+        transactions_file = SimpleUploadedFile('transactions.csv', '\n'.join(lines).encode('utf-8'),
+                                               content_type='text/csv')
+        return self.client.post(reverse('load_transactions', args=[self.account_1.pk, 'home']),
+                                {'transactions_file': transactions_file, 'transactions_time_zone': '0.00',
+                                 'column_delimiter': ';', 'string_delimiter': '', 'are_field_headers': '1',
+                                 'duplicates_mode': duplicates_mode})
+
+    def test_reloaded_transactions_are_skipped(self):
+        lines = ['time_transaction;amount_acc_cur;movement_flag;category;bank_description']
+        lines.extend(f'{day:02d}.01.2023 10:00:00;-{day}0;0;Еда;кофе {day}' for day in range(1, 11))
+        lines.append('11.01.2023;1000;0;Зарплата;зарплата')
+
+        # Файл проверяется и пишется порциями по 4 строки (в текущем процессе)
+        with mock.patch('main.loading.TRANSACTION_LOADING_CHUNK_SIZE', 4), \
+                mock.patch('main.loading.os.cpu_count', return_value=1):
+            response = self.load(lines)
+            self.assertEqual([log[0] for log in response.context['transaction_loading_log']], [1] * 11)
+            self.assertEqual(Transaction.objects.filter(account=self.account_1).count(), 11)
+            self.assertEqual(BudgetSummary.get_summary(self.budget.pk).transactions_count, 11)
+
+            # Повторная загрузка файла с новой строкой: загружается только новая операция
+            lines.append('12.01.2023 10:00:00;-5;0;Еда;чай')
+            response = self.load(lines)
+            self.assertEqual([log[0] for log in response.context['transaction_loading_log']], [0] * 11 + [1])
+            self.assertEqual(Transaction.objects.filter(account=self.account_1).count(), 12)
+
+            # Та же операция с другим описанием от банка - другая операция
+            response = self.load(lines[:1] + ['01.01.2023 10:00:00;-10;0;Еда;кофе 1 (возврат)'])
+            self.assertEqual([log[0] for log in response.context['transaction_loading_log']], [1])
+
+            # В режиме повторной загрузки операции загружаются еще раз
+            response = self.load(lines[:3], duplicates_mode='0')
+            self.assertEqual([log[0] for log in response.context['transaction_loading_log']], [1, 1])
+        self.assertEqual(Transaction.objects.filter(account=self.account_1).count(), 15)
+        self.assertEqual(BudgetSummary.get_summary(self.budget.pk).transactions_count, 15)
+        self.assertEqual(TransactionCategory.objects.filter(transaction__account=self.account_1,
+                                                            category=self.food).count(), 14)
+
+
+class AccountTransactionsInCategoryPeriodTests(BudgetTestCase):
+
+    def test_rows_match_distinct_join(self):
+        time_transaction = datetime(2023, 1, 5, 10, 0, tzinfo=timezone.utc)
+        for i, categories in enumerate([[self.food], [self.food, self.food], [self.food, self.transport],
+                                        [self.transport]]):
+            new_transaction = self.create_transaction(self.account_1, 'DEB', -10 * len(categories),
+                                                      time_transaction + timedelta(hours=i))
+            TransactionCategory.set_transaction_categories(
+                Transaction.objects.get(pk=new_transaction.pk),
+                [TransactionCategory(category=category, amount_acc_cur=ftod(-10, 2)) for category in categories])
+        self.create_transaction(self.account_1, 'DEB', -10, datetime(2023, 2, 5, 10, 0, tzinfo=timezone.utc),
+                                self.food)
+        other_user = User.objects.create_user('other', password='password')
+        other_budget = Budget.objects.create(name='Другой', user=other_user, base_currency_1=self.rub,
+                                             base_currency_2=self.usd, secret_key='other')
+        other_account = Account.objects.create(budget=other_budget, name='Карта', user=other_user,
+                                               currency=self.rub, type='DEC')
+        self.create_transaction(other_account, 'DEB', -10, time_transaction, self.food)
+
+        distinct_transactions = list(Transaction.objects.distinct()
+                                     .filter(budget_id=self.budget.pk, budget_year=2023, budget_month=1,
+                                             transaction_categories__category__id=self.food.pk)
+                                     .order_by('-time_transaction'))
+        response = self.client.get(reverse('account_transactions_in_category_period',
+                                           args=[self.budget.pk, self.food.pk, 2023, 1, self.rub.pk, 'home']))
+        self.assertEqual(len(distinct_transactions), 3)
+        self.assertEqual(list(response.context['transactions']), distinct_transactions)
+
+
+class MovementLinksTests(BudgetTestCase):
+
+    def setUp(self):
+        super().setUp()
+        time_transaction = datetime(2023, 1, 5, 10, 0, tzinfo=timezone.utc)
+        self.senders = [self.create_transaction(self.account_1, 'MO-', -100, time_transaction + timedelta(minutes=i))
+                        for i in range(2)]
+        self.receivers = [self.create_transaction(self.account_2, 'MO+', 100,
+                                                  time_transaction + timedelta(minutes=i + 1)) for i in range(3)]
+
+    def assertLinksAreUnique(self):
+        linked_receivers = Transaction.objects.filter(sender__isnull=False)
+        self.assertEqual(len(set(linked_receivers.values_list('sender_id', flat=True))), linked_receivers.count())
+
+    def test_linked_transactions_are_skipped(self):
+        pairs = [(self.senders[0].pk, self.receivers[0].pk), (self.senders[0].pk, self.receivers[1].pk),
+                 (self.senders[1].pk, self.receivers[0].pk)]
+        self.assertEqual(Transaction.set_movement_links(pairs, self.user), 1)
+        self.assertEqual(Transaction.set_movement_links([(self.senders[0].pk, self.receivers[2].pk),
+                                                         (self.senders[1].pk, self.receivers[2].pk)], self.user), 1)
+        self.assertEqual(dict(Transaction.objects.filter(sender__isnull=False).values_list('pk', 'sender_id')),
+                         {self.receivers[0].pk: self.senders[0].pk, self.receivers[2].pk: self.senders[1].pk})
+        self.assertLinksAreUnique()
+        self.account_2.refresh_from_db()
+        self.assertFalse(self.account_2.is_balances_valid)
+
+
+class PartitioningTests(MovementLinksTests):
+    """
+    Секционирование таблиц операций на тестовой базе PostgreSQL (DDL откатывается вместе с транзакцией теста)
+    """
+
+    def setUp(self):
+        if not is_partitioning_supported(connection):
+            self.skipTest('Секционирование поддерживается только в PostgreSQL')
+        super().setUp()
+        self.create_transaction(self.account_1, 'DEB', -10, datetime(2022, 6, 1, 10, 0, tzinfo=timezone.utc),
+                                self.food)
+        # Отложенные проверки внешних ключей не дают изменять таблицы (pending trigger events)
+        with connection.cursor() as cursor:
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+    def get_partition_counts(self, table):
+        with connection.cursor() as cursor:
+            counts = {}
+            for partition in get_partitions(cursor, table):
+                cursor.execute(f'SELECT COUNT(*) FROM {connection.ops.quote_name(partition)}')
+                counts[partition] = cursor.fetchone()[0]
+            return counts
+
+    def test_partition_table_and_create_partitions(self):
+        transactions_count = Transaction.objects.count()
+        transaction_categories_count = TransactionCategory.objects.count()
+        call_command('partition_transactions', stdout=StringIO())
+        current_year = datetime.now().year
+        for table in PARTITIONED_TABLES:
+            with connection.cursor() as cursor:
+                self.assertTrue(is_partitioned(cursor, table))
+            self.assertEqual(set(self.get_partition_counts(table)),
+                             {get_partition_name(table, year) for year in range(2022, current_year + 2)} |
+                             {table + DEFAULT_PARTITION_SUFFIX})
+        self.assertEqual(self.get_partition_counts('main_transaction')[get_partition_name('main_transaction', 2023)],
+                         5)
+        self.assertEqual((Transaction.objects.count(), TransactionCategory.objects.count()),
+                         (transactions_count, transaction_categories_count))
+
+        # Уникальность операции-отправителя после секционирования обеспечивает приложение
+        self.test_linked_transactions_are_skipped()
+
+        # Операции года без секции попадают в секцию по умолчанию и переносятся в новую секцию при повторном запуске
+        far_year_time = datetime(current_year + 3, 1, 10, 10, 0, tzinfo=timezone.utc)
+        far_transaction = self.create_transaction(self.account_1, 'DEB', -10, far_year_time, self.food)
+        self.assertEqual(self.get_partition_counts('main_transaction')['main_transaction' + DEFAULT_PARTITION_SUFFIX],
+                         1)
+        with connection.cursor() as cursor:
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        call_command('partition_transactions', '--years-ahead=3', stdout=StringIO())
+        for table in PARTITIONED_TABLES:
+            partition_counts = self.get_partition_counts(table)
+            self.assertEqual(partition_counts[table + DEFAULT_PARTITION_SUFFIX], 0)
+            self.assertEqual(partition_counts[get_partition_name(table, current_year + 3)], 1)
+        self.assertEqual(Transaction.objects.get(pk=far_transaction.pk).transaction_categories.get().category,
+                         self.food)
+
+    def test_migrations_after_partitioning(self):
+        # Возвращаемся к миграции секционирования, секционируем таблицы и применяем следующие миграции
+        executor = MigrationExecutor(connection)
+        leaf_nodes = executor.loader.graph.leaf_nodes('main')
+        executor.migrate([('main', '0014_transaction_partitioning')])
+        with connection.cursor() as cursor:
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        with connection.schema_editor() as schema_editor:
+            for table in PARTITIONED_TABLES:
+                partition_table(schema_editor, table)
+        executor = MigrationExecutor(connection)
+        executor.migrate(leaf_nodes)
+
+        with connection.cursor() as cursor:
+            self.assertTrue(is_partitioned(cursor, 'main_transactioncategory'))
+            constraints = connection.introspection.get_constraints(cursor, 'main_transactioncategory')
+        self.assertIn('tc__category_period_idx', constraints)
+        self.assertTrue(any(constraint['foreign_key'] == ('main_budget', 'id') for constraint in constraints.values()))
+        self.assertFalse(TransactionCategory.objects.filter(budget__isnull=True).exists())
+        self.assertEqual(set(TransactionCategory.objects.values_list('budget_id', flat=True)), {self.budget.pk})
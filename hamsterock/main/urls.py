@@ -49,7 +49,10 @@ urlpatterns = [
          name='balances_recalculation'),
     path('account_transactions_without_join/<int:budget_id>/<path:return_url>/', account_transactions_without_join,
          name='account_transactions_without_join'),
+    path('join_unlinked_movements/<int:budget_id>/<path:return_url>/', join_unlinked_movements,
+         name='join_unlinked_movements'),
     path('load_transactions/<int:account_id>/<path:return_url>/', load_transactions, name='load_transactions'),
+    path('download_loading_log/<int:account_id>/<str:log_id>/', download_loading_log, name='download_loading_log'),
     path('annual_budget/<int:year>/<int:currency_id>/', annual_budget, name='annual_budget'),
     path('edit_budget_register/', edit_budget_register, name='edit_budget_register'),
     path('autoplanning_budget/<int:budget_id>/<int:budget_year>/<path:return_url>/', autoplanning_budget,
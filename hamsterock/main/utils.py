@@ -1,5 +1,10 @@
-from django.core.paginator import Paginator, EmptyPage
-from django.http import HttpResponseRedirect
+import hashlib
+
+from django.core.cache import cache
+from django.core.paginator import Paginator, EmptyPage, InvalidPage
+from django.db.models import Q
+from django.http import HttpResponseRedirect, Http404
+from django.utils.functional import cached_property
 from django.utils.http import urlencode
 
 from .models import *
@@ -23,12 +28,15 @@ def get_u_context(request, initial_context):
         if request.user.profile.budget:
             context['is_has_budget'] = True
 
-            if request.user.profile.budget.user == request.user:
+            if request.user.profile.budget.user_id == request.user.pk:
                 context['is_owner_budget'] = True
             else:
                 context['is_owner_budget'] = False
 
-            accounts = Account.objects.filter(budget_id=request.user.profile.budget.pk).order_by('name')
+            # Счета/кошельки, диапазон лет и базовые валюты бюджета берем из кэша (см. Budget.get_cached_context)
+            budget_context = Budget.get_cached_context(request.user.profile.budget)
+
+            accounts = budget_context['accounts']
             context['accounts'] = accounts
 
             if accounts:
@@ -40,18 +48,8 @@ def get_u_context(request, initial_context):
                 context['account_selected'] = 0
 
             now = datetime.utcnow()
-            try:
-                first_budget_year = (BudgetRegister.objects
-                                     .filter(budget_id=request.user.profile.budget.pk)
-                                     .order_by('-budget_year')
-                                     )[:1][0].budget_year
-                last_budget_year = (BudgetRegister.objects
-                                    .filter(budget_id=request.user.profile.budget.pk)
-                                    .order_by('budget_year')
-                                    )[:1][0].budget_year
-            except Exception as e:
-                first_budget_year = now.year
-                last_budget_year = now.year
+            first_budget_year = budget_context['first_budget_year'] or now.year
+            last_budget_year = budget_context['last_budget_year'] or now.year
             budget_years = [year for year in range(first_budget_year, last_budget_year - 1, -1)]
             if now.month >= request.user.profile.budget.start_budget_month and now.year + 1 not in budget_years:
                 budget_years = [now.year + 1] + budget_years
@@ -60,7 +58,7 @@ def get_u_context(request, initial_context):
             if 'budget_year_selected' not in context:
                 context['budget_year_selected'] = 0
 
-            base_currencies = [request.user.profile.budget.base_currency_1, request.user.profile.budget.base_currency_2]
+            base_currencies = budget_context['base_currencies']
             first_base_currency = base_currencies[0].id
             context['base_currencies'] = base_currencies
             context['first_base_currency'] = first_base_currency
@@ -90,6 +88,70 @@ class SafePaginator(Paginator):
                 raise
 
 
+class KeysetPaginator(SafePaginator):
+    """
+    Пагинатор списка операций с переходом на соседние страницы по ключу (дата-время операции, id).
+    Список должен быть упорядочен по убыванию даты-времени операции и id. Переход на следующую/предыдущую страницу
+    идет от ключа последней/первой операции текущей страницы (WHERE по индексу вместо OFFSET), последняя страница
+    отбирается в обратном порядке. На произвольную страницу по номеру переход идет как обычно через OFFSET.
+    Количество записей для виджета страниц кэшируется на короткое время, т.е. может быть приблизительным.
+    """
+    count_cache_timeout = 60
+
+    @cached_property
+    def count(self):
+        cache_key = 'keyset_paginator_count_' + hashlib.md5(str(self.object_list.query).encode('utf-8')).hexdigest()
+        count = cache.get(cache_key)
+        if count is None:
+            count = super(KeysetPaginator, self).count
+            cache.set(cache_key, count, self.count_cache_timeout)
+        return count
+
+    @staticmethod
+    def get_key(obj):
+        return obj.time_transaction.astimezone(timezone.utc).strftime('%Y%m%d%H%M%S%f') + '_' + str(obj.pk)
+
+    @staticmethod
+    def parse_key(key):
+        try:
+            time_key, pk_key = key.split('_')
+            return datetime.strptime(time_key, '%Y%m%d%H%M%S%f').replace(tzinfo=timezone.utc), int(pk_key)
+        except Exception as e:
+            return None
+
+    def get_page_by_key(self, number, after_key=None, before_key=None):
+        """
+        Получение страницы по номеру и ключу соседней страницы.
+        :param number: номер страницы (для виджета страниц);
+        :param after_key: ключ последней операции предыдущей страницы;
+        :param before_key: ключ первой операции следующей страницы;
+        :return: страница с ключами для перехода на соседние страницы.
+        """
+        number = self.validate_number(number)
+        after = self.parse_key(after_key) if after_key else None
+        before = self.parse_key(before_key) if before_key else None
+        if after:
+            object_list = list(self.object_list
+                               .filter(Q(time_transaction__lt=after[0]) |
+                                       Q(time_transaction=after[0], id__lt=after[1]))[:self.per_page])
+        elif before:
+            object_list = list(self.object_list
+                               .filter(Q(time_transaction__gt=before[0]) |
+                                       Q(time_transaction=before[0], id__gt=before[1]))
+                               .reverse()[:self.per_page])[::-1]
+        elif number > 1 and number == self.num_pages:
+            object_list = list(self.object_list.reverse()[:max(self.count - (number - 1) * self.per_page, 1)])[::-1]
+        else:
+            return self.add_page_keys(self.page(number))
+        return self.add_page_keys(self._get_page(object_list, number, self))
+
+    def add_page_keys(self, page):
+        page.object_list = list(page.object_list)
+        page.previous_key = self.get_key(page.object_list[0]) if page.has_previous() and page.object_list else ''
+        page.next_key = self.get_key(page.object_list[-1]) if page.has_next() and page.object_list else ''
+        return page
+
+
 class DataMixin:
     paginator_class = SafePaginator
     paginate_by = 12
@@ -98,6 +160,25 @@ class DataMixin:
         return get_u_context(self.request, kwargs)
 
 
+class KeysetPaginationMixin:
+    """
+    Постраничный вывод операций через KeysetPaginator
+    """
+    paginator_class = KeysetPaginator
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = self.get_paginator(queryset, page_size, orphans=self.get_paginate_orphans(),
+                                       allow_empty_first_page=self.get_allow_empty())
+        page_number = self.request.GET.get('page') or 1
+        try:
+            page_number = paginator.num_pages if page_number == 'last' else int(page_number)
+            page = paginator.get_page_by_key(page_number, self.request.GET.get('after'),
+                                             self.request.GET.get('before'))
+        except (ValueError, InvalidPage) as e:
+            raise Http404('Неверная страница: ' + str(e))
+        return paginator, page, page.object_list, page.has_other_pages()
+
+
 def custom_redirect(url_name, *args, **kwargs):
     url = reverse(url_name, args=args)
     params = urlencode(kwargs)
@@ -1,6 +1,8 @@
 import csv
 import json
-from io import StringIO
+import os
+from io import TextIOWrapper
+from itertools import chain
 from uuid import uuid4
 
 from django.contrib.auth import logout, login
@@ -9,9 +11,10 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.views import LoginView, PasswordChangeView, PasswordChangeDoneView
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 from django.db import transaction, DataError, IntegrityError
-from django.db.models import F, Value, Sum
+from django.db.models import F, Q, Value, Sum
 from django.db.models.functions import Concat
-from django.http import HttpResponseNotFound, HttpResponseForbidden, HttpResponseServerError, JsonResponse
+from django.http import HttpResponseNotFound, HttpResponseForbidden, HttpResponseServerError, JsonResponse, \
+    FileResponse, Http404
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse_lazy
 from django.utils import formats, translation
@@ -20,6 +23,7 @@ from mptt.utils import tree_item_iterator
 
 from .filters import *
 from .forms import *
+from .loading import *
 from .utils import *
 
 
@@ -596,7 +600,7 @@ class DeleteAccount(LoginRequiredMixin, DataMixin, DeleteView):
     def form_valid(self, form):
         a = self.get_object()
         # Если есть операции по счету, то удалять счет нельзя
-        if Transaction.objects.filter(account_id=a.pk).count() > 0:
+        if get_references(a):
             return render(self.request, 'main/account_delete.html',
                           get_u_context(self.request, {'title': 'Удаление счета/кошелька - ' + str(a.name) + ' (' +
                                                                 str(a.currency.iso_code) + ')',
@@ -737,7 +741,7 @@ class DeleteProject(LoginRequiredMixin, DataMixin, DeleteView):
     def form_valid(self, form):
         p = self.get_object()
         # Если есть операции с текущим проектом, то удалять его нельзя
-        if Transaction.objects.filter(project_id=p.pk).count() > 0:
+        if get_references(p):
             return render(self.request, 'main/project_delete.html',
                           get_u_context(self.request, {'title': 'Удаление проекта - ' + str(p.name),
                                                        'account_selected': -1,
@@ -875,14 +879,8 @@ class DeleteBudgetObject(LoginRequiredMixin, DataMixin, DeleteView):
 
     def form_valid(self, form):
         b = self.get_object()
-        categories = Category.objects.filter(budget_object_id=b.pk)
-        is_transactions_exist = False
-        for category in categories:
-            # Если есть категории с бюджетным объектом в операциях, то удалять бюджетный объект нельзя
-            if TransactionCategory.objects.filter(category_id=category.pk).count() > 0:
-                is_transactions_exist = True
-                break
-        if is_transactions_exist:
+        # Если есть категории с бюджетным объектом в операциях, то удалять бюджетный объект нельзя
+        if get_references(b):
             return render(self.request, 'main/budget_object_delete.html',
                           get_u_context(self.request, {'title': 'Удаление объекта бюджета - ' + str(b.name),
                                                        'account_selected': -2,
@@ -905,7 +903,7 @@ class DeleteBudgetObject(LoginRequiredMixin, DataMixin, DeleteView):
         return super(DeleteBudgetObject, self).dispatch(request, *args, **kwargs)
 
 
-class AccountTransactions(LoginRequiredMixin, DataMixin, ListView):
+class AccountTransactions(LoginRequiredMixin, KeysetPaginationMixin, DataMixin, ListView):
     """
     Класс списка операций по счету
     """
@@ -914,10 +912,11 @@ class AccountTransactions(LoginRequiredMixin, DataMixin, ListView):
     context_object_name = 'transactions'
     allow_empty = True
     account_transaction_filter = None
+    account = None
 
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(**kwargs)
-        a = get_object_or_404(Account, pk=self.kwargs['account_id'])
+        a = self.account
         c_def = self.get_user_context(title='Операции по счету/кошельку - ' + str(a),
                                       filter=self.account_transaction_filter,
                                       account_selected=a.id,
@@ -927,17 +926,22 @@ class AccountTransactions(LoginRequiredMixin, DataMixin, ListView):
                                       account_balance=a.balance,
                                       account_credit_limit=a.credit_limit,
                                       account_type=a.type,
-                                      account_budget=a.budget.id,
+                                      account_budget=a.budget_id,
+                                      account_balances_error=a.balances_error,
+                                      account_balances_error_transaction=a.balances_error_transaction
+                                      if a.balances_error_transaction_id else None,
                                       work_menu=True,
                                       selected_menu='account_transactions')
         return dict(list(context.items()) + list(c_def.items()))
 
     def dispatch(self, request, *args, **kwargs):
-        a = get_object_or_404(Account, pk=self.kwargs['account_id'])
+        # Счет читаем один раз на запрос (сразу с валютой) - он же используется в контексте
+        self.account = a = get_object_or_404(Account.objects.select_related('currency'),
+                                             pk=self.kwargs['account_id'])
         if request.user.is_authenticated:
             if not (hasattr(request.user, 'profile') and request.user.profile.budget):
                 return redirect('home')
-            if a.budget != request.user.profile.budget:
+            if a.budget_id != request.user.profile.budget_id:
                 return self.handle_no_permission()
         if not self.request.user.profile.budget:
             b_id = 0
@@ -948,7 +952,9 @@ class AccountTransactions(LoginRequiredMixin, DataMixin, ListView):
             AccountTransactionsFilter(
                 request.GET, request=request,
                 queryset=Transaction.objects.filter(budget_id=b_id, account_id=self.kwargs['account_id']).exclude(
-                    type__in=['ED+', 'ED-']).select_related('budget', 'account', 'currency', 'sender')
+                    type__in=['ED+', 'ED-']).order_by('-time_transaction', '-id').select_related(
+                    'budget', 'account', 'currency', 'sender', 'project').prefetch_related(
+                    Transaction.get_categories_prefetch())
             )
         self.queryset = self.account_transaction_filter.qs
         return super(AccountTransactions, self).dispatch(request, *args, **kwargs)
@@ -1369,74 +1375,17 @@ def manage_transaction_category(request, transaction_id, return_url):
         if formset.is_valid():
             try:
                 with transaction.atomic():
-                    formset.save()
-
-                    # 1. Получим набор категорий по операции
-                    transaction_categories = TransactionCategory.objects.filter(transaction_id=t.pk)
-
-                    # 2 Кейс с отсутствием категории не обрабатываем, ибо такое возможно при создании - здесь
-                    #   категория создастся следом
-                    pass
-
-                    # 3. Если у операции только одна категория, то поменяем суммы в базовых валютах у категории
-                    if len(transaction_categories) == 1:
-                        transaction_category = transaction_categories[0]
-                        is_transaction_category_update = False
-                        if transaction_category.amount_base_cur_1 != ftod(t.amount_base_cur_1, 2):
-                            transaction_category.amount_base_cur_1 = ftod(t.amount_base_cur_1, 2)
-                            is_transaction_category_update = True
-                        if transaction_category.amount_base_cur_2 != ftod(t.amount_base_cur_2, 2):
-                            transaction_category.amount_base_cur_2 = ftod(t.amount_base_cur_2, 2)
-                            is_transaction_category_update = True
-                        if is_transaction_category_update:
-                            transaction_category.save()
-
-                    # 4. Если у операции несколько категорий, то творим магию - обновляем суммы в базовых валютах у
-                    #    категорий в соответствие долям распределения основных сумм категорий операции
-                    if len(transaction_categories) > 1:
-                        # 4.1. Посчитаем текущую сумму основных сумм категорий операции
-                        categories_sum = ftod(0.00, 2)
-                        for transaction_category in transaction_categories:
-                            categories_sum = categories_sum + ftod(transaction_category.amount_acc_cur, 2)
-
-                        # 4.2. Обновим суммы каждой категории
-                        new_sum_amount_base_cur_1 = ftod(0.00, 2)
-                        new_sum_amount_base_cur_2 = ftod(0.00, 2)
-
-                        for i, transaction_category in enumerate(transaction_categories):
-                            is_transaction_category_update = False
-
-                            if i < len(transaction_categories) - 1:
-                                # Для всех, кроме последней
-                                proportion = transaction_category.amount_acc_cur / categories_sum
-                                if transaction_category.amount_base_cur_1 != ftod(t.amount_base_cur_1 * proportion, 2):
-                                    transaction_category.amount_base_cur_1 = ftod(t.amount_base_cur_1 * proportion, 2)
-                                    is_transaction_category_update = True
-                                new_sum_amount_base_cur_1 = \
-                                    new_sum_amount_base_cur_1 + \
-                                    transaction_category.amount_base_cur_1
-                                if transaction_category.amount_base_cur_2 != ftod(t.amount_base_cur_2 * proportion, 2):
-                                    transaction_category.amount_base_cur_2 = ftod(t.amount_base_cur_2 * proportion, 2)
-                                    is_transaction_category_update = True
-                                new_sum_amount_base_cur_2 = \
-                                    new_sum_amount_base_cur_2 + \
-                                    transaction_category.amount_base_cur_2
-                            else:
-                                # для последней берем точный остаток от суммы операции за минусом суммы предыдущих
-                                # категорий, чтобы избежать копеек разницы из-за округления
-                                if transaction_category.amount_base_cur_1 != ftod(t.amount_base_cur_1 -
-                                                                                  new_sum_amount_base_cur_1, 2):
-                                    transaction_category.amount_base_cur_1 = ftod(t.amount_base_cur_1 -
-                                                                                  new_sum_amount_base_cur_1, 2)
-                                    is_transaction_category_update = True
-                                if transaction_category.amount_base_cur_2 != ftod(t.amount_base_cur_2 -
-                                                                                  new_sum_amount_base_cur_2, 2):
-                                    transaction_category.amount_base_cur_2 = ftod(t.amount_base_cur_2 -
-                                                                                  new_sum_amount_base_cur_2, 2)
-                                    is_transaction_category_update = True
-
-                            if is_transaction_category_update:
-                                transaction_category.save()
+                    # 1. Соберем новый список категорий операции: существующие (по порядку, с изменениями из форм),
+                    #    кроме удаленных, и следом добавленные
+                    formset.save(commit=False)
+                    deleted_ids = {transaction_category.pk for transaction_category in formset.deleted_objects}
+                    transaction_categories = [transaction_category
+                                              for transaction_category in formset.get_queryset()
+                                              if transaction_category.pk not in deleted_ids] + formset.new_objects
+
+                    # 2. Запишем список целиком: суммы в базовых валютах распределятся по долям сумм категорий,
+                    #    бюджетные регистры изменятся на разницу со старым списком (см. set_transaction_categories)
+                    TransactionCategory.set_transaction_categories(t, transaction_categories)
 
                     return redirect(return_url)
             except Exception as e:
@@ -1494,22 +1443,7 @@ def set_join_between_transactions(request, transaction_id, return_url):
     if request.method == 'POST':
         pass
     elif changed_transaction.type in ('MO+', 'MO-'):
-        search_type = 'MO-' if changed_transaction.type == 'MO+' else 'MO+'
-        search_start_time = changed_transaction.time_transaction - DEFAULT_TIME_DELTA \
-            if changed_transaction.type == 'MO+' \
-            else changed_transaction.time_transaction
-        search_end_time = changed_transaction.time_transaction \
-            if changed_transaction.type == 'MO+' \
-            else changed_transaction.time_transaction + DEFAULT_TIME_DELTA
-        suitable_transactions = Transaction.objects.filter(budget_id=changed_transaction.budget.id,
-                                                           time_transaction__gte=search_start_time,
-                                                           time_transaction__lte=search_end_time,
-                                                           type=search_type,
-                                                           amount=-changed_transaction.amount,
-                                                           currency_id=changed_transaction.currency.id,
-                                                           sender__isnull=True,
-                                                           receiver__isnull=True
-                                                           ).exclude(account_id=changed_transaction.account.id)
+        suitable_transactions = Transaction.get_movement_candidates(changed_transaction)[:2]
 
         if len(suitable_transactions) == 1:
             try:
@@ -1526,32 +1460,8 @@ def set_join_between_transactions(request, transaction_id, return_url):
                 print('Что-то пошло не так с установлением связи между операциями - ' + str(e))
             return redirect(return_url)
         else:
-            if changed_transaction.type == 'MO+':
-                return custom_redirect('account_transactions_for_join', transaction_id, return_url,
-                                       time_transaction_min=search_start_time.strftime(
-                                           formats.get_format("DATETIME_INPUT_FORMATS",
-                                                              lang=translation.get_language())[0]
-                                       ),
-                                       time_transaction_max=search_end_time.strftime(
-                                           formats.get_format("DATETIME_INPUT_FORMATS",
-                                                              lang=translation.get_language())[0]
-                                       ),
-                                       amount_exp_min=changed_transaction.amount,
-                                       amount_exp_max=changed_transaction.amount,
-                                       currency=changed_transaction.currency.iso_code)
-            else:
-                return custom_redirect('account_transactions_for_join', transaction_id, return_url,
-                                       time_transaction_min=search_start_time.strftime(
-                                           formats.get_format("DATETIME_INPUT_FORMATS",
-                                                              lang=translation.get_language())[0]
-                                       ),
-                                       time_transaction_max=search_end_time.strftime(
-                                           formats.get_format("DATETIME_INPUT_FORMATS",
-                                                              lang=translation.get_language())[0]
-                                       ),
-                                       amount_inc_min=-changed_transaction.amount,
-                                       amount_inc_max=-changed_transaction.amount,
-                                       currency=changed_transaction.currency.iso_code)
+            # Без параметров отбора список выбора откроется сразу с подходящими операциями
+            return redirect('account_transactions_for_join', transaction_id, return_url)
     return redirect(return_url)
 
 
@@ -1564,6 +1474,7 @@ class AccountTransactionsForJoin(LoginRequiredMixin, DataMixin, ListView):
     context_object_name = 'transactions'
     allow_empty = True
     account_transaction_filter = None
+    is_movement_candidates = False
     success_url = reverse_lazy('home')
 
     def get_context_data(self, *, object_list=None, **kwargs):
@@ -1592,6 +1503,7 @@ class AccountTransactionsForJoin(LoginRequiredMixin, DataMixin, ListView):
                                       transaction_for_join_amount=t.amount,
                                       transaction_for_join_currency_iso_code=t.currency.iso_code,
                                       transaction_for_join_currency_id=t.currency.id,
+                                      is_movement_candidates=self.is_movement_candidates,
                                       return_url=return_url,
                                       work_menu=True,
                                       selected_menu='account_transactions')
@@ -1611,23 +1523,34 @@ class AccountTransactionsForJoin(LoginRequiredMixin, DataMixin, ListView):
         if t.type not in ['MO-', 'MO+']:
             return redirect('home')
 
-        search_type = 'MO-' if t.type == 'MO+' else 'MO+'
+        # Без параметров отбора выводятся только подходящие для связи операции (по частичному индексу
+        # несвязанных перемещений), ближайшие по времени - первыми, иначе - все несвязанные перемещения бюджета
+        # с заданным пользователем отбором. Отбор определяется только по полям формы отбора (номер страницы и прочие
+        # параметры запроса не в счет, чтобы все страницы списка кандидатов выводились одинаково)
+        filter_form = AccountTransactionsFilterForJoin(request.GET, request=request).form
+        self.is_movement_candidates = not any(any(value) if isinstance(value, (list, tuple)) else value
+                                              for value in (bound_field.value() for bound_field in filter_form))
+        if self.is_movement_candidates:
+            queryset = Transaction.get_movement_candidates(t)
+        else:
+            search_type = 'MO-' if t.type == 'MO+' else 'MO+'
+            queryset = (Transaction.objects
+                        .filter(budget_id=t.budget.id,
+                                type=search_type,
+                                sender__isnull=True,
+                                receiver__isnull=True
+                                )
+                        .exclude(account_id=t.account.id)
+                        .order_by('-time_transaction'))
         self.account_transaction_filter = \
             AccountTransactionsFilterForJoin(
                 request.GET, request=request,
-                queryset=(Transaction.objects
+                queryset=(queryset
                           .annotate(a_name=Concat(F('account__name'),
                                                   Value(' ('),
                                                   F('account__currency__iso_code'),
                                                   Value(')'),
                                                   output_field=models.CharField()))
-                          .filter(budget_id=t.budget.id,
-                                  type=search_type,
-                                  sender__isnull=True,
-                                  receiver__isnull=True
-                                  )
-                          .exclude(account_id=t.account.id)
-                          .order_by('-time_transaction')
                           .select_related('budget', 'account', 'currency', 'sender')
                           )
             )
@@ -1936,6 +1859,11 @@ def balances_recalculation(request, budget_id, return_url):
     в каком-то месяце этих операций они добавляются;
     - операции выстраиваются по времени создания (необходимо для расчета остатков),
     и производится пересчет атрибутов.
+
+    Пересчет операций пишется порциями (одна транзакция базы данных на порцию, см.
+    BALANCES_RECALCULATION_CHUNK_SIZE и BALANCES_RECALCULATION_CHUNK_MILLISECONDS). Вместе с операциями порции
+    в той же транзакции сохраняется дата валидности остатков счетов - курсор пересчета, поэтому прерванный
+    пересчет при следующем запуске продолжается с последней записанной порции.
     """
 
     if not request.user.is_authenticated:
@@ -2046,8 +1974,10 @@ def balances_recalculation(request, budget_id, return_url):
     except Exception as e:
         is_error = True
 
+    account_with_invalid_balances = None
     try:
-        with transaction.atomic():
+        # Количество добавленных операций курсовой разницы пишется в сводку бюджета один раз на всю транзакцию
+        with transaction.atomic(), BudgetSummary.deferred_counts():
             # Проверим наличие Операций курсовой разницы для каждого счета из сформированного массива счетов
 
             # Вычислим конечную дату интервала проверки (она для всех счетов единая)
@@ -2175,6 +2105,11 @@ def balances_recalculation(request, budget_id, return_url):
 
     except Exception as e:
         is_error = True
+        # Запомним на счете ошибку (операции курсовой разницы откатились)
+        if account_with_invalid_balances:
+            Account.objects.filter(pk=account_with_invalid_balances.pk)\
+                .update(balances_error=(str(e) or e.__class__.__name__)[:255], balances_error_transaction=None)
+            Budget.reset_cached_context(budget_id)
 
     # Если были ошибки, то прерываем процедуру
     if is_error:
@@ -2217,301 +2152,331 @@ def balances_recalculation(request, budget_id, return_url):
 
     # Запускаем главный цикл
     n = 1
+    processed_transaction = None
+    processed_account_idx = None
     try:
-        while True:
-            # Отбираем операцию для пересчета в данной итерации - берем самую раннюю из оставшихся по всем счетам
-            # Операции перемещения расход в первую очередь при наличии нескольких операций в одно время
-            processed_transaction = None
-            processed_account_idx = None
-            for i, account_with_invalid_balances in enumerate(accounts_with_invalid_balances):
-                if account_with_invalid_balances['transaction']:
-                    if not processed_transaction:
-                        processed_transaction = account_with_invalid_balances['transaction']
-                        processed_account_idx = i
-                    else:
-                        if processed_transaction.time_transaction == \
-                                account_with_invalid_balances['transaction'].time_transaction:
-                            if account_with_invalid_balances['transaction'].type == 'MO-':
+        is_finished = False
+        while not is_finished:
+            # Запускаем транзакцию порции операций
+            with transaction.atomic():
+                chunk_begin_time = datetime.utcnow()
+                chunk_transactions_count = 0
+                chunk_account_idxs = set()
+                while True:
+                    # Отбираем операцию для пересчета в данной итерации - берем самую раннюю из оставшихся
+                    # по всем счетам
+                    # Операции перемещения расход в первую очередь при наличии нескольких операций в одно время
+                    processed_transaction = None
+                    processed_account_idx = None
+                    for i, account_with_invalid_balances in enumerate(accounts_with_invalid_balances):
+                        if account_with_invalid_balances['transaction']:
+                            if not processed_transaction:
                                 processed_transaction = account_with_invalid_balances['transaction']
                                 processed_account_idx = i
-                        elif processed_transaction.time_transaction > \
-                                account_with_invalid_balances['transaction'].time_transaction:
-                            processed_transaction = account_with_invalid_balances['transaction']
-                            processed_account_idx = i
-
-            # Если не отобрали операцию, значит они закончились - выходим из главного цикла!
-            if not processed_transaction:
-                break
-
-            # Вытаскиваем обрабатываемую операцию из базы (для консистентности)
-            processed_transaction = Transaction.objects.get(pk=processed_transaction.pk)
-
-            # И предыдущую операцию тоже
-            previous_transaction = accounts_with_invalid_balances[processed_account_idx]['previous_transaction']
-            if previous_transaction:
-                previous_transaction = Transaction.objects.get(pk=previous_transaction.pk)
-
-            # Запускаем транзакцию
-            with transaction.atomic():
-
-                # 1. Вычисляем остаток по счету в валюте счета для данной операции
-                if previous_transaction:
-                    processed_transaction.balance_acc_cur = previous_transaction.balance_acc_cur + \
-                                                            processed_transaction.amount_acc_cur
-                else:
-                    processed_transaction.balance_acc_cur = processed_transaction.account.initial_balance + \
-                                                            processed_transaction.amount_acc_cur
-
-                # 2. Проверим заведены ли категории у операции, если какой-то причине нет, то заведем по дефолту
-                if processed_transaction.type in ['CRE', 'DEB']:
-                    transaction_categories = TransactionCategory.objects.filter(transaction_id=processed_transaction.pk)
-                    if len(transaction_categories) == 0:
-                        new_transaction_category = TransactionCategory()
-                        new_transaction_category.transaction = processed_transaction
-                        new_transaction_category.amount_acc_cur = processed_transaction.amount_acc_cur
-                        if processed_transaction.type == 'CRE':
-                            new_transaction_category.category_id = DEFAULT_INC_CATEGORY
-                        else:
-                            new_transaction_category.category_id = DEFAULT_EXP_CATEGORY
-                        new_transaction_category.save()
-
-                # 3. Вычисляем суммы операции в базовых валютах и остатки по счету в базовых валютах
-                if processed_transaction.type in ['MO+', 'CRE', 'DEB']:
-                    # Все приходные, расходные операции и операции перемещения приход получают рыночные курсы,
-                    # суммы операции в базовых валютах через произведения этих курсов на сумму операции в валюте счета,
-                    # а остатки в базовых валютах из остатков предыдущей операции с добавлением сумм текущей
-
-                    processed_transaction.rate_base_cur_1 = \
-                        CurrencyRate.get_rate(budget_base_currency_1,
-                                              processed_transaction.account.currency_id,
-                                              processed_transaction.time_transaction)
-                    processed_transaction.rate_base_cur_2 = \
-                        CurrencyRate.get_rate(budget_base_currency_2,
-                                              processed_transaction.account.currency_id,
-                                              processed_transaction.time_transaction)
-
-                    processed_transaction.amount_base_cur_1 = \
-                        ftod(processed_transaction.amount_acc_cur *
-                             processed_transaction.rate_base_cur_1, 2)
-                    processed_transaction.amount_base_cur_2 = \
-                        ftod(processed_transaction.amount_acc_cur *
-                             processed_transaction.rate_base_cur_2, 2)
+                            else:
+                                if processed_transaction.time_transaction == \
+                                        account_with_invalid_balances['transaction'].time_transaction:
+                                    if account_with_invalid_balances['transaction'].type == 'MO-':
+                                        processed_transaction = account_with_invalid_balances['transaction']
+                                        processed_account_idx = i
+                                elif processed_transaction.time_transaction > \
+                                        account_with_invalid_balances['transaction'].time_transaction:
+                                    processed_transaction = account_with_invalid_balances['transaction']
+                                    processed_account_idx = i
+
+                    # Если не отобрали операцию, значит они закончились - выходим из главного цикла!
+                    if not processed_transaction:
+                        is_finished = True
+                        break
 
-                    if previous_transaction:
-                        processed_transaction.balance_base_cur_1 = previous_transaction.balance_base_cur_1 + \
-                                                                   processed_transaction.amount_base_cur_1
-                        processed_transaction.balance_base_cur_2 = previous_transaction.balance_base_cur_2 + \
-                                                                   processed_transaction.amount_base_cur_2
-                    else:
-                        processed_transaction.balance_base_cur_1 = \
-                            ftod(processed_transaction.account.initial_balance *
-                                 CurrencyRate.get_rate(budget_base_currency_1,
-                                                       processed_transaction.account.currency_id,
-                                                       processed_transaction.time_transaction), 2) + \
-                            processed_transaction.amount_base_cur_1
-                        processed_transaction.balance_base_cur_2 = \
-                            ftod(processed_transaction.account.initial_balance *
-                                 CurrencyRate.get_rate(budget_base_currency_2,
-                                                       processed_transaction.account.currency_id,
-                                                       processed_transaction.time_transaction), 2) + \
-                            processed_transaction.amount_base_cur_2
-
-                elif processed_transaction.type in ['MO-']:
-                    # Операции перемещения расход получают рыночные курсы по дате операции-приемника, суммы операции в
-                    # базовых валютах через произведения этих курсов на инвертированную сумму операции в валюте счета
-                    # операции-приемника, а остатки в базовых валютах из остатков предыдущей операции
-                    # с добавлением сумм текущей
-                    # ВАЖНО! Расчет сумм в базовых валютах производится по сумме в валюте счета операции-приемника,
-                    # так как обороты по операциям перемещения должны совпадать, а курсовая разница для операций
-                    # покупки-продажи валюты (это когда счет-отправитель и счет-получатель в разных валютах) должна
-                    # отражаться на счете-отправителе
-
-                    receiver_transaction = processed_transaction.receiver
-
-                    processed_transaction.rate_base_cur_1 = \
-                        CurrencyRate.get_rate(budget_base_currency_1,
-                                              receiver_transaction.account.currency_id,
-                                              receiver_transaction.time_transaction)
-                    processed_transaction.rate_base_cur_2 = \
-                        CurrencyRate.get_rate(budget_base_currency_2,
-                                              receiver_transaction.account.currency_id,
-                                              receiver_transaction.time_transaction)
-
-                    processed_transaction.amount_base_cur_1 = \
-                        ftod(-receiver_transaction.amount_acc_cur *
-                             processed_transaction.rate_base_cur_1, 2)
-                    processed_transaction.amount_base_cur_2 = \
-                        ftod(-receiver_transaction.amount_acc_cur *
-                             processed_transaction.rate_base_cur_2, 2)
+                    # Вытаскиваем обрабатываемую операцию из базы (для консистентности)
+                    processed_transaction = Transaction.objects.get(pk=processed_transaction.pk)
 
+                    # И предыдущую операцию тоже
+                    previous_transaction = accounts_with_invalid_balances[processed_account_idx]['previous_transaction']
                     if previous_transaction:
-                        processed_transaction.balance_base_cur_1 = \
-                            previous_transaction.balance_base_cur_1 + \
-                            processed_transaction.amount_base_cur_1
-                        processed_transaction.balance_base_cur_2 = \
-                            previous_transaction.balance_base_cur_2 + \
-                            processed_transaction.amount_base_cur_2
-                    else:
-                        processed_transaction.balance_base_cur_1 = \
-                            ftod(processed_transaction.account.initial_balance *
-                                 CurrencyRate.get_rate(budget_base_currency_1,
-                                                       processed_transaction.account.currency_id,
-                                                       processed_transaction.time_transaction), 2) + \
-                            processed_transaction.amount_base_cur_1
-                        processed_transaction.balance_base_cur_2 = \
-                            ftod(processed_transaction.account.initial_balance *
-                                 CurrencyRate.get_rate(budget_base_currency_2,
-                                                       processed_transaction.account.currency_id,
-                                                       processed_transaction.time_transaction), 2) + \
-                            processed_transaction.amount_base_cur_2
-
-                elif processed_transaction.type in ['ED+', 'ED-']:
-                    # Операции курсовой разницы получают рыночный курс, остаток в базовой валюте как произведение
-                    # остатка в валюте счета на рыночный курс, сумма операции в базовой валюте как разницу
-                    # остатка от предыдущей операции и вычисленным остатком
-
-                    processed_transaction.rate_base_cur_1 = \
-                        CurrencyRate.get_rate(budget_base_currency_1,
-                                              processed_transaction.account.currency_id,
-                                              processed_transaction.time_transaction)
-                    processed_transaction.rate_base_cur_2 = \
-                        CurrencyRate.get_rate(budget_base_currency_2,
-                                              processed_transaction.account.currency_id,
-                                              processed_transaction.time_transaction)
-
-                    new_balance_base_cur_1 = \
-                        ftod(processed_transaction.balance_acc_cur *
-                             processed_transaction.rate_base_cur_1, 2)
-                    new_balance_base_cur_2 = \
-                        ftod(processed_transaction.balance_acc_cur *
-                             processed_transaction.rate_base_cur_2, 2)
+                        previous_transaction = Transaction.objects.get(pk=previous_transaction.pk)
 
+                    # 1. Вычисляем остаток по счету в валюте счета для данной операции
                     if previous_transaction:
-                        new_amount_base_cur_1 = new_balance_base_cur_1 - previous_transaction.balance_base_cur_1
-                        new_amount_base_cur_2 = new_balance_base_cur_2 - previous_transaction.balance_base_cur_2
+                        processed_transaction.balance_acc_cur = previous_transaction.balance_acc_cur + \
+                                                                processed_transaction.amount_acc_cur
                     else:
-                        new_amount_base_cur_1 = \
-                            new_balance_base_cur_1 - \
-                            ftod(processed_transaction.account.initial_balance *
-                                 CurrencyRate.get_rate(budget_base_currency_1,
-                                                       processed_transaction.account.currency_id,
-                                                       datetime(processed_transaction.time_transaction.year,
-                                                                processed_transaction.time_transaction.month,
-                                                                1, 0, 0, 0, 0, timezone.utc) -
-                                                       timedelta(microseconds=1)), 2)
-                        new_amount_base_cur_2 = \
-                            new_balance_base_cur_2 - \
-                            ftod(processed_transaction.account.initial_balance *
-                                 CurrencyRate.get_rate(budget_base_currency_2,
-                                                       processed_transaction.account.currency_id,
-                                                       datetime(processed_transaction.time_transaction.year,
-                                                                processed_transaction.time_transaction.month,
-                                                                1, 0, 0, 0, 0, timezone.utc) -
-                                                       timedelta(microseconds=1)), 2)
-
-                    # Вычисленная курсовая разница записывается в операцию положительной курсовой разницы (ED+),
-                    # если она положительна, иначе в операцию отрицательной курсовой разницы (ED-).
-                    if processed_transaction.type == 'ED+':
-
-                        if new_amount_base_cur_1 >= 0:
-                            processed_transaction.amount_base_cur_1 = new_amount_base_cur_1
-                            processed_transaction.balance_base_cur_1 = new_balance_base_cur_1
-                        else:
-                            processed_transaction.amount_base_cur_1 = ftod(0.00, 2)
-                            if previous_transaction:
-                                processed_transaction.balance_base_cur_1 = previous_transaction.balance_base_cur_1
+                        processed_transaction.balance_acc_cur = processed_transaction.account.initial_balance + \
+                                                                processed_transaction.amount_acc_cur
+
+                    # 2. Проверим заведены ли категории у операции, если какой-то причине нет, то заведем по дефолту
+                    if processed_transaction.type in ['CRE', 'DEB']:
+                        transaction_categories = \
+                            TransactionCategory.objects.filter(transaction_id=processed_transaction.pk)
+                        if len(transaction_categories) == 0:
+                            new_transaction_category = TransactionCategory()
+                            new_transaction_category.transaction = processed_transaction
+                            new_transaction_category.amount_acc_cur = processed_transaction.amount_acc_cur
+                            if processed_transaction.type == 'CRE':
+                                new_transaction_category.category_id = DEFAULT_INC_CATEGORY
                             else:
-                                processed_transaction.balance_base_cur_1 = \
-                                    ftod(processed_transaction.account.initial_balance *
-                                         CurrencyRate.get_rate(budget_base_currency_1,
-                                                               processed_transaction.account.currency_id,
-                                                               datetime(processed_transaction.time_transaction.year,
-                                                                        processed_transaction.time_transaction.month,
-                                                                        1, 0, 0, 0, 0, timezone.utc) -
-                                                               timedelta(microseconds=1)), 2)
-
-                        if new_amount_base_cur_2 >= 0:
-                            processed_transaction.amount_base_cur_2 = new_amount_base_cur_2
-                            processed_transaction.balance_base_cur_2 = new_balance_base_cur_2
+                                new_transaction_category.category_id = DEFAULT_EXP_CATEGORY
+                            new_transaction_category.save()
+
+                    # 3. Вычисляем суммы операции в базовых валютах и остатки по счету в базовых валютах
+                    if processed_transaction.type in ['MO+', 'CRE', 'DEB']:
+                        # Все приходные, расходные операции и операции перемещения приход получают рыночные курсы,
+                        # суммы операции в базовых валютах через произведения этих курсов на сумму операции в валюте
+                        # счета, а остатки в базовых валютах из остатков предыдущей операции с добавлением сумм текущей
+
+                        processed_transaction.rate_base_cur_1 = \
+                            CurrencyRate.get_rate(budget_base_currency_1,
+                                                  processed_transaction.account.currency_id,
+                                                  processed_transaction.time_transaction)
+                        processed_transaction.rate_base_cur_2 = \
+                            CurrencyRate.get_rate(budget_base_currency_2,
+                                                  processed_transaction.account.currency_id,
+                                                  processed_transaction.time_transaction)
+
+                        processed_transaction.amount_base_cur_1 = \
+                            ftod(processed_transaction.amount_acc_cur *
+                                 processed_transaction.rate_base_cur_1, 2)
+                        processed_transaction.amount_base_cur_2 = \
+                            ftod(processed_transaction.amount_acc_cur *
+                                 processed_transaction.rate_base_cur_2, 2)
+
+                        if previous_transaction:
+                            processed_transaction.balance_base_cur_1 = previous_transaction.balance_base_cur_1 + \
+                                                                       processed_transaction.amount_base_cur_1
+                            processed_transaction.balance_base_cur_2 = previous_transaction.balance_base_cur_2 + \
+                                                                       processed_transaction.amount_base_cur_2
                         else:
-                            processed_transaction.amount_base_cur_2 = ftod(0.00, 2)
-                            if previous_transaction:
-                                processed_transaction.balance_base_cur_2 = previous_transaction.balance_base_cur_2
-                            else:
-                                processed_transaction.balance_base_cur_2 = \
-                                    ftod(processed_transaction.account.initial_balance *
-                                         CurrencyRate.get_rate(budget_base_currency_2,
-                                                               processed_transaction.account.currency_id,
-                                                               datetime(processed_transaction.time_transaction.year,
-                                                                        processed_transaction.time_transaction.month,
-                                                                        1, 0, 0, 0, 0, timezone.utc) -
-                                                               timedelta(microseconds=1)), 2)
-
-                    elif processed_transaction.type == 'ED-':
-
-                        if new_amount_base_cur_1 <= 0:
-                            processed_transaction.amount_base_cur_1 = new_amount_base_cur_1
-                            processed_transaction.balance_base_cur_1 = new_balance_base_cur_1
+                            processed_transaction.balance_base_cur_1 = \
+                                ftod(processed_transaction.account.initial_balance *
+                                     CurrencyRate.get_rate(budget_base_currency_1,
+                                                           processed_transaction.account.currency_id,
+                                                           processed_transaction.time_transaction), 2) + \
+                                processed_transaction.amount_base_cur_1
+                            processed_transaction.balance_base_cur_2 = \
+                                ftod(processed_transaction.account.initial_balance *
+                                     CurrencyRate.get_rate(budget_base_currency_2,
+                                                           processed_transaction.account.currency_id,
+                                                           processed_transaction.time_transaction), 2) + \
+                                processed_transaction.amount_base_cur_2
+
+                    elif processed_transaction.type in ['MO-']:
+                        # Операции перемещения расход получают рыночные курсы по дате операции-приемника, суммы
+                        # операции в базовых валютах через произведения этих курсов на инвертированную сумму операции
+                        # в валюте счета операции-приемника, а остатки в базовых валютах из остатков предыдущей операции
+                        # с добавлением сумм текущей
+                        # ВАЖНО! Расчет сумм в базовых валютах производится по сумме в валюте счета операции-приемника,
+                        # так как обороты по операциям перемещения должны совпадать, а курсовая разница для операций
+                        # покупки-продажи валюты (это когда счет-отправитель и счет-получатель в разных валютах) должна
+                        # отражаться на счете-отправителе
+
+                        receiver_transaction = processed_transaction.receiver
+
+                        processed_transaction.rate_base_cur_1 = \
+                            CurrencyRate.get_rate(budget_base_currency_1,
+                                                  receiver_transaction.account.currency_id,
+                                                  receiver_transaction.time_transaction)
+                        processed_transaction.rate_base_cur_2 = \
+                            CurrencyRate.get_rate(budget_base_currency_2,
+                                                  receiver_transaction.account.currency_id,
+                                                  receiver_transaction.time_transaction)
+
+                        processed_transaction.amount_base_cur_1 = \
+                            ftod(-receiver_transaction.amount_acc_cur *
+                                 processed_transaction.rate_base_cur_1, 2)
+                        processed_transaction.amount_base_cur_2 = \
+                            ftod(-receiver_transaction.amount_acc_cur *
+                                 processed_transaction.rate_base_cur_2, 2)
+
+                        if previous_transaction:
+                            processed_transaction.balance_base_cur_1 = \
+                                previous_transaction.balance_base_cur_1 + \
+                                processed_transaction.amount_base_cur_1
+                            processed_transaction.balance_base_cur_2 = \
+                                previous_transaction.balance_base_cur_2 + \
+                                processed_transaction.amount_base_cur_2
                         else:
-                            processed_transaction.amount_base_cur_1 = ftod(0.00, 2)
-                            if previous_transaction:
-                                processed_transaction.balance_base_cur_1 = previous_transaction.balance_base_cur_1
-                            else:
-                                processed_transaction.balance_base_cur_1 = \
-                                    ftod(processed_transaction.account.initial_balance *
-                                         CurrencyRate.get_rate(budget_base_currency_1,
-                                                               processed_transaction.account.currency_id,
-                                                               datetime(processed_transaction.time_transaction.year,
-                                                                        processed_transaction.time_transaction.month,
-                                                                        1, 0, 0, 0, 0, timezone.utc) -
-                                                               timedelta(microseconds=1)), 2)
-
-                        if new_amount_base_cur_2 <= 0:
-                            processed_transaction.amount_base_cur_2 = new_amount_base_cur_2
-                            processed_transaction.balance_base_cur_2 = new_balance_base_cur_2
+                            processed_transaction.balance_base_cur_1 = \
+                                ftod(processed_transaction.account.initial_balance *
+                                     CurrencyRate.get_rate(budget_base_currency_1,
+                                                           processed_transaction.account.currency_id,
+                                                           processed_transaction.time_transaction), 2) + \
+                                processed_transaction.amount_base_cur_1
+                            processed_transaction.balance_base_cur_2 = \
+                                ftod(processed_transaction.account.initial_balance *
+                                     CurrencyRate.get_rate(budget_base_currency_2,
+                                                           processed_transaction.account.currency_id,
+                                                           processed_transaction.time_transaction), 2) + \
+                                processed_transaction.amount_base_cur_2
+
+                    elif processed_transaction.type in ['ED+', 'ED-']:
+                        # Операции курсовой разницы получают рыночный курс, остаток в базовой валюте как произведение
+                        # остатка в валюте счета на рыночный курс, сумма операции в базовой валюте как разницу
+                        # остатка от предыдущей операции и вычисленным остатком
+
+                        processed_transaction.rate_base_cur_1 = \
+                            CurrencyRate.get_rate(budget_base_currency_1,
+                                                  processed_transaction.account.currency_id,
+                                                  processed_transaction.time_transaction)
+                        processed_transaction.rate_base_cur_2 = \
+                            CurrencyRate.get_rate(budget_base_currency_2,
+                                                  processed_transaction.account.currency_id,
+                                                  processed_transaction.time_transaction)
+
+                        new_balance_base_cur_1 = \
+                            ftod(processed_transaction.balance_acc_cur *
+                                 processed_transaction.rate_base_cur_1, 2)
+                        new_balance_base_cur_2 = \
+                            ftod(processed_transaction.balance_acc_cur *
+                                 processed_transaction.rate_base_cur_2, 2)
+
+                        if previous_transaction:
+                            new_amount_base_cur_1 = new_balance_base_cur_1 - previous_transaction.balance_base_cur_1
+                            new_amount_base_cur_2 = new_balance_base_cur_2 - previous_transaction.balance_base_cur_2
                         else:
-                            processed_transaction.amount_base_cur_2 = ftod(0.00, 2)
-                            if previous_transaction:
-                                processed_transaction.balance_base_cur_2 = previous_transaction.balance_base_cur_2
+                            new_amount_base_cur_1 = \
+                                new_balance_base_cur_1 - \
+                                ftod(processed_transaction.account.initial_balance *
+                                     CurrencyRate.get_rate(budget_base_currency_1,
+                                                           processed_transaction.account.currency_id,
+                                                           datetime(processed_transaction.time_transaction.year,
+                                                                    processed_transaction.time_transaction.month,
+                                                                    1, 0, 0, 0, 0, timezone.utc) -
+                                                           timedelta(microseconds=1)), 2)
+                            new_amount_base_cur_2 = \
+                                new_balance_base_cur_2 - \
+                                ftod(processed_transaction.account.initial_balance *
+                                     CurrencyRate.get_rate(budget_base_currency_2,
+                                                           processed_transaction.account.currency_id,
+                                                           datetime(processed_transaction.time_transaction.year,
+                                                                    processed_transaction.time_transaction.month,
+                                                                    1, 0, 0, 0, 0, timezone.utc) -
+                                                           timedelta(microseconds=1)), 2)
+
+                        # Вычисленная курсовая разница записывается в операцию положительной курсовой разницы (ED+),
+                        # если она положительна, иначе в операцию отрицательной курсовой разницы (ED-).
+                        if processed_transaction.type == 'ED+':
+
+                            if new_amount_base_cur_1 >= 0:
+                                processed_transaction.amount_base_cur_1 = new_amount_base_cur_1
+                                processed_transaction.balance_base_cur_1 = new_balance_base_cur_1
                             else:
-                                processed_transaction.balance_base_cur_2 = \
-                                    ftod(processed_transaction.account.initial_balance *
-                                         CurrencyRate.get_rate(budget_base_currency_2,
-                                                               processed_transaction.account.currency_id,
-                                                               datetime(processed_transaction.time_transaction.year,
-                                                                        processed_transaction.time_transaction.month,
-                                                                        1, 0, 0, 0, 0, timezone.utc) -
-                                                               timedelta(microseconds=1)), 2)
-
-                # 4. Сохраним изменения в операции (будет каскад обновлений: категории транзакций и бюджетные регистры
-                processed_transaction.save()
-
-                # 5. Вычисляем новую дату валидности у счета и сохраним
-                accounts_with_invalid_balances[processed_account_idx]['account'].balances_valid_until = \
-                    processed_transaction.time_transaction + timedelta(microseconds=1)
-                accounts_with_invalid_balances[processed_account_idx]['account'].save(
-                    update_fields=['balances_valid_until'])
-
-            # Все необходимые действия по пересчету с операцией совершены!
-            # Берем следующую транзакцию у данного счета
-            accounts_with_invalid_balances[processed_account_idx]['previous_transaction'] = processed_transaction
-            accounts_with_invalid_balances[processed_account_idx]['idx'] = \
-                accounts_with_invalid_balances[processed_account_idx]['idx'] + 1
-            if accounts_with_invalid_balances[processed_account_idx]['idx'] >= \
-                    len(accounts_with_invalid_balances[processed_account_idx]['transactions']):
-                accounts_with_invalid_balances[processed_account_idx]['transaction'] = None
-            else:
-                next_idx = accounts_with_invalid_balances[processed_account_idx]['idx']
-                accounts_with_invalid_balances[processed_account_idx]['transaction'] = \
-                    accounts_with_invalid_balances[processed_account_idx]['transactions'][next_idx]
+                                processed_transaction.amount_base_cur_1 = ftod(0.00, 2)
+                                if previous_transaction:
+                                    processed_transaction.balance_base_cur_1 = previous_transaction.balance_base_cur_1
+                                else:
+                                    processed_transaction.balance_base_cur_1 = \
+                                        ftod(processed_transaction.account.initial_balance *
+                                             CurrencyRate.get_rate(budget_base_currency_1,
+                                                                   processed_transaction.account.currency_id,
+                                                                   datetime(
+                                                                       processed_transaction.time_transaction.year,
+                                                                       processed_transaction.time_transaction.month,
+                                                                       1, 0, 0, 0, 0, timezone.utc) -
+                                                                   timedelta(microseconds=1)), 2)
+
+                            if new_amount_base_cur_2 >= 0:
+                                processed_transaction.amount_base_cur_2 = new_amount_base_cur_2
+                                processed_transaction.balance_base_cur_2 = new_balance_base_cur_2
+                            else:
+                                processed_transaction.amount_base_cur_2 = ftod(0.00, 2)
+                                if previous_transaction:
+                                    processed_transaction.balance_base_cur_2 = previous_transaction.balance_base_cur_2
+                                else:
+                                    processed_transaction.balance_base_cur_2 = \
+                                        ftod(processed_transaction.account.initial_balance *
+                                             CurrencyRate.get_rate(budget_base_currency_2,
+                                                                   processed_transaction.account.currency_id,
+                                                                   datetime(
+                                                                       processed_transaction.time_transaction.year,
+                                                                       processed_transaction.time_transaction.month,
+                                                                       1, 0, 0, 0, 0, timezone.utc) -
+                                                                   timedelta(microseconds=1)), 2)
+
+                        elif processed_transaction.type == 'ED-':
+
+                            if new_amount_base_cur_1 <= 0:
+                                processed_transaction.amount_base_cur_1 = new_amount_base_cur_1
+                                processed_transaction.balance_base_cur_1 = new_balance_base_cur_1
+                            else:
+                                processed_transaction.amount_base_cur_1 = ftod(0.00, 2)
+                                if previous_transaction:
+                                    processed_transaction.balance_base_cur_1 = previous_transaction.balance_base_cur_1
+                                else:
+                                    processed_transaction.balance_base_cur_1 = \
+                                        ftod(processed_transaction.account.initial_balance *
+                                             CurrencyRate.get_rate(budget_base_currency_1,
+                                                                   processed_transaction.account.currency_id,
+                                                                   datetime(
+                                                                       processed_transaction.time_transaction.year,
+                                                                       processed_transaction.time_transaction.month,
+                                                                       1, 0, 0, 0, 0, timezone.utc) -
+                                                                   timedelta(microseconds=1)), 2)
+
+                            if new_amount_base_cur_2 <= 0:
+                                processed_transaction.amount_base_cur_2 = new_amount_base_cur_2
+                                processed_transaction.balance_base_cur_2 = new_balance_base_cur_2
+                            else:
+                                processed_transaction.amount_base_cur_2 = ftod(0.00, 2)
+                                if previous_transaction:
+                                    processed_transaction.balance_base_cur_2 = previous_transaction.balance_base_cur_2
+                                else:
+                                    processed_transaction.balance_base_cur_2 = \
+                                        ftod(processed_transaction.account.initial_balance *
+                                             CurrencyRate.get_rate(budget_base_currency_2,
+                                                                   processed_transaction.account.currency_id,
+                                                                   datetime(
+                                                                       processed_transaction.time_transaction.year,
+                                                                       processed_transaction.time_transaction.month,
+                                                                       1, 0, 0, 0, 0, timezone.utc) -
+                                                                   timedelta(microseconds=1)), 2)
+
+                    # 4. Сохраним изменения в операции (будет каскад обновлений: категории транзакций и бюджетные
+                    #    регистры
+                    processed_transaction.save()
+
+                    # 5. Вычисляем новую дату валидности у счета (сохраним в конце порции)
+                    accounts_with_invalid_balances[processed_account_idx]['account'].balances_valid_until = \
+                        processed_transaction.time_transaction + timedelta(microseconds=1)
+                    chunk_account_idxs.add(processed_account_idx)
+
+                    # Все необходимые действия по пересчету с операцией совершены!
+                    # Берем следующую транзакцию у данного счета
+                    accounts_with_invalid_balances[processed_account_idx]['previous_transaction'] = \
+                        processed_transaction
+                    accounts_with_invalid_balances[processed_account_idx]['idx'] = \
+                        accounts_with_invalid_balances[processed_account_idx]['idx'] + 1
+                    if accounts_with_invalid_balances[processed_account_idx]['idx'] >= \
+                            len(accounts_with_invalid_balances[processed_account_idx]['transactions']):
+                        accounts_with_invalid_balances[processed_account_idx]['transaction'] = None
+                    else:
+                        next_idx = accounts_with_invalid_balances[processed_account_idx]['idx']
+                        accounts_with_invalid_balances[processed_account_idx]['transaction'] = \
+                            accounts_with_invalid_balances[processed_account_idx]['transactions'][next_idx]
+
+                    n = n + 1
+
+                    # Порция набрана по количеству операций или по времени - закончим транзакцию
+                    chunk_transactions_count = chunk_transactions_count + 1
+                    if chunk_transactions_count >= BALANCES_RECALCULATION_CHUNK_SIZE or \
+                            datetime.utcnow() - chunk_begin_time >= \
+                            timedelta(milliseconds=BALANCES_RECALCULATION_CHUNK_MILLISECONDS):
+                        break
 
-            n = n + 1
+                # 6. Сохраним даты валидности у счетов порции - это курсор пересчета: прерванный пересчет
+                #    продолжится с последней записанной порции
+                for idx in chunk_account_idxs:
+                    accounts_with_invalid_balances[idx]['account'].save(update_fields=['balances_valid_until'])
 
         # В конце процедуры у всех счетов, участвующих в пересчете, взводим флаг валидности остатков
-        for account_with_invalid_balances in accounts_with_invalid_balances:
-            with transaction.atomic():
+        # (и сбрасываем ошибку прошлого прерванного пересчета)
+        with transaction.atomic():
+            for account_with_invalid_balances in accounts_with_invalid_balances:
                 account_with_invalid_balances['account'].is_balances_valid = True
-                account_with_invalid_balances['account'].save(update_fields=['is_balances_valid'])
+                account_with_invalid_balances['account'].balances_error = None
+                account_with_invalid_balances['account'].balances_error_transaction = None
+                account_with_invalid_balances['account'].save(update_fields=['is_balances_valid', 'balances_error',
+                                                                             'balances_error_transaction'])
 
         # Еще нужно пересчитать остатки в Бюджетных оборотах счетов
 
@@ -2595,6 +2560,13 @@ def balances_recalculation(request, budget_id, return_url):
 
     except Exception as e:
         print('Что-то в главном цикле процедуры пересчета остатков пошло не так: ' + str(e))
+        # Если упали на операции, то запомним на ее счете ошибку и саму операцию - порция с этой операцией
+        # откатилась, остальные записаны, и следующий запуск пересчета продолжится с последней записанной порции
+        if processed_transaction:
+            Account.objects.filter(pk=accounts_with_invalid_balances[processed_account_idx]['account'].pk)\
+                .update(balances_error=(str(e) or e.__class__.__name__)[:255],
+                        balances_error_transaction=processed_transaction.pk)
+            Budget.reset_cached_context(budget_id)
 
     return redirect(return_url)
 
@@ -2630,6 +2602,56 @@ def account_transactions_without_join(request, budget_id, return_url):
                   get_u_context(request,
                                 {'title': 'Счета с операциями перемещения без связи',
                                  'accounts_with_unlinked_transactions': accounts_with_unlinked_transactions,
+                                 'budget_id': budget_id,
+                                 'work_menu': True,
+                                 'account_selected': -10,
+                                 'selected_menu': 'account_transactions',
+                                 'return_url': return_url,
+                                 }))
+
+
+@login_required
+def join_unlinked_movements(request, budget_id, return_url):
+    """
+    Функция массового установления связей между операциями перемещения без связи
+
+    При GET выводятся количество однозначно подобранных пар и группы операций, для которых подходящих операций
+    несколько (их нужно связать вручную), при POST однозначные пары связываются одним массовым обновлением.
+    """
+    if not request.user.is_authenticated:
+        return redirect('home')
+    if not (hasattr(request.user, 'profile') and request.user.profile.budget):
+        return redirect('home')
+    if budget_id != request.user.profile.budget.pk:
+        return HttpResponseForbidden("<h1>Доступ запрещен</h1>")
+
+    if return_url[0:1] != '/':
+        return_url = '/' + return_url
+
+    pairs, ambiguous_groups = Transaction.get_movement_matching(budget_id)
+
+    if request.method == 'POST':
+        try:
+            Transaction.set_movement_links(pairs, request.user)
+        except Exception as e:
+            print('Что-то пошло не так с массовым установлением связей между операциями - ' + str(e))
+        return redirect(join_unlinked_movements, budget_id, return_url)
+
+    # Для вывода неоднозначных групп получим сами операции одним запросом
+    ambiguous_transactions = \
+        (Transaction.objects
+         .select_related('account', 'account__currency', 'currency')
+         .in_bulk([t_id for group_senders, group_receivers in ambiguous_groups
+                   for t_id in chain(group_senders, group_receivers)]))
+    ambiguous_groups = [([ambiguous_transactions[t_id] for t_id in group_senders],
+                         [ambiguous_transactions[t_id] for t_id in group_receivers])
+                        for group_senders, group_receivers in ambiguous_groups]
+
+    return render(request, 'main/account_transactions_join_unlinked.html',
+                  get_u_context(request,
+                                {'title': 'Связывание операций перемещения без связи',
+                                 'pairs_count': len(pairs),
+                                 'ambiguous_groups': ambiguous_groups,
                                  'work_menu': True,
                                  'account_selected': -10,
                                  'selected_menu': 'account_transactions',
@@ -2659,8 +2681,8 @@ def load_transactions(request, account_id, return_url):
         form = LoadTransactionForm(account=account, data=request.POST, files=request.FILES)
 
         if form.is_valid():
-            # Откроем скаченный файл
-            csv_file = StringIO(request.FILES['transactions_file'].read().decode('utf-8-sig'))
+            # Откроем скаченный файл (читается потоково, целиком в память не загружается)
+            csv_file = TextIOWrapper(request.FILES['transactions_file'].file, encoding='utf-8-sig', newline='')
 
             # Зададим начальный список полей в первую строку лога загрузки
             transaction_loading_log = [['Статус', '№', 'Тип']]
@@ -2704,348 +2726,70 @@ def load_transactions(request, account_id, return_url):
 
             is_error = False
 
-            # Получим форматы ввода даты-времени допустимые в данной локации и сформируем подсказку для ошибок
-            datetime_formats = formats.get_format("DATETIME_INPUT_FORMATS", lang=translation.get_language())
-            datetime_formats.append(datetime_formats[0][:8])
-            example_datetime = datetime.utcnow()
-            valid_datetime_formats = 'Допустимые форматы даты-времени:'
-            for datetime_format in datetime_formats:
-                valid_datetime_formats += f"<br>{datetime_format}: {example_datetime.strftime(datetime_format)}"
-
-            # Цикл по строкам (операциям)
-            for row in rows:
-                if is_need_check_headers:
-                    # Проверяем действительное наличие заголовков в части обязательных полей
-                    headers = row.keys()
-                    for trf in TRANSACTION_REQUIRED_FIELDS:
-                        if trf[0] not in headers:
-                            form.add_error('are_field_headers',
-                                           forms.ValidationError('В заголовках файла нет обязательного поля - ' +
-                                                                 trf[1] + ' (' + trf[0] + ')'))
-                            is_error = True
-                    if is_error:
-                        break
-                    is_need_check_headers = False
+            # Проверяем действительное наличие заголовков в части обязательных полей
+            if is_need_check_headers:
+                headers = rows.fieldnames or []
+                for trf in TRANSACTION_REQUIRED_FIELDS:
+                    if trf[0] not in headers:
+                        form.add_error('are_field_headers',
+                                       forms.ValidationError('В заголовках файла нет обязательного поля - ' +
+                                                             trf[1] + ' (' + trf[0] + ')'))
+                        is_error = True
+                if not is_error:
                     # Расширим первую строку лога заголовками полей, полученными из первой строки файла
                     transaction_loading_log[0].extend(headers)
 
-                # Добавим пустую строчку в лог, соответствующую строке файла
-                transaction_loading_log.append([None, row_idx, {}, {}])
-                log_idx = len(transaction_loading_log) - 1
-
-                # Вытаскиваем значения из строки файла, нормализуем их
-                # В случае ошибок взводим флаги ошибок для каждого поля, записываем в лог ошибку и подсказку
-
-                # 1. ОБЯЗАТЕЛЬНОЕ ПОЛЕ! Дата-время операции  - time_transaction
-                is_time_transaction_error = True
-                time_transaction_str = row.get('time_transaction', '')
-                time_transaction = None
-                time_zone = None
-                transaction_loading_log[log_idx][3]['time_transaction'] = {'value': time_transaction_str}
-                # Попробуем распарсить дату-время из файла допустимыми форматами в данной локации
+            # Если не было ошибки на уровне наличия обязательных полей в файле, то загружаем операции
+            # и показываем пользователю лог загрузки
+            if not is_error:
+                # Режим пропуска уже загруженных операций (по отпечатку операции)
+                is_skip_duplicates = request.POST.get('duplicates_mode', '1') != '0'
+
+                # Получим форматы ввода даты-времени допустимые в данной локации и сформируем подсказку для ошибок
+                datetime_formats = list(formats.get_format("DATETIME_INPUT_FORMATS",
+                                                           lang=translation.get_language()))
+                datetime_formats.append(datetime_formats[0][:8])
+                example_datetime = datetime.utcnow()
+                valid_datetime_formats = 'Допустимые форматы даты-времени:'
                 for datetime_format in datetime_formats:
-                    try:
-                        time_transaction = datetime.strptime(time_transaction_str, datetime_format)
-                        time_zone = ftod(request.POST['transactions_time_zone'], 2)
-                        # Приводим дату-время к UTC
-                        if time_transaction.hour != 0 or time_transaction.minute != 0 or \
-                                time_transaction.second != 0 or time_transaction.microsecond != 0:
-                            time_transaction = time_transaction - timedelta(hours=float(time_zone))
-                        time_transaction = datetime(time_transaction.year,
-                                                    time_transaction.month,
-                                                    time_transaction.day,
-                                                    time_transaction.hour,
-                                                    time_transaction.minute,
-                                                    time_transaction.second,
-                                                    time_transaction.microsecond,
-                                                    timezone.utc)
-                        is_time_transaction_error = False
-                        break
-                    except Exception as e:
-                        pass
-                if is_time_transaction_error:
-                    transaction_loading_log[log_idx][3]['time_transaction']['error'] = 'ошибка формата даты-времени'
-                    transaction_loading_log[log_idx][3]['time_transaction']['tip'] = valid_datetime_formats
-                elif time_transaction < MIN_TRANSACTION_DATETIME or time_transaction > MAX_TRANSACTION_DATETIME:
-                    is_time_transaction_error = True
-                    time_transaction = None
-                    transaction_loading_log[log_idx][3]['time_transaction']['error'] = 'ошибка даты-времени'
-                    transaction_loading_log[log_idx][3]['time_transaction']['tip'] = \
-                        f"Допускаются даты в интервале<br>от {MIN_TRANSACTION_DATETIME}<br>" \
-                        f"до {MAX_TRANSACTION_DATETIME}"
-
-                # 2. ОБЯЗАТЕЛЬНОЕ ПОЛЕ! Сумма операции в валюте счета - amount_acc_cur
-                is_amount_acc_cur_error = False
-                amount_acc_cur_str = row.get('amount_acc_cur', '')
-                amount_acc_cur_str = amount_acc_cur_str.replace(' ', '')
-                amount_acc_cur_str = amount_acc_cur_str.replace(',', '.')
-                amount_acc_cur = None
-                transaction_loading_log[log_idx][3]['amount_acc_cur'] = {'value': amount_acc_cur_str}
-                try:
-                    amount_acc_cur = ftod(amount_acc_cur_str, 2)
-                except Exception as e:
-                    is_amount_acc_cur_error = True
-                    transaction_loading_log[log_idx][3]['amount_acc_cur']['error'] = 'ошибка значения суммы'
-                    transaction_loading_log[log_idx][3]['amount_acc_cur']['tip'] = 'Допускаются цифры, минус,<br>' \
-                                                                                   'точка или запятая'
-
-                # 3. ОБЯЗАТЕЛЬНОЕ ПОЛЕ! Признак операции-перемещения - movement_flag
-                is_movement_flag_error = False
-                movement_flag_str = row.get('movement_flag', None)
-                movement_flag = None
-                transaction_loading_log[log_idx][3]['movement_flag'] = {'value': movement_flag_str}
-                if movement_flag_str.lower() in ['0', 'false', 'f', 'нет', 'н']:
-                    movement_flag = False
-                elif movement_flag_str.lower() in ['1', 'true', 't', 'да', 'д']:
-                    movement_flag = True
-                else:
-                    is_movement_flag_error = True
-                    transaction_loading_log[log_idx][3]['movement_flag']['error'] = 'ошибка логического значения'
-                    transaction_loading_log[log_idx][3]['movement_flag']['tip'] = 'Допустимые значения:<br>' \
-                                                                                  '0, Нет, False, 1, Да, True'
-
-                # 4. ОБЯЗАТЕЛЬНОЕ ПОЛЕ! Категория операции - category
-                is_category_error = False
-                category_str = row.get('category', '')
-                category = None
-                transaction_loading_log[log_idx][3]['category'] = {'value': category_str}
-                if not movement_flag:
-                    try:
-                        category = Category.objects.get(name=category_str)
-                        if not category.parent:
-                            category = None
-                            raise
-                    except Exception as e:
-                        is_category_error = True
-                        transaction_loading_log[log_idx][3]['category']['error'] = 'категория не найдена'
-                        transaction_loading_log[log_idx][3]['category']['tip'] = \
-                            'Допустимые значения<br>смотри&nbsp;<a href="/static/main/upload/hamsterock-loading.xlsx"' \
-                            ' download="hamsterock-loading">здесь</a>'
-
-                # 5. Объект бюджета - budget_object
-                is_budget_object_error = False
-                budget_object_str = row.get('budget_object', '')
-                budget_object = None
-                budget_object_created = None
-                if budget_object_str:
-                    transaction_loading_log[log_idx][3]['budget_object'] = {'value': budget_object_str}
-                    try:
-                        budget_object, budget_object_created = BudgetObject.objects.get_or_create(
-                            budget_id=account.budget_id, name=budget_object_str)
-                    except Exception as e:
-                        is_budget_object_error = True
-                        transaction_loading_log[log_idx][3]['budget_object']['error'] = \
-                            'объект бюджета не был найден<br>и не смог создаться'
-                        transaction_loading_log[log_idx][3]['budget_object']['tip'] = 'Обратитесь к администратору'
-
-                # В случае, когда получили валидную категорию (базовую) и валидный непустой объект бюджета нужно
-                # получить категорию с бюджетным объектом (это отдельная строка в списке категорий)
-                # Вызываем Category.get_category_with_object(), которая либо вернет уже существующую категорию,
-                # либо вновь созданную
-                if not is_category_error and not is_budget_object_error and budget_object:
-                    try:
-                        c_id = Category.get_category_with_object(account.budget, category.pk,
-                                                                 budget_object.pk, request.user)
-                        category = Category.objects.get(pk=c_id)
-                    except Exception as e:
-                        pass
-
-                # На основе значений признака операции-перемещения и типа категории вычисляем тип операции
-                if amount_acc_cur is None or movement_flag is None:
-                    transaction_type = None
-                elif movement_flag:
-                    transaction_type = 'MO+' if amount_acc_cur >= 0 else 'MO-'
-                elif category is None:
-                    transaction_type = None
-                else:
-                    transaction_type = 'CRE' if category.type == 'INC' else 'DEB'
-                transaction_loading_log[log_idx][2] = {'value': transaction_type}
-
-                # 6. Валюта операции - currency
-                is_currency_error = False
-                currency_str = row.get('currency', '')
-                currency = None
-                if currency_str:
-                    transaction_loading_log[log_idx][3]['currency'] = {'value': currency_str}
-                    try:
-                        currency = Currency.objects.get(iso_code=currency_str)
-                    except Exception as e:
-                        is_category_error = True
-                        transaction_loading_log[log_idx][3]['currency']['error'] = 'валюта не найдена'
-                        transaction_loading_log[log_idx][3]['currency']['tip'] = \
-                            'Допустимые значения<br>смотри&nbsp;<a href="/static/main/upload/hamsterock-loading.xlsx"' \
-                            ' download="hamsterock-loading">здесь</a>'
-                else:
-                    currency = account.currency
-
-                # 7. Сумма операции в валюте операции - amount
-                is_amount_error = False
-                amount_str = row.get('amount', '')
-                amount = None
-                if amount_str:
-                    amount_str = amount_str.replace(' ', '')
-                    amount_str = amount_str.replace(',', '.')
-                    transaction_loading_log[log_idx][3]['amount'] = {'value': amount_str}
-                    try:
-                        amount = ftod(amount_str, 2)
-                    except Exception as e:
-                        is_amount_error = True
-                        transaction_loading_log[log_idx][3]['amount']['error'] = 'ошибка значения суммы'
-                        transaction_loading_log[log_idx][3]['amount']['tip'] = 'Допускаются цифры, минус,<br>' \
-                                                                               'точка или запятая'
-                else:
-                    if amount_acc_cur:
-                        if currency == account.currency or currency is None or time_transaction is None:
-                            amount = ftod(amount_acc_cur, 2)
-                        else:
-                            amount = ftod(amount_acc_cur *
-                                          CurrencyRate.get_rate(currency, account.currency, time_transaction), 2)
-
-                # 8. Проект - project
-                is_project_error = False
-                project_str = row.get('project', '')
-                project = None
-                if project_str:
-                    transaction_loading_log[log_idx][3]['project'] = {'value': project_str}
-                    try:
-                        project, project_created = Project.objects.get_or_create(budget_id=account.budget_id,
-                                                                                 name=project_str)
-                    except Exception as e:
-                        is_project_error = True
-                        transaction_loading_log[log_idx][3]['project']['error'] = 'проект не был найден<br>' \
-                                                                                  'и не смог создаться'
-                        transaction_loading_log[log_idx][3]['project']['tip'] = 'Обратитесь к администратору'
-
-                # 9. Год периода бюджета - budget_year
-                is_budget_year_error = False
-                budget_year_str = row.get('budget_year', '')
-                budget_year = None
-                if budget_year_str:
-                    transaction_loading_log[log_idx][3]['budget_year'] = {'value': budget_year_str}
-                    try:
-                        budget_year = int(budget_year_str)
-                        if not (MIN_BUDGET_YEAR <= budget_year <= MAX_BUDGET_YEAR):
-                            budget_year = None
-                            raise
-                    except Exception as e:
-                        is_budget_year_error = True
-                        transaction_loading_log[log_idx][3]['budget_year']['error'] = 'ошибка значения года'
-                        transaction_loading_log[log_idx][3]['budget_year']['tip'] = \
-                            f"Допускаются целые числа<br>в интервале от {MIN_BUDGET_YEAR} до {MAX_BUDGET_YEAR}"
-                else:
-                    try:
-                        budget_year = time_transaction.year
-                    except Exception as e:
-                        budget_year = None
-
-                # 10. Месяц периода бюджета - budget_month
-                is_budget_month_error = False
-                budget_month_str = row.get('budget_month', '')
-                budget_month = None
-                if budget_month_str:
-                    transaction_loading_log[log_idx][3]['budget_month'] = {'value': budget_month_str}
-                    try:
-                        budget_month = int(budget_month_str)
-                        if not (1 <= budget_month <= 12):
-                            budget_month = None
-                            raise
-                    except Exception as e:
-                        is_budget_month_error = True
-                        transaction_loading_log[log_idx][3]['budget_month']['error'] = 'ошибка значения месяца'
-                        transaction_loading_log[log_idx][3]['budget_month']['tip'] = 'Допускаются целые числа<br>' \
-                                                                                     'в интервале от 1 до 12'
-                else:
-                    try:
-                        budget_month = time_transaction.month
-                    except Exception as e:
-                        budget_month = None
-
-                # 11. Описание операции от банка - bank_description
-                bank_description = row.get('bank_description', None)
-                if bank_description:
-                    transaction_loading_log[log_idx][3]['bank_description'] = {'value': bank_description}
-
-                # 12. Категория операции от банка - bank_category
-                bank_category = row.get('bank_category', None)
-                if bank_category:
-                    transaction_loading_log[log_idx][3]['bank_category'] = {'value': bank_category}
-
-                # 13. MCC код от банка - mcc_code
-                mcc_code = row.get('mcc_code', None)
-                if mcc_code:
-                    transaction_loading_log[log_idx][3]['mcc_code'] = {'value': mcc_code}
-
-                # 14. Место совершения операции - place
-                place = row.get('place', None)
-                if place:
-                    transaction_loading_log[log_idx][3]['place'] = {'value': place}
-
-                # 15. Описание операции - description
-                description = row.get('description', None)
-                if description:
-                    transaction_loading_log[log_idx][3]['description'] = {'value': description}
-
-                # Развилка по наличию ошибок или их отсутствию
-                if not (is_time_transaction_error or is_amount_acc_cur_error or is_movement_flag_error or
-                        is_category_error or is_currency_error or is_amount_error or is_project_error or
-                        is_budget_year_error or is_budget_month_error):
-                    # Ошибок нет
-                    budget = account.budget
-                    user_create = request.user
-                    user_update = request.user
-
-                    # Посмотрим есть ли такая операция уже в системе (время + тип + сумма)
-                    exist_the_same_transactions = \
-                        Transaction.objects.filter(budget_id=budget.pk, account_id=account.pk,
-                                                   time_transaction=time_transaction, type=transaction_type,
-                                                   amount_acc_cur=amount_acc_cur)
-                    if exist_the_same_transactions:
-                        transaction_loading_log[log_idx][2]['error'] = 'такая операция<br>уже существует'
-                        transaction_loading_log[log_idx][0] = 0
-                    else:
-                        # Такой операции нет - создаем ее и категорию к ней
-                        try:
-                            with transaction.atomic():
-                                new_transaction = Transaction()
-                                new_transaction.budget = budget
-                                new_transaction.account = account
-                                new_transaction.type = transaction_type
-                                new_transaction.time_transaction = time_transaction
-                                new_transaction.time_zone = time_zone
-                                new_transaction.amount_acc_cur = amount_acc_cur
-                                new_transaction.currency = currency
-                                new_transaction.amount = amount
-                                new_transaction.budget_year = budget_year
-                                new_transaction.budget_month = budget_month
-                                new_transaction.place = place
-                                new_transaction.description = description
-                                new_transaction.mcc_code = mcc_code
-                                new_transaction.banks_category = bank_category
-                                new_transaction.banks_description = bank_description
-                                new_transaction.project = project
-                                new_transaction.user_create = user_create
-                                new_transaction.user_update = user_update
-                                new_transaction.save()
-                                if transaction_type in ['CRE', 'DEB']:
-                                    new_transaction_category = TransactionCategory()
-                                    new_transaction_category.transaction = new_transaction
-                                    new_transaction_category.category = category
-                                    new_transaction_category.amount_acc_cur = amount_acc_cur
-                                    new_transaction_category.budget_year = budget_year
-                                    new_transaction_category.budget_month = budget_month
-                                    new_transaction_category.project = project
-                                    new_transaction_category.save()
-                                transaction_loading_log[log_idx][0] = 1
-                        except Exception as e:
-                            transaction_loading_log[log_idx][2]['error'] = 'операция не смогла<br>быть загружена'
-                            transaction_loading_log[log_idx][0] = 0
-                else:
-                    transaction_loading_log[log_idx][0] = 0
-
-                row_idx += 1
+                    valid_datetime_formats += f"<br>{datetime_format}: {example_datetime.strftime(datetime_format)}"
+                loading_options = {'time_zone': ftod(request.POST['transactions_time_zone'], 2),
+                                   'datetime_formats': datetime_formats,
+                                   'valid_datetime_formats': valid_datetime_formats}
+
+                # Предзагрузим справочники одним запросом на справочник
+                validation_references, saving_references = get_loading_references(account)
+
+                # Предварительная проверка файла без загрузки операций
+                if request.POST.get('dry_run', '0') == '1':
+                    log_id = uuid4().hex
+                    preview = preview_loading_file(rows, row_idx, transaction_loading_log[0][3:], account,
+                                                   validation_references, loading_options,
+                                                   get_loading_log_file_name(account, log_id))
+                    return render(request, 'main/transaction_loading_preview.html',
+                                  get_u_context(request,
+                                                {'title': 'Проверка файла загрузки операций по счету/кошельку - ' +
+                                                          str(account),
+                                                 'file': request.FILES['transactions_file'].name,
+                                                 'header_loading_log': transaction_loading_log[0],
+                                                 'preview': preview,
+                                                 'preview_errors_limit': TRANSACTION_LOADING_PREVIEW_ERRORS,
+                                                 'preview_sample_limit': TRANSACTION_LOADING_PREVIEW_SAMPLE,
+                                                 'log_id': log_id,
+                                                 'work_menu': True,
+                                                 'account_selected': account.id,
+                                                 'selected_menu': 'account_transactions',
+                                                 'return_url': return_url}))
+
+                # Проверяем строки порциями (параллельно), записываем операции порциями в одном процессе
+                for validated_chunk in iterate_validated_chunks(rows, row_idx,
+                                                                validation_references, loading_options):
+                    transaction_loading_log.extend([log for log, r in validated_chunk])
+                    save_loading_chunk(resolve_loading_rows(validated_chunk, account, request.user,
+                                                            saving_references),
+                                       account, request.user, is_skip_duplicates,
+                                       saving_references['last_transaction_times'])
 
-            # Если не было ошибки на уровне наличия обязательных полей в файле, то показываем пользователю лог загрузки
-            if not is_error:
                 return render(request, 'main/transaction_loading_log.html',
                               get_u_context(request,
                                             {'title': 'Протокол загрузки операций из файла по счету/кошельку - ' +
@@ -3062,7 +2806,8 @@ def load_transactions(request, account_id, return_url):
 
     last_transactions = \
         Transaction.objects.filter(budget_id=account.budget.pk, account_id=account.pk).exclude(
-            type__in=['ED+', 'ED-']).order_by('-time_transaction')[:3]
+            type__in=['ED+', 'ED-']).order_by('-time_transaction').select_related(
+            'account', 'currency').prefetch_related(Transaction.get_categories_prefetch())[:3]
 
     return render(request, 'main/transaction_load.html',
                   get_u_context(request,
@@ -3082,6 +2827,27 @@ def load_transactions(request, account_id, return_url):
                                  'return_url': return_url}))
 
 
+@login_required
+def download_loading_log(request, account_id, log_id):
+    """
+    Функция скачивания полного протокола предварительной проверки файла загрузки операций
+    """
+    if not (hasattr(request.user, 'profile') and request.user.profile.budget):
+        return redirect('home')
+
+    account = get_object_or_404(Account, pk=account_id)
+
+    if account.budget != request.user.profile.budget:
+        return HttpResponseForbidden("<h1>Доступ запрещен</h1>")
+
+    log_file_name = get_loading_log_file_name(account, log_id)
+    if not log_file_name or not os.path.exists(log_file_name):
+        raise Http404
+
+    return FileResponse(open(log_file_name, 'rb'), as_attachment=True,
+                        filename='hamsterock-loading-log.csv.gz', content_type='application/gzip')
+
+
 @login_required
 def annual_budget(request, year, currency_id):
     """
@@ -3691,8 +3457,8 @@ def annual_budget(request, year, currency_id):
 @login_required
 def edit_budget_register(request):
     """
-    Функция изменения планового значения бюджетного регистра.
-    Вызывается в асинхронном режиме с фронта AJAX
+    Функция изменения плановых значений бюджетных регистров.
+    Вызывается в асинхронном режиме с фронта AJAX - по одной ячейке или пачкой правок (cells)
     """
     if not request.user.is_authenticated:
         return JsonResponse({'status': 'PermissionDenied'}, status=403)
@@ -3704,17 +3470,21 @@ def edit_budget_register(request):
     if is_ajax:
         if request.method == 'POST':
             planned_data = json.load(request)
+
+            # Правки приходят пачкой (cells) или по одной ячейке в самом запросе
+            is_batch = 'cells' in planned_data
             try:
-                cat_budget_id = int(planned_data.get('cat_budget_id'))
-                cat_year = int(planned_data.get('cat_year'))
-                cat_month = int(planned_data.get('cat_month'))
-                cat_id = int(planned_data.get('cat_id'))
-                cat_parent_id = int(planned_data.get('cat_parent_id'))
-                cat_dir = planned_data.get('cat_dir')
-                cat_type = planned_data.get('cat_type')
-                cat_planned_value = ftod(planned_data.get('cat_planned_value'), 2)
-                if cat_dir == 'exp':
-                    cat_planned_value = -cat_planned_value
+                cells = []
+                for cell_data in (planned_data.get('cells') if is_batch else [planned_data]):
+                    cell = {'cat_year': int(cell_data.get('cat_year')),
+                            'cat_month': int(cell_data.get('cat_month')),
+                            'cat_id': int(cell_data.get('cat_id')),
+                            'cat_dir': cell_data.get('cat_dir'),
+                            'cat_type': cell_data.get('cat_type'),
+                            'cat_planned_value': ftod(cell_data.get('cat_planned_value'), 2)}
+                    if cell['cat_dir'] == 'exp':
+                        cell['cat_planned_value'] = -cell['cat_planned_value']
+                    cells.append(cell)
             except Exception as e:
                 return JsonResponse({'status': 'Error', 'error_massage': str(e)}, status=400)
 
@@ -3723,90 +3493,13 @@ def edit_budget_register(request):
 
             try:
                 with transaction.atomic():
-                    date_rate = date(cat_year, 1, 1) - timedelta(days=1)
-                    rate = CurrencyRate.get_rate(request.user.profile.budget.base_currency_2_id,
-                                                 request.user.profile.budget.base_currency_1_id,
-                                                 date_rate)
-
-                    budget_register_non_project, created = \
-                        BudgetRegister.objects.get_or_create(budget_id=cat_budget_id,
-                                                             budget_year=cat_year,
-                                                             budget_month=cat_month,
-                                                             category_id=cat_id,
-                                                             project_id__isnull=True)
-                    old_non_project = ftod(budget_register_non_project.planned_amount_base_cur_1, 2)
-
-                    budget_register_project, created = \
-                        BudgetRegister.objects.get_or_create(budget_id=cat_budget_id,
-                                                             budget_year=cat_year,
-                                                             budget_month=cat_month,
-                                                             category_id=cat_id,
-                                                             project_id=0)
-                    old_project = ftod(budget_register_project.planned_amount_base_cur_1, 2)
-
-                    old_all = ftod(old_non_project + old_project, 2)
-
-                    new_non_project = ftod(old_non_project, 2)
-                    new_project = ftod(old_project, 2)
-
-                    if cat_type == 'all':
-                        delta = cat_planned_value - ftod(old_non_project + old_project, 2)
-                        delta_x = max(-old_non_project, delta) if cat_dir == 'inc' else -max(old_non_project, -delta)
-                        delta_y = delta - delta_x
-
-                        budget_register_non_project.planned_amount_base_cur_1 = \
-                            ftod(budget_register_non_project.planned_amount_base_cur_1, 2) + ftod(delta_x, 2)
-                        budget_register_non_project.planned_amount_base_cur_2 = \
-                            ftod(budget_register_non_project.planned_amount_base_cur_1 * rate, 2)
-                        budget_register_non_project.save()
-                        new_non_project = ftod(budget_register_non_project.planned_amount_base_cur_1, 2)
-                        if ftod(delta_y, 2) != ftod(0.00, 2):
-                            budget_register_project.planned_amount_base_cur_1 = \
-                                ftod(budget_register_project.planned_amount_base_cur_1, 2) + ftod(delta_y, 2)
-                            budget_register_project.planned_amount_base_cur_2 = \
-                                ftod(budget_register_project.planned_amount_base_cur_1 * rate, 2)
-                            budget_register_project.save()
-                            new_project = ftod(budget_register_project.planned_amount_base_cur_1, 2)
-
-                    elif cat_type == 'non-project':
-                        budget_register_non_project.planned_amount_base_cur_1 = ftod(cat_planned_value, 2)
-                        budget_register_non_project.planned_amount_base_cur_2 = \
-                            ftod(budget_register_non_project.planned_amount_base_cur_1 * rate, 2)
-                        budget_register_non_project.save()
-                        new_non_project = ftod(budget_register_non_project.planned_amount_base_cur_1, 2)
-
-                    elif cat_type == 'project':
-                        budget_register_project.planned_amount_base_cur_1 = ftod(cat_planned_value, 2)
-                        budget_register_project.planned_amount_base_cur_2 = \
-                            ftod(budget_register_project.planned_amount_base_cur_1 * rate, 2)
-                        budget_register_project.save()
-                        new_project = ftod(budget_register_project.planned_amount_base_cur_1, 2)
-
-                    new_all = ftod(new_non_project + new_project, 2)
-
-                    delta_all = ftod(new_all - old_all, 2)
-                    delta_non_project = ftod(new_non_project - old_non_project, 2)
-                    delta_project = ftod(new_project - old_project, 2)
-
-                    if cat_dir == 'exp':
-                        new_all = -new_all
-                        new_non_project = -new_non_project
-                        new_project = -new_project
-                        delta_all = -delta_all
-                        delta_non_project = -delta_non_project
-                        delta_project = -delta_project
-
+                    results = BudgetRegister.set_planned_cells(request.user.profile.budget, cells)
             except Exception as e:
                 return JsonResponse({'status': 'Error', 'error_massage': str(e)}, status=400)
 
-            return JsonResponse({'status': 'Ok',
-                                 'new_all': new_all,
-                                 'new_non_project': new_non_project,
-                                 'new_project': new_project,
-                                 'delta_all': delta_all,
-                                 'delta_non_project': delta_non_project,
-                                 'delta_project': delta_project,
-                                 })
+            if is_batch:
+                return JsonResponse({'status': 'Ok', 'cells': results})
+            return JsonResponse(dict({'status': 'Ok'}, **results[0]))
 
         return JsonResponse({'status': 'Invalid request'}, status=400)
     else:
@@ -3862,240 +3555,110 @@ def autoplanning_budget(request, budget_id, budget_year, return_url):
         form = AutoplanningBudgetForm(data=request.POST)
         if form.is_valid():
             try:
+                # Отбор регистров по типам значений для планирования
+                if request.POST['types_for_planning'] == 'only_current':
+                    types_filter = Q(project_id__isnull=True)
+                elif request.POST['types_for_planning'] == 'only_project':
+                    types_filter = Q(project_id__isnull=False)
+                else:
+                    types_filter = Q()
+
+                # Плановые значения рассчитываются в памяти и записываются одной массовой операцией:
+                # (месяц, id категории, id проекта или None) - (план в основной и в дополнительной валютах)
+                planned_values = {}
+
                 with transaction.atomic():
                     # Заполняем план из факта предыдущего года
                     if request.POST['plan_action'] in ['fill_january', 'fill_all_month']:
 
+                        # Будем изменять только январь или весь год в зависимости от выбора пользователя
+                        if request.POST['plan_action'] == 'fill_january':
+                            month_range = range(1, 2)
+                        else:
+                            month_range = range(1, 13)
+
                         # Удалим сначала существующий план, при наличии указания на сие
                         if request.POST['clean_needed'] == 'delete_first':
-                            if request.POST['plan_action'] == 'fill_january' and \
-                                    request.POST['types_for_planning'] == 'only_current':
-                                (BudgetRegister.objects
-                                 .filter(budget_id=budget_id, budget_year=budget_year,
-                                         budget_month=1, project_id__isnull=True)
-                                 .update(planned_amount_base_cur_1=ftod(0.00, 2),
-                                         planned_amount_base_cur_2=ftod(0.00, 2))
-                                 )
-                            elif request.POST['plan_action'] == 'fill_january' and \
-                                    request.POST['types_for_planning'] == 'only_project':
-                                (BudgetRegister.objects
-                                 .filter(budget_id=budget_id, budget_year=budget_year,
-                                         budget_month=1, project_id__isnull=False)
-                                 .update(planned_amount_base_cur_1=ftod(0.00, 2),
-                                         planned_amount_base_cur_2=ftod(0.00, 2))
-                                 )
-                            elif request.POST['plan_action'] == 'fill_january' and \
-                                    request.POST['types_for_planning'] == 'both':
-                                (BudgetRegister.objects
-                                 .filter(budget_id=budget_id, budget_year=budget_year,
-                                         budget_month=1)
-                                 .update(planned_amount_base_cur_1=ftod(0.00, 2),
-                                         planned_amount_base_cur_2=ftod(0.00, 2))
-                                 )
-                            elif request.POST['plan_action'] == 'fill_all_month' and \
-                                    request.POST['types_for_planning'] == 'only_current':
-                                (BudgetRegister.objects
-                                 .filter(budget_id=budget_id, budget_year=budget_year,
-                                         project_id__isnull=True)
-                                 .update(planned_amount_base_cur_1=ftod(0.00, 2),
-                                         planned_amount_base_cur_2=ftod(0.00, 2))
-                                 )
-                            elif request.POST['plan_action'] == 'fill_all_month' and \
-                                    request.POST['types_for_planning'] == 'only_project':
-                                (BudgetRegister.objects
-                                 .filter(budget_id=budget_id, budget_year=budget_year,
-                                         project_id__isnull=False)
-                                 .update(planned_amount_base_cur_1=ftod(0.00, 2),
-                                         planned_amount_base_cur_2=ftod(0.00, 2))
-                                 )
-                            elif request.POST['plan_action'] == 'fill_all_month' and \
-                                    request.POST['types_for_planning'] == 'both':
-                                (BudgetRegister.objects
-                                 .filter(budget_id=budget_id, budget_year=budget_year)
-                                 .update(planned_amount_base_cur_1=ftod(0.00, 2),
-                                         planned_amount_base_cur_2=ftod(0.00, 2))
-                                 )
+                            (BudgetRegister.objects
+                             .filter(types_filter, budget_id=budget_id, budget_year=budget_year,
+                                     budget_month__in=month_range)
+                             .update(planned_amount_base_cur_1=ftod(0.00, 2),
+                                     planned_amount_base_cur_2=ftod(0.00, 2))
+                             )
 
                         # Возьмем курс для дополнительной валюты на начало планируемого года
                         rate = CurrencyRate.get_rate(request.user.profile.budget.base_currency_2_id,
                                                      request.user.profile.budget.base_currency_1_id,
                                                      date(budget_year, 1, 1) - timedelta(days=1))
 
-                        # Будем изменять только январь или весь год в зависимости от выбора пользователя
-                        if request.POST['plan_action'] == 'fill_january':
-                            month_range = range(1, 2)
-                        else:
-                            month_range = range(1, 13)
-
                         digit_rounding = request.user.profile.budget.digit_rounding
 
-                        # Заполнение плана для текущих доходов и расходов
+                        # Возьмем суммы факта предыдущего года по категориям кроме курсовых разниц (одним запросом
+                        # для текущих и одним для проектных доходов и расходов). План проектных доходов и расходов
+                        # ведется одной суммой в регистре с проектом = 0
+                        slices = []
                         if request.POST['types_for_planning'] in ['only_current', 'both']:
-                            # Возьмем бюджетные регистры за предыдущий год кроме курсовых разниц
-                            actual_current_values = (BudgetRegister.objects
-                                                     .values('category_id')
-                                                     .annotate(actual_sum=Sum('actual_amount_base_cur_1'))
-                                                     .filter(budget_id=budget_id, budget_year=giving_year,
-                                                             project_id__isnull=True)
-                                                     .values('category_id', 'actual_sum'))
-
-                            for actual_current_value in actual_current_values:
-                                if actual_current_value.get('category_id') not in [POSITIVE_EXCHANGE_DIFFERENCE,
-                                                                                   NEGATIVE_EXCHANGE_DIFFERENCE]:
-                                    # Считаем среднее для базовой валюты
-                                    ac_val_1 = \
-                                        balance_round(actual_current_value.get('actual_sum', 0) / months,
-                                                      digit_rounding)
-                                    if ac_val_1 != ftod(0.00, 2):
-                                        # Считаем среднее для дополнительной валюты
-                                        ac_val_2 = ftod(ac_val_1 * rate, 2)
-                                        # Записываем плановые значения в бюджетные регистры планируемого года
-                                        # Если регистра нет, то создаем
-                                        for month in month_range:
-                                            br, created = \
-                                                (BudgetRegister.objects
-                                                 .get_or_create(budget_id=budget_id,
-                                                                budget_year=budget_year,
-                                                                budget_month=month,
-                                                                category_id=actual_current_value.get('category_id'),
-                                                                project_id__isnull=True)
-                                                 )
-                                            br.planned_amount_base_cur_1 = ac_val_1
-                                            br.planned_amount_base_cur_2 = ac_val_2
-                                            br.save()
-
-                        # Заполнение плана для проектных доходов и расходов
+                            slices.append((Q(project_id__isnull=True), None))
                         if request.POST['types_for_planning'] in ['only_project', 'both']:
-                            # Возьмем бюджетные регистры за предыдущий год кроме курсовых разниц
-                            actual_project_values = (BudgetRegister.objects
-                                                     .values('category_id')
-                                                     .annotate(actual_sum=Sum('actual_amount_base_cur_1'))
-                                                     .filter(budget_id=budget_id, budget_year=giving_year,
-                                                             project_id__isnull=False)
-                                                     .values('category_id', 'actual_sum'))
-                            for actual_project_value in actual_project_values:
-                                if actual_current_value.get('category_id') not in [POSITIVE_EXCHANGE_DIFFERENCE,
-                                                                                   NEGATIVE_EXCHANGE_DIFFERENCE]:
-                                    # Считаем среднее для базовой валюты
-                                    ac_val_1 = \
-                                        balance_round(actual_project_value.get('actual_sum', 0) / months, digit_rounding)
-                                    if ac_val_1 != ftod(0.00, 2):
-                                        # Считаем среднее для дополнительной валюты
-                                        ac_val_2 = ftod(ac_val_1 * rate, 2)
-                                        # Записываем плановые значения в бюджетные регистры планируемого года
-                                        # Если регистра нет, то создаем
-                                        for month in month_range:
-                                            br, created = \
-                                                (BudgetRegister.objects
-                                                 .get_or_create(budget_id=budget_id,
-                                                                budget_year=budget_year,
-                                                                budget_month=month,
-                                                                category_id=actual_project_value.get('category_id'),
-                                                                project_id=0)
-                                                 )
-                                            br.planned_amount_base_cur_1 = ac_val_1
-                                            br.planned_amount_base_cur_2 = ac_val_2
-                                            br.save()
+                            slices.append((Q(project_id__isnull=False), 0))
+                        for slice_filter, planned_project_id in slices:
+                            actual_values = (BudgetRegister.objects
+                                             .filter(slice_filter, budget_id=budget_id, budget_year=giving_year)
+                                             .exclude(category_id__in=[POSITIVE_EXCHANGE_DIFFERENCE,
+                                                                       NEGATIVE_EXCHANGE_DIFFERENCE])
+                                             .values('category_id')
+                                             .annotate(actual_sum=Sum('actual_amount_base_cur_1'))
+                                             .values_list('category_id', 'actual_sum'))
+                            for category_id, actual_sum in actual_values:
+                                # Считаем среднее для базовой валюты
+                                ac_val_1 = balance_round((actual_sum or 0) / months, digit_rounding)
+                                if ac_val_1 != ftod(0.00, 2):
+                                    # Считаем среднее для дополнительной валюты
+                                    ac_val_2 = ftod(ac_val_1 * rate, 2)
+                                    for month in month_range:
+                                        planned_values[(month, category_id, planned_project_id)] = (ac_val_1, ac_val_2)
 
                     # Копируем план января во все месяцы года
                     elif request.POST['plan_action'] == 'copy_january_to_all_month':
 
                         # Удалим сначала существующий план, при наличии указания на сие
                         if request.POST['clean_needed'] == 'delete_first':
-                            if request.POST['types_for_planning'] == 'only_current':
-                                (BudgetRegister.objects
-                                 .filter(budget_id=budget_id, budget_year=budget_year,
-                                         budget_month__gt=1, project_id__isnull=True)
-                                 .update(planned_amount_base_cur_1=ftod(0.00, 2),
-                                         planned_amount_base_cur_2=ftod(0.00, 2))
-                                 )
-                            elif request.POST['types_for_planning'] == 'only_project':
-                                (BudgetRegister.objects
-                                 .filter(budget_id=budget_id, budget_year=budget_year,
-                                         budget_month__gt=1, project_id__isnull=False)
-                                 .update(planned_amount_base_cur_1=ftod(0.00, 2),
-                                         planned_amount_base_cur_2=ftod(0.00, 2))
-                                 )
-                            elif request.POST['types_for_planning'] == 'both':
-                                (BudgetRegister.objects
-                                 .filter(budget_id=budget_id, budget_year=budget_year,
-                                         budget_month__gt=1)
-                                 .update(planned_amount_base_cur_1=ftod(0.00, 2),
-                                         planned_amount_base_cur_2=ftod(0.00, 2))
-                                 )
-
-                        # Берем плановые значения января (различные опции)
-                        if request.POST['types_for_planning'] == 'only_current':
-                            planned_values = BudgetRegister.objects.filter(budget_id=budget_id,
-                                                                           budget_year=budget_year,
-                                                                           budget_month=1,
-                                                                           project_id__isnull=True)
-                        elif request.POST['types_for_planning'] == 'only_project':
-                            planned_values = BudgetRegister.objects.filter(budget_id=budget_id,
-                                                                           budget_year=budget_year,
-                                                                           budget_month=1,
-                                                                           project_id=0)
-                        else:
-                            planned_values = BudgetRegister.objects.filter(budget_id=budget_id,
-                                                                           budget_year=budget_year,
-                                                                           budget_month=1)
-                        for planned_value in planned_values:
-                            if planned_value.category_id not in [POSITIVE_EXCHANGE_DIFFERENCE,
-                                                                 NEGATIVE_EXCHANGE_DIFFERENCE]:
-                                ac_val_1 = ftod(planned_value.planned_amount_base_cur_1, 2)
-                                if ac_val_1 != ftod(0.00, 2):
-                                    ac_val_2 = ftod(planned_value.planned_amount_base_cur_2, 2)
-                                    # Записываем плановые значения в бюджетные регистры планируемого года
-                                    # Если регистра нет, то создаем
-                                    for month in range(2, 13):
-                                        if planned_value.project_id is None:
-                                            br, created = \
-                                                (BudgetRegister.objects
-                                                 .get_or_create(budget_id=budget_id,
-                                                                budget_year=budget_year,
-                                                                budget_month=month,
-                                                                category_id=planned_value.category_id,
-                                                                project_id__isnull=True)
-                                                 )
-                                            br.planned_amount_base_cur_1 = ac_val_1
-                                            br.planned_amount_base_cur_2 = ac_val_2
-                                            br.save()
-                                        else:
-                                            br, created = \
-                                                (BudgetRegister.objects
-                                                 .get_or_create(budget_id=budget_id,
-                                                                budget_year=budget_year,
-                                                                budget_month=month,
-                                                                category_id=planned_value.category_id,
-                                                                project_id=0)
-                                                 )
-                                            br.planned_amount_base_cur_1 = ac_val_1
-                                            br.planned_amount_base_cur_2 = ac_val_2
-                                            br.save()
-
-                    # Удаляем план
-                    elif request.POST['plan_action'] == 'delete':
-                        if request.POST['types_for_planning'] == 'only_current':
                             (BudgetRegister.objects
-                             .filter(budget_id=budget_id, budget_year=budget_year,
-                                     project_id__isnull=True)
-                             .update(planned_amount_base_cur_1=ftod(0.00, 2),
-                                     planned_amount_base_cur_2=ftod(0.00, 2))
-                             )
-                        elif request.POST['types_for_planning'] == 'only_project':
-                            (BudgetRegister.objects
-                             .filter(budget_id=budget_id, budget_year=budget_year,
-                                     project_id__isnull=False)
-                             .update(planned_amount_base_cur_1=ftod(0.00, 2),
-                                     planned_amount_base_cur_2=ftod(0.00, 2))
-                             )
-                        elif request.POST['types_for_planning'] == 'both':
-                            (BudgetRegister.objects
-                             .filter(budget_id=budget_id, budget_year=budget_year)
+                             .filter(types_filter, budget_id=budget_id, budget_year=budget_year,
+                                     budget_month__gt=1)
                              .update(planned_amount_base_cur_1=ftod(0.00, 2),
                                      planned_amount_base_cur_2=ftod(0.00, 2))
                              )
 
+                        # Берем плановые значения января (план проектных значений - в регистрах с проектом = 0)
+                        if request.POST['types_for_planning'] == 'only_project':
+                            types_filter = Q(project_id=0)
+                        january_values = (BudgetRegister.objects
+                                          .filter(types_filter, budget_id=budget_id, budget_year=budget_year,
+                                                  budget_month=1)
+                                          .exclude(category_id__in=[POSITIVE_EXCHANGE_DIFFERENCE,
+                                                                    NEGATIVE_EXCHANGE_DIFFERENCE])
+                                          .order_by('id')
+                                          .values_list('category_id', 'project_id',
+                                                       'planned_amount_base_cur_1', 'planned_amount_base_cur_2'))
+                        for category_id, project_id, ac_val_1, ac_val_2 in january_values:
+                            if ftod(ac_val_1, 2) != ftod(0.00, 2):
+                                for month in range(2, 13):
+                                    planned_values[(month, category_id, None if project_id is None else 0)] = \
+                                        (ftod(ac_val_1, 2), ftod(ac_val_2, 2))
+
+                    # Удаляем план
+                    elif request.POST['plan_action'] == 'delete':
+                        (BudgetRegister.objects
+                         .filter(types_filter, budget_id=budget_id, budget_year=budget_year)
+                         .update(planned_amount_base_cur_1=ftod(0.00, 2),
+                                 planned_amount_base_cur_2=ftod(0.00, 2))
+                         )
+
+                    # Записываем плановые значения в бюджетные регистры планируемого года, недостающие регистры
+                    # создаются
+                    BudgetRegister.set_planned_values(budget_id, budget_year, planned_values)
+
                 return redirect(return_url)
 
             except Exception as e:
@@ -4728,13 +4291,16 @@ class AccountTransactionsInCategoryPeriod(LoginRequiredMixin, DataMixin, ListVie
             if budget_id != request.user.profile.budget.pk:
                 return self.handle_no_permission()
 
+        # Операции отбираются подзапросом по индексу категорий операции (категория, бюджет, год, месяц) - без DISTINCT
+        transactions_ids = TransactionCategory.objects.filter(category_id=category_id,
+                                                              budget_id=budget_id,
+                                                              budget_year=year,
+                                                              budget_month=month).values('transaction_id')
         self.queryset = (Transaction.objects
-                         .distinct()
                          .filter(budget_id=budget_id,
-                                 budget_year=year,
-                                 budget_month=month,
-                                 transaction_categories__category__id=category_id
+                                 id__in=transactions_ids
                                  )
                          .order_by('-time_transaction')
-                         .select_related('budget', 'account', 'currency', 'sender'))
+                         .select_related('budget', 'account', 'account__currency', 'currency', 'sender', 'project')
+                         .prefetch_related(Transaction.get_categories_prefetch()))
         return super(AccountTransactionsInCategoryPeriod, self).dispatch(request, *args, **kwargs)